@@ -0,0 +1,72 @@
+import threading
+
+import instrumentation
+
+# One session per process shares botocore's loader, so each service model is
+# parsed once no matter how many regions or clients use it.
+MAX_POOL_CONNECTIONS = 50
+RETRY_MODE = "adaptive"
+MAX_ATTEMPTS = 10
+GLOBAL_SERVICES = ("iam",)
+
+_session = None
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_session():
+    """Returns the process-wide boto3 session, creating it on first use."""
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3
+            _session = boto3.Session()
+        return _session
+
+
+def get_client(service, region=None):
+    """Returns a cached client for (service, region), building it on first use."""
+    key = (service, None if service in GLOBAL_SERVICES else region)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    session = get_session()
+    with _lock:
+        # Creating clients from one session is not thread-safe, so build them under the lock.
+        client = _clients.get(key)
+        if client is None:
+            from botocore.config import Config
+            config = Config(
+                max_pool_connections=MAX_POOL_CONNECTIONS,
+                retries={"mode": RETRY_MODE, "max_attempts": MAX_ATTEMPTS},
+            )
+            client = session.client(service, region_name=region, config=config)
+            if instrumentation.enabled:
+                instrumentation.attach(client)
+            _clients[key] = client
+    return client
+
+
+class LazyClient:
+    """Stands in for a client and only builds it when an API is first used."""
+
+    def __init__(self, service, region=None):
+        self.service = service
+        self.region = region
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service, self.region), name)
+
+
+def lazy_client(service, region=None):
+    """Returns a client placeholder; no service model is loaded until it is called."""
+    return LazyClient(service, region)
+
+
+def reset_clients():
+    """Drops the cached session and clients, e.g. after changing credentials."""
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
@@ -0,0 +1,246 @@
+"""Benchmarks the full deploy and teardown flows against a local AWS stand-in.
+
+Runs vpn_create.deploy and clean_up.destroy against benchmarks/fake_aws.py,
+which charges a fixed latency per call, and reports wall-clock time, peak
+memory, API calls per operation and serial round trips (the longest chain
+of calls that had to wait for each other). The run fails when a call count
+or the number of serial round trips is above benchmarks/baselines.json. No
+network or AWS credentials are needed.
+
+    python3 benchmarks/bench_deploy.py
+    python3 benchmarks/bench_deploy.py --write-baselines
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clean_up  # noqa: E402
+import discovery_cache  # noqa: E402
+import openvpn_aws  # noqa: E402
+import vpn_create  # noqa: E402
+import waiters  # noqa: E402
+from fake_aws import FakeAWS  # noqa: E402
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+API_LATENCY = 0.02
+INSTANCE_COUNTS = (1, 3)
+# Lookups the discovery cache answers on a repeat deploy. Key pairs are not among them: preflight checks
+# those live, as it does security groups when deploying into an existing VPC.
+CACHED_LOOKUPS = ("ec2:DescribeImages", "ec2:DescribeInstanceTypes", "ec2:DescribeInstanceTypeOfferings",
+                  "service-quotas:GetServiceQuota", "iam:GetRole")
+REGION = "eu-west-2"
+
+
+def measure(world, flow):
+    """Runs flow() with stdout silenced. Returns (result, metrics)."""
+    world.reset_calls()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            result = flow()
+        finally:
+            sys.stdout = stdout
+    wall_clock = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {
+        "wall_clock": wall_clock,
+        "peak_memory_kib": peak / 1024,
+        "api_calls": len(world.calls),
+        "serial_round_trips": world.serial_round_trips(),
+        "calls": world.call_counts(),
+    }
+
+
+def run_scenario(instance_count):
+    """Deploys and tears down one stack. Returns {flow: metrics}."""
+    world = FakeAWS(latency=API_LATENCY, region=REGION)
+    world.install()
+    vpn_create.resources.clear()
+    vpn_create.init_clients(REGION)
+
+    def deploy():
+        return vpn_create.deploy({"key_name": "bench-key", "instance_count": instance_count}, create_new_vpc=True)
+
+    def teardown():
+        return clean_up.destroy(clean_up.load_resources_from_file())
+
+    deployed, deploy_metrics = measure(world, deploy)
+    destroyed, teardown_metrics = measure(world, teardown)
+    if not deployed or not destroyed or world.leftovers():
+        raise RuntimeError(f"Flow failed for {instance_count} instance(s): deployed={deployed}, "
+                           f"destroyed={destroyed}, leftovers={world.leftovers()}")
+    return {"deploy": deploy_metrics, "teardown": teardown_metrics}
+
+
+def check_resume(instance_count=3):
+    """Interrupts a deploy after its instances launched, resumes it like the CLI does and tears it down.
+
+    Returns the problems found: the resume must reuse the recorded instances
+    instead of launching (and forgetting) a new set.
+    """
+    world = FakeAWS(latency=0.001, region=REGION)
+    world.install()
+    vpn_create.resources.clear()
+    vpn_create.init_clients(REGION)
+    world.failures["AllocateAddress"] = "AddressLimitExceeded"
+    options = openvpn_aws.merge_options(openvpn_aws.build_parser().parse_args(["create", "--resume", "--no-input"]))
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            interrupted = vpn_create.deploy({"key_name": "bench-key", "instance_count": instance_count},
+                                            create_new_vpc=True)
+            launched = sorted(world.instances)
+            resumed = vpn_create.create(options, resume=True)
+            recorded = sorted(clean_up.load_resources_from_file().get("instance_ids", []))
+            destroyed = clean_up.destroy(clean_up.load_resources_from_file())
+        finally:
+            sys.stdout = stdout
+
+    problems = []
+    if interrupted or len(launched) != instance_count:
+        problems.append(f"resume: the first run was not interrupted after launching {instance_count} instances.")
+    if not resumed or recorded != launched or len(world.instances) != instance_count:
+        problems.append(f"resume: launched {launched} before and {sorted(world.instances)} in total, "
+                        f"but recorded {recorded}.")
+    if not destroyed or world.leftovers():
+        problems.append(f"resume: teardown failed or left {world.leftovers()}.")
+    return problems
+
+
+def check_cache(work_dir):
+    """Deploys with the discovery cache on. Returns the problems found.
+
+    A repeat deploy must make none of the lookups the cache covers. A
+    security group or role deleted behind the cache's back must not be
+    served from it.
+    """
+    discovery_cache.enabled = True
+    discovery_cache.CACHE_FILE = os.path.join(work_dir, "discovery.json")
+    discovery_cache._entries = None
+    discovery_cache._account = "123456789012"  # The stand-in has no credentials to identify the account by
+    world = FakeAWS(latency=0.001, region=REGION)
+    world.install()
+    problems = []
+
+    def deploy(resources_file, **context):
+        vpn_create.resources.clear()
+        vpn_create.init_clients(REGION)
+        world.reset_calls()
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                ok = vpn_create.deploy(dict({"key_name": "bench-key", "instance_count": 1}, **context),
+                                       create_new_vpc="vpc_id" not in context, resources_file=resources_file)
+            finally:
+                sys.stdout = stdout
+        if not ok:
+            problems.append(f"cache: the deploy to '{resources_file}' failed.")
+        return clean_up.load_resources_from_file(resources_file), world.call_counts()
+
+    try:
+        first, _ = deploy("cache-1.json")
+        _, calls = deploy("cache-2.json")
+        repeated = {operation: count for operation, count in calls.items() if operation in CACHED_LOOKUPS}
+        if repeated:
+            problems.append(f"cache: the repeat deploy still made cached lookups: {repeated}")
+
+        # Delete the group and the role the cache points at, then deploy into the same VPC.
+        del world.security_groups[first["security_group_id"]]
+        del world.roles[first["lambda_role_name"]]
+        third, _ = deploy("cache-3.json", vpc_id=first["vpc_id"], subnet_id=first["subnets"][0])
+        if third.get("security_group_id") not in world.security_groups:
+            problems.append(f"cache: the deleted security group {first['security_group_id']} was served "
+                            f"from the cache.")
+        if first["lambda_role_name"] not in world.roles:
+            problems.append("cache: the deleted Lambda role was served from the cache and not recreated.")
+
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                for resources_file in ("cache-3.json", "cache-2.json", "cache-1.json"):
+                    clean_up.destroy(clean_up.load_resources_from_file(resources_file))
+            finally:
+                sys.stdout = stdout
+        if world.leftovers():
+            problems.append(f"cache: teardown left {world.leftovers()}.")
+    finally:
+        discovery_cache.enabled = False
+        discovery_cache._entries = None
+    return problems
+
+
+def check(name, metrics, baseline):
+    """Returns the regressions of one flow against its baseline."""
+    problems = []
+    if metrics["serial_round_trips"] > baseline["serial_round_trips"]:
+        problems.append(f"{name}: {metrics['serial_round_trips']} serial round trips "
+                        f"(baseline {baseline['serial_round_trips']})")
+    for operation, count in metrics["calls"].items():
+        allowed = baseline["calls"].get(operation, 0)
+        if count > allowed:
+            problems.append(f"{name}: {operation} called {count} times (baseline {allowed})")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--write-baselines", action="store_true", help="Record this run as the new baselines.")
+    args = parser.parse_args()
+
+    discovery_cache.enabled = False
+    # The stand-in changes instance state per poll, so polling needs no real waiting.
+    waiters.INITIAL_POLL_DELAY = waiters.MAX_POLL_DELAY = API_LATENCY
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        cwd = os.getcwd()
+        os.chdir(work_dir)  # Deploy writes resources.json and the .pem file here
+        try:
+            for count in INSTANCE_COUNTS:
+                for flow, metrics in run_scenario(count).items():
+                    results[f"{flow}-{count}"] = metrics
+            resume_problems = check_resume() + check_cache(work_dir)
+        finally:
+            os.chdir(cwd)
+
+    print(f"API latency: {API_LATENCY * 1000:.0f} ms per call\n")
+    print(f"{'flow':<12} {'wall (s)':>9} {'calls':>6} {'serial':>7} {'peak KiB':>9}")
+    for name, metrics in results.items():
+        print(f"{name:<12} {metrics['wall_clock']:>9.2f} {metrics['api_calls']:>6} "
+              f"{metrics['serial_round_trips']:>7} {metrics['peak_memory_kib']:>9.0f}")
+
+    if args.write_baselines:
+        baselines = {name: {"serial_round_trips": metrics["serial_round_trips"], "calls": metrics["calls"]}
+                     for name, metrics in results.items()}
+        with open(BASELINES_FILE, "w") as file:
+            json.dump(baselines, file, indent=4)
+            file.write("\n")
+        print(f"\nBaselines written to '{BASELINES_FILE}'.")
+        return 0
+
+    with open(BASELINES_FILE, "r") as file:
+        baselines = json.load(file)
+    problems = [problem for name, metrics in results.items() if name in baselines
+                for problem in check(name, metrics, baselines[name])]
+    missing = sorted(set(results) - set(baselines))
+    problems += [f"{name}: no baseline recorded" for name in missing]
+    problems += resume_problems
+    if problems:
+        print("\nRegressions against the baselines:")
+        for problem in problems:
+            print(f"  {problem}")
+        return 1
+    print("\nNo regressions against the baselines.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""Checks that the instrumentation hooks record what botocore actually did.
+
+Builds a real EC2 client through aws_clients with instrumentation on, and
+answers its requests from a before-send handler instead of the network, so
+botocore's own retry handler and response parser run as they would against
+AWS:
+- DescribeRegions is throttled once, then succeeds, then succeeds again;
+- DescribeVpcs fails with a non-retryable error code.
+Then it compares the per-operation counts, retries, throttles and errors in
+instrumentation.report(), and checks that the Prometheus textfile escapes
+label values.
+
+Needs botocore but no network or AWS credentials.
+
+    python3 benchmarks/bench_instrumentation.py
+"""
+import os
+import sys
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aws_clients  # noqa: E402
+import instrumentation  # noqa: E402
+
+REGION = "us-east-1"
+EC2_NAMESPACE = "http://ec2.amazonaws.com/doc/2016-11-15/"
+THROTTLE = (503, "<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Request limit exceeded."
+                 "</Message></Error></Errors><RequestID>bench</RequestID></Response>")
+NOT_FOUND = (400, "<Response><Errors><Error><Code>InvalidVpcID.NotFound</Code><Message>The vpc ID 'vpc-0' does not"
+                  " exist</Message></Error></Errors><RequestID>bench</RequestID></Response>")
+REGIONS = (200, f'<DescribeRegionsResponse xmlns="{EC2_NAMESPACE}"><requestId>bench</requestId><regionInfo>'
+                f"<item><regionName>{REGION}</regionName></item></regionInfo></DescribeRegionsResponse>")
+# Responses handed out per action, in order; the last one repeats.
+RESPONSES = {"DescribeRegions": [THROTTLE, REGIONS], "DescribeVpcs": [NOT_FOUND]}
+# operation: (count, retries, throttles, errors) expected in the report
+EXPECTED = {"DescribeRegions": (2, 1, 1, 0), "DescribeVpcs": (1, 0, 0, 1)}
+STEP_NAME = 'say "hi"\\\nbye'
+
+
+class RawBody:
+    """The minimal raw stream AWSResponse reads its content from."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def stub_endpoint(client, attempts):
+    """Answers every request of client from RESPONSES and counts the HTTP attempts per action."""
+    from botocore.awsrequest import AWSResponse
+
+    def send(request, **kwargs):
+        body = request.body.decode() if isinstance(request.body, bytes) else request.body
+        action = parse_qs(body)["Action"][0]
+        queue = RESPONSES[action]
+        status, content = queue.pop(0) if len(queue) > 1 else queue[0]
+        attempts[action] = attempts.get(action, 0) + 1
+        return AWSResponse(request.url, status, {"Content-Type": "text/xml"}, RawBody(content.encode()))
+
+    client.meta.events.register("before-send", send)
+
+
+def check_hooks():
+    """Makes the stubbed calls and returns the differences between report() and EXPECTED."""
+    from botocore.exceptions import ClientError
+
+    # Dummy credentials; nothing leaves the process.
+    os.environ.update(AWS_ACCESS_KEY_ID="testing", AWS_SECRET_ACCESS_KEY="testing", AWS_EC2_METADATA_DISABLED="true")
+    os.environ.pop("AWS_PROFILE", None)
+    aws_clients.reset_clients()
+    instrumentation.enable()
+    client = aws_clients.get_client("ec2", REGION)
+    attempts = {}
+    stub_endpoint(client, attempts)
+
+    problems = []
+    client.describe_regions()
+    client.describe_regions()
+    try:
+        client.describe_vpcs(VpcIds=["vpc-0"])
+        problems.append("DescribeVpcs did not raise the stubbed error.")
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "InvalidVpcID.NotFound":
+            problems.append(f"DescribeVpcs raised {e.response['Error']['Code']}, not InvalidVpcID.NotFound.")
+
+    calls = {call["operation"]: call for call in instrumentation.report()["api_calls"]}
+    print(f"{'operation':<16} {'attempts':>8} {'count':>6} {'retries':>8} {'throttles':>10} {'errors':>7}")
+    for operation, expected in EXPECTED.items():
+        call = calls.get(operation)
+        if call is None:
+            problems.append(f"{operation} is missing from the report.")
+            continue
+        recorded = (call["count"], call["retries"], call["throttles"], call["errors"])
+        print(f"{operation:<16} {attempts.get(operation, 0):>8} {recorded[0]:>6} {recorded[1]:>8} "
+              f"{recorded[2]:>10} {recorded[3]:>7}")
+        if recorded != expected:
+            problems.append(f"{operation}: (count, retries, throttles, errors) recorded as {recorded}, "
+                            f"expected {expected}.")
+        if call["service"] != "ec2" or call["latency_seconds"]["buckets"][str(instrumentation.LATENCY_BUCKETS[-1])] \
+                != call["count"]:
+            problems.append(f"{operation}: wrong service or latency histogram in {call}.")
+    return problems
+
+
+def check_prometheus():
+    """Renders a step name with a quote, a backslash and a line feed; returns any malformed output."""
+    instrumentation.record_steps("bench", {STEP_NAME: {"status": "ok", "duration": 0.5}})
+    text = instrumentation.prometheus_text(instrumentation.report())
+    problems = []
+    if 'step="say \\"hi\\"\\\\\\nbye"' not in text:
+        problems.append("The step label value is not escaped as the exposition format requires.")
+    stray = [line for line in text.splitlines() if not line.startswith(("#", "openvpn_aws_"))]
+    if stray:
+        problems.append(f"The textfile has lines outside any sample: {stray}")
+    return problems
+
+
+def main():
+    try:
+        import botocore  # noqa: F401
+    except ImportError:
+        print("FAILED: botocore is not installed.")
+        return False
+    problems = check_hooks() + check_prometheus()
+
+    print()
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    if not problems:
+        print("All instrumentation checks passed.")
+    return not problems
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,116 @@
+"""Checks the latency probe against local stand-in servers.
+
+Starts stand-ins on 127.0.0.1, each with a TCP listener and a UDP responder
+that answers OpenVPN hard resets after a fixed delay. It also starts one
+stand-in whose UDP stays silent, like a server with tls-auth, and one
+endpoint with nothing listening. Then it probes them all and checks the
+results:
+- the UDP stand-ins are ranked by their delay;
+- the silent one falls back to TCP;
+- the dead endpoint is ranked last and left out of the generated profile.
+
+    python3 benchmarks/bench_probe.py
+"""
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import probe  # noqa: E402
+
+UDP_DELAYS = (0.03, 0.01, 0.02)  # Seconds each stand-in waits before answering
+SAMPLES = 3
+TEMPLATE = "client\ndev tun\nproto udp\nremote 192.0.2.1 1194 udp\nremote-random\nnobind\n<ca>\n</ca>\n"
+
+
+class StandIn:
+    """A local TCP listener plus a UDP socket that answers hard resets after delay seconds (never if None)."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.tcp = socket.create_server(("127.0.0.1", 0))
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", 0))
+        self.running = True
+        threading.Thread(target=self.accept, daemon=True).start()
+        threading.Thread(target=self.answer, daemon=True).start()
+
+    def accept(self):
+        while self.running:
+            try:
+                connection, _ = self.tcp.accept()
+            except OSError:
+                return
+            connection.close()
+
+    def answer(self):
+        while self.running:
+            try:
+                data, address = self.udp.recvfrom(2048)
+            except OSError:
+                return
+            if self.delay is None or data[0] >> 3 != probe.P_CONTROL_HARD_RESET_CLIENT_V2:
+                continue
+            threading.Timer(self.delay, self.udp.sendto, (
+                struct.pack("!B8sBI", probe.P_CONTROL_HARD_RESET_SERVER_V2 << 3, os.urandom(8), 0, 0),
+                address)).start()
+
+    def endpoint(self, region):
+        return probe.Endpoint("127.0.0.1", region, self.tcp.getsockname()[1], self.udp.getsockname()[1])
+
+    def close(self):
+        self.running = False
+        self.tcp.close()
+        self.udp.close()
+
+
+def unused_ports():
+    """Returns a TCP and a UDP port with nothing listening on them."""
+    with socket.socket() as tcp, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+        tcp.bind(("127.0.0.1", 0))
+        udp.bind(("127.0.0.1", 0))
+        return tcp.getsockname()[1], udp.getsockname()[1]
+
+
+def main():
+    stand_ins = [StandIn(delay) for delay in UDP_DELAYS] + [StandIn(None)]
+    endpoints = [stand_in.endpoint(f"udp-{delay * 1000:.0f}ms") for stand_in, delay in zip(stand_ins, UDP_DELAYS)]
+    endpoints.append(stand_ins[-1].endpoint("tcp-only"))
+    endpoints.append(probe.Endpoint("127.0.0.1", "dead", *unused_ports()))
+    try:
+        start = time.perf_counter()
+        ranked = probe.probe(endpoints, samples=SAMPLES, interval=0.05, timeout=0.3)
+        wall_clock = time.perf_counter() - start
+    finally:
+        for stand_in in stand_ins:
+            stand_in.close()
+
+    probe.print_ranking(ranked)
+    print(f"\nProbed {len(endpoints)} endpoints in {wall_clock:.2f}s\n")
+    profile = probe.profile_with_remotes(TEMPLATE, ranked)
+    print(profile)
+
+    order = [endpoint.region for endpoint, _ in ranked]
+    udp_order = [region for region in order if region.startswith("udp-")]
+    tcp_only = next(result for endpoint, result in ranked if endpoint.region == "tcp-only")
+    remotes = [line for line in profile.splitlines() if line.startswith("remote")]
+    problems = []
+    if udp_order != sorted(udp_order, key=lambda region: int(region[4:-2])):
+        problems.append(f"UDP stand-ins ranked {udp_order}, not by their delay.")
+    if tcp_only["udp"]["median"] is not None or tcp_only["tcp"]["median"] is None:
+        problems.append("The silent stand-in did not fall back to TCP.")
+    if order[-1] != "dead" or probe.latency(ranked[-1][1]) is not None:
+        problems.append("The dead endpoint was not ranked last as unreachable.")
+    if len(remotes) != 2 * (len(endpoints) - 1) or "remote-random" in profile or "192.0.2.1" in profile:
+        problems.append(f"The profile has unexpected remote lines: {remotes}")
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    return not problems
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,124 @@
+"""Compares the old fixed-sleep Elastic IP flow with the readiness pipeline.
+
+Runs against a stubbed EC2 endpoint on a virtual clock, so the benchmark
+finishes instantly while still reporting the deploy time each flow would take.
+
+    python3 benchmarks/bench_readiness.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vpn_create  # noqa: E402
+
+API_LATENCY = 0.15  # Seconds of virtual time charged per API call
+WAITER_DELAY = 15  # Polling interval of botocore's instance_running waiter
+BOOT_TIMES = [20, 35, 50, 90]
+
+
+class VirtualClock:
+    """Replaces time.sleep/time.monotonic so waiting costs no real time."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def monotonic(self):
+        return self.now
+
+
+class StubWaiter:
+    def __init__(self, ec2):
+        self.ec2 = ec2
+
+    def wait(self, InstanceIds):
+        while self.ec2.state(InstanceIds[0]) != "running":
+            time.sleep(WAITER_DELAY)
+            self.ec2.calls += 1
+
+
+class StubEC2:
+    """Just enough of the EC2 API for launch, readiness polling and EIP association."""
+
+    def __init__(self, clock, boot_time):
+        self.clock = clock
+        self.boot_time = boot_time
+        self.launched_at = None
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        self.clock.sleep(API_LATENCY)
+
+    def state(self, instance_id):
+        return "running" if self.clock.now - self.launched_at >= self.boot_time else "pending"
+
+    def run_instances(self, **kwargs):
+        self._call()
+        self.launched_at = self.clock.now
+        return {"Instances": [{"InstanceId": "i-0123456789abcdef0"}]}
+
+    def describe_instances(self, InstanceIds):
+        self._call()
+        instances = [{"InstanceId": i, "State": {"Name": self.state(i)}} for i in InstanceIds]
+        return {"Reservations": [{"Instances": instances}]}
+
+    def allocate_address(self, Domain):
+        self._call()
+        return {"PublicIp": "203.0.113.10", "AllocationId": "eipalloc-0123456789abcdef0"}
+
+    def associate_address(self, InstanceId, AllocationId):
+        self._call()
+        if self.state(InstanceId) != "running":
+            raise RuntimeError("IncorrectInstanceState")
+        return {"AssociationId": "eipassoc-0123456789abcdef0"}
+
+    def get_waiter(self, name):
+        return StubWaiter(self)
+
+
+def legacy_allocate_elastic_ip(ec2, instance_id):
+    """The original flow: fixed 60 second sleep, then the instance_running waiter."""
+    time.sleep(60)
+    ec2.get_waiter("instance_running").wait(InstanceIds=[instance_id])
+    eip_response = ec2.allocate_address(Domain="vpc")
+    ec2.associate_address(InstanceId=instance_id, AllocationId=eip_response["AllocationId"])
+
+
+def run_flow(boot_time, flow):
+    clock = VirtualClock()
+    ec2 = StubEC2(clock, boot_time)
+    vpn_create.ec2_client = ec2
+    real_sleep, real_monotonic = time.sleep, time.monotonic
+    time.sleep, time.monotonic = clock.sleep, clock.monotonic
+    try:
+        instance_id = ec2.run_instances()["Instances"][0]["InstanceId"]
+        if flow == "legacy":
+            legacy_allocate_elastic_ip(ec2, instance_id)
+        else:
+            vpn_create.allocate_elastic_ips([instance_id])
+    finally:
+        time.sleep, time.monotonic = real_sleep, real_monotonic
+    return clock.now, ec2.calls
+
+
+def main():
+    print(f"{'boot (s)':>9} {'legacy (s)':>11} {'pipeline (s)':>13} {'saved (s)':>10} {'calls old/new':>14}")
+    for boot_time in BOOT_TIMES:
+        legacy_time, legacy_calls = run_flow(boot_time, "legacy")
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                new_time, new_calls = run_flow(boot_time, "pipeline")
+            finally:
+                sys.stdout = stdout
+        print(f"{boot_time:>9} {legacy_time:>11.1f} {new_time:>13.1f} {legacy_time - new_time:>10.1f} "
+              f"{legacy_calls:>7}/{new_calls:<6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Checks the scale-out policy offline and the scale-out flow against the local AWS stand-in.
+
+First, scaling.decide() is run on synthetic metric series: steady, spiky,
+ramping and falling load, cooldowns, missing datapoints and the minimum
+and maximum bounds. Each decision is compared with the expected server
+count.
+
+Then a --scale-out deploy runs against benchmarks/fake_aws.py:
+- heavy synthetic NetworkOut makes `scale` add servers behind the load
+  balancer, and journal them before registering them;
+- light traffic after the cooldown makes it drain one;
+- a --min override of the recorded minimum keeps the rest;
+- the teardown has to leave nothing behind.
+
+No network or AWS credentials are needed.
+
+    python3 benchmarks/bench_scaling.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clean_up  # noqa: E402
+import discovery_cache  # noqa: E402
+import scaling  # noqa: E402
+import vpn_create  # noqa: E402
+import waiters  # noqa: E402
+from fake_aws import FakeAWS  # noqa: E402
+
+MIB = 1024 ** 2
+PERIOD = scaling.DEFAULT_POLICY["period"]
+NOW = 1_800_000_000
+REGION = "eu-west-2"
+
+
+def synthetic(network_mib, cpu, instances=2, missing=()):
+    """Builds series where every instance sees the given per-period NetworkOut (MiB/s) and CPU (%).
+
+    missing lists (instance index, period index) pairs without a datapoint.
+    """
+    start = NOW - len(network_mib) * PERIOD
+    series = {}
+    for index in range(instances):
+        metrics = series[f"i-{index}"] = {"network_out": {}, "cpu": {}}
+        for period, (network, percent) in enumerate(zip(network_mib, cpu)):
+            if (index, period) in missing:
+                continue
+            metrics["network_out"][start + period * PERIOD] = network * MIB
+            metrics["cpu"][start + period * PERIOD] = percent
+    return series
+
+
+# (name, current servers, series, decide() keyword arguments, expected servers)
+SCENARIOS = [
+    ("steady and quiet at the minimum", 1, synthetic([0.5] * 4, [5] * 4, 1), {}, 1),
+    ("steady within the band", 3, synthetic([4] * 4, [40] * 4, 3), {}, 3),
+    ("one bandwidth spike", 2, synthetic([3, 3, 20, 3], [30] * 4), {}, 2),
+    ("one quiet dip", 3, synthetic([5, 5, 0.5, 5], [40, 40, 5, 40], 3), {}, 3),
+    ("sustained bandwidth", 2, synthetic([3, 4, 12, 14], [30] * 4), {}, 5),
+    ("sustained CPU", 3, synthetic([4] * 4, [50, 60, 85, 90], 3), {}, 6),
+    ("big surge is stepped", 2, synthetic([40, 40, 40], [95] * 3), {}, 6),
+    ("surge near the maximum", 9, synthetic([20] * 3, [80] * 3, 9), {}, 10),
+    ("surge at the maximum", 10, synthetic([20] * 3, [80] * 3, 10), {}, 10),
+    ("sustained drop", 4, synthetic([1] * 4, [10] * 4, 4), {}, 3),
+    ("drop at the minimum", 1, synthetic([0.1] * 4, [1] * 4, 1), {}, 1),
+    ("drop that would overload the rest", 2, synthetic([5] * 3, [10] * 3),
+     {"policy": {"network_out_low": 6 * MIB}}, 2),
+    ("surge during the cooldown", 2, synthetic([20] * 3, [90] * 3),
+     {"now": NOW, "last_scaled": NOW - 300}, 2),
+    ("surge after the cooldown", 2, synthetic([20] * 3, [90] * 3),
+     {"now": NOW, "last_scaled": NOW - 1800}, 6),
+    ("only one datapoint", 2, synthetic([20], [90]), {}, 2),
+    ("new server without datapoints", 3, synthetic([12] * 3, [50] * 3, 3, missing={(2, 1), (2, 2)}), {}, 7),
+    ("below a raised minimum", 1, synthetic([1] * 3, [5] * 3, 1), {"policy": {"min_instances": 2}}, 2),
+    ("above a lowered maximum", 5, synthetic([4] * 3, [40] * 3, 5), {"policy": {"max_instances": 3}}, 3),
+]
+
+
+def check_policy():
+    """Returns the scenarios whose decision differs from the expected one."""
+    print(f"{'scenario':<36} {'now':>4} {'wanted':>7} {'expected':>9}  reason")
+    problems = []
+    for name, current, series, kwargs, expected in SCENARIOS:
+        kwargs = dict({"now": NOW}, **kwargs)
+        desired, reason = scaling.decide(series, current, **kwargs)
+        print(f"{name:<36} {current:>4} {desired:>7} {expected:>9}  {reason}")
+        if desired != expected:
+            problems.append(f"{name}: wanted {desired} servers, expected {expected}.")
+    return problems
+
+
+def check_flow(world):
+    """Deploys with --scale-out, scales out and in, and tears down. Returns the problems found."""
+    problems = []
+    vpn_create.resources.clear()
+    vpn_create.init_clients(REGION)
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            deployed = vpn_create.deploy({"key_name": "bench-key", "instance_count": 1, "scale_out": True,
+                                          "max_instances": 4}, create_new_vpc=True)
+        finally:
+            sys.stdout = stdout
+    resources = clean_up.load_resources_from_file()
+    if not deployed or "load_balancer_arn" not in resources or resources.get("elastic_ips"):
+        return [f"Scale-out deploy failed or allocated Elastic IPs: {sorted(resources)}"]
+
+    def group_members():
+        return [sorted(group["targets"]) for group in world.target_groups.values()]
+
+    heavy = {"NetworkOut": 16 * MIB * PERIOD, "CPUUtilization": 50.0}
+    light = {"NetworkOut": 0.5 * MIB * PERIOD, "CPUUtilization": 5.0}
+    # (name, synthetic load, time, policy overrides as the CLI passes them, expected servers)
+    steps = [("heavy traffic", heavy, NOW, None, 4), ("heavy traffic, cooling down", heavy, NOW + 600, None, 4),
+             ("light traffic", light, NOW + 2 * 3600, None, 3),
+             ("light traffic, --min 3 over the recorded minimum", light, NOW + 4 * 3600,
+              {"min_instances": 3, "max_instances": 4}, 3)]
+    for name, load, now, overrides, expected in steps:
+        world.metrics = lambda instance_id, metric, period_start, load=load: load[metric]
+        world.reset_calls()
+        print(f"\n{name}:")
+        ok = scaling.scale(resources, overrides, dry_run=False, now=now, resources_file="resources.json")
+        instance_ids = clean_up.recorded_instance_ids(resources)
+        print(f"  {len(world.calls)} API calls, {len(instance_ids)} server(s) recorded")
+        if not ok or len(instance_ids) != expected:
+            problems.append(f"{name}: {len(instance_ids)} servers recorded, expected {expected}.")
+        # Nothing saved resources.json, so launched servers must already be on disk through the journal.
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                on_disk = clean_up.recorded_instance_ids(clean_up.load_resources_from_file())
+            finally:
+                sys.stdout = stdout
+        if not set(instance_ids) <= set(on_disk):
+            problems.append(f"{name}: {sorted(set(instance_ids) - set(on_disk))} are only recorded in memory.")
+        if any(members != sorted(instance_ids) for members in group_members()):
+            problems.append(f"{name}: target groups hold {group_members()}, not {sorted(instance_ids)}.")
+
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            destroyed = clean_up.destroy(resources)
+        finally:
+            sys.stdout = stdout
+    if not destroyed or world.leftovers():
+        problems.append(f"Teardown failed or left {world.leftovers()}.")
+    return problems
+
+
+def main():
+    problems = check_policy()
+
+    discovery_cache.enabled = False
+    waiters.INITIAL_POLL_DELAY = waiters.MAX_POLL_DELAY = 0.001
+    world = FakeAWS(latency=0.001, region=REGION)
+    world.install()
+    with tempfile.TemporaryDirectory() as work_dir:
+        cwd = os.getcwd()
+        os.chdir(work_dir)  # Deploy writes resources.json and the .pem file here
+        try:
+            problems += check_flow(world)
+        finally:
+            os.chdir(cwd)
+
+    print()
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    if not problems:
+        print("All scaling checks passed.")
+    return not problems
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,65 @@
+"""Measures the describe_instances traffic of concurrent instance waits.
+
+Launches instances in benchmarks/fake_aws.py and waits for them to run in
+three ways: one wait for all of them, one thread per instance, and one
+thread per instance with staggered starts. With the shared region poll, the
+per-instance waits should cost about as many describe_instances calls as
+the single batched wait, whatever the instance count.
+
+    python3 benchmarks/bench_waiters.py
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import waiters  # noqa: E402
+from fake_aws import FakeAWS  # noqa: E402
+
+API_LATENCY = 0.01
+POLL_DELAY = 0.05
+INSTANCE_COUNTS = (1, 10, 50)
+
+
+def launch(world, count):
+    ec2 = world.clients["ec2"]
+    response = ec2.run_instances(MinCount=count, MaxCount=count, SecurityGroupIds=["sg-bench"], SubnetId="subnet-bench")
+    return ec2, [instance["InstanceId"] for instance in response["Instances"]]
+
+
+def run(count, mode):
+    """Returns (describe_instances calls, wall-clock seconds) for one way of waiting."""
+    world = FakeAWS(latency=API_LATENCY)
+    ec2, instance_ids = launch(world, count)
+    world.reset_calls()
+    start = time.perf_counter()
+    if mode == "batched":
+        waiters.wait_for_instance_state(ec2, instance_ids, "running")
+    else:
+        threads = [threading.Thread(target=waiters.wait_for_instance_state, args=(ec2, [instance_id], "running"))
+                   for instance_id in instance_ids]
+        for thread in threads:
+            thread.start()
+            if mode == "staggered":
+                time.sleep(POLL_DELAY / 5)
+        for thread in threads:
+            thread.join()
+    wall_clock = time.perf_counter() - start
+    return world.call_counts().get("ec2:DescribeInstances", 0), wall_clock
+
+
+def main():
+    waiters.INITIAL_POLL_DELAY = waiters.MAX_POLL_DELAY = POLL_DELAY
+    print(f"API latency: {API_LATENCY * 1000:.0f} ms per call, poll interval {POLL_DELAY * 1000:.0f} ms\n")
+    print(f"{'instances':>9} {'mode':<10} {'describe calls':>14} {'wall (s)':>9}")
+    for count in INSTANCE_COUNTS:
+        for mode in ("batched", "threads", "staggered"):
+            calls, wall_clock = run(count, mode)
+            print(f"{count:>9} {mode:<10} {calls:>14} {wall_clock:>9.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
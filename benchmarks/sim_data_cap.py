@@ -0,0 +1,157 @@
+"""Replays synthetic traffic through the old alarm and the usage engine.
+
+The old alarm watched NetworkOut only and fired after 24 consecutive hours
+above cap / 720. The usage engine sums NetworkIn + NetworkOut over the
+month and is run every 15 minutes, as the scheduled Lambda would be. For
+each traffic pattern this prints how much had really been used when the
+server was stopped, against stubbed EC2 and CloudWatch endpoints.
+
+    python3 benchmarks/sim_data_cap.py
+"""
+import os
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import usage  # noqa: E402
+
+GB = 1024 ** 3
+CAP = usage.DATA_CAP_BYTES
+PERIOD = usage.PERIOD
+MONTH_START = int(datetime(2026, 11, 1, tzinfo=timezone.utc).timestamp())
+MONTH_SECONDS = 30 * 86400
+CHECK_INTERVAL = 900  # rate(15 minutes)
+PUBLISH_DELAY = 180  # A datapoint appears this long after its period ends
+INSTANCE_ID = "i-0123456789abcdef0"
+
+
+def per_period(monthly_gb, in_share, active=lambda hour: True):
+    """Spreads monthly_gb over the active hours of each day as (in, out) bytes per period."""
+    periods = MONTH_SECONDS // PERIOD
+    active_periods = sum(1 for p in range(periods) if active((p * PERIOD // 3600) % 24))
+    size = monthly_gb * GB / active_periods
+    series = []
+    for p in range(periods):
+        value = size if active((p * PERIOD // 3600) % 24) else 0
+        series.append((value * in_share, value * (1 - in_share)))
+    return series
+
+
+def with_spike(series, day, gb):
+    """Adds a one-hour download of gb on the given day."""
+    series = list(series)
+    first = day * 86400 // PERIOD
+    for p in range(first, first + 3600 // PERIOD):
+        traffic_in, traffic_out = series[p]
+        series[p] = (traffic_in + gb * GB / 12 * 0.9, traffic_out + gb * GB / 12 * 0.1)
+    return series
+
+
+SCENARIOS = {
+    "steady 150 GB": per_period(150, 0.25),
+    "steady 60 GB (under cap)": per_period(60, 0.25),
+    "evenings 200 GB": per_period(200, 0.25, active=lambda hour: 18 <= hour < 23),
+    "download-heavy 180 GB": per_period(180, 0.9),
+    "spike 70 GB + 60 GB on day 12": with_spike(per_period(70, 0.25), 12, 60),
+}
+
+
+class StubCloudWatch:
+    """Serves get_metric_data for the usage queries from a replayed series."""
+
+    def __init__(self, series):
+        self.series = series
+        self.now = MONTH_START
+        self.calls = 0
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, ScanBy, NextToken=None):
+        self.calls += 1
+        start, end = int(StartTime.timestamp()), int(EndTime.timestamp())
+        timestamps, values = [], []
+        for timestamp in range(start - start % PERIOD, end, PERIOD):
+            index = (timestamp - MONTH_START) // PERIOD
+            if timestamp + PERIOD + PUBLISH_DELAY > self.now or not 0 <= index < len(self.series):
+                continue
+            timestamps.append(datetime.fromtimestamp(timestamp, timezone.utc))
+            values.append(sum(self.series[index]))
+        results = [{"Id": query["Id"], "Timestamps": timestamps, "Values": values}
+                   for query in MetricDataQueries if "Expression" in query]
+        return {"MetricDataResults": results}
+
+
+class StubPaginator:
+    def __init__(self, ec2):
+        self.ec2 = ec2
+
+    def paginate(self, Filters):
+        instance = {"InstanceId": INSTANCE_ID, "State": {"Name": self.ec2.state},
+                    "Tags": [{"Key": key, "Value": value} for key, value in self.ec2.tags.items()]}
+        yield {"Reservations": [{"Instances": [instance]}]}
+
+
+class StubEC2:
+    """Keeps the instance state and tags the usage engine reads and writes."""
+
+    def __init__(self):
+        self.state = "running"
+        self.tags = {}
+        self.calls = 0
+
+    def get_paginator(self, name):
+        self.calls += 1
+        return StubPaginator(self)
+
+    def create_tags(self, Resources, Tags):
+        self.calls += 1
+        self.tags.update({tag["Key"]: tag["Value"] for tag in Tags})
+
+    def stop_instances(self, InstanceIds):
+        self.calls += 1
+        self.state = "stopped"
+
+
+def used_by(series, end):
+    """True combined bytes sent and received before end."""
+    return sum(sum(series[p]) for p in range(min(len(series), (end - MONTH_START) // PERIOD)))
+
+
+def legacy_cutoff(series):
+    """Returns when the old alarm would have fired, or None."""
+    threshold = CAP / (30 * 24)
+    breaching = 0
+    per_hour = 3600 // PERIOD
+    for hour in range(len(series) // per_hour):
+        network_out = sum(traffic_out for _, traffic_out in series[hour * per_hour:(hour + 1) * per_hour])
+        breaching = breaching + 1 if network_out > threshold else 0
+        if breaching == 24:
+            return MONTH_START + (hour + 1) * 3600
+    return None
+
+
+def engine_cutoff(series):
+    """Runs the usage engine on its schedule. Returns (stop time or None, API calls)."""
+    ec2, cloudwatch = StubEC2(), StubCloudWatch(series)
+    for now in range(MONTH_START + CHECK_INTERVAL, MONTH_START + MONTH_SECONDS + 1, CHECK_INTERVAL):
+        cloudwatch.now = now
+        if usage.enforce_cap(ec2, cloudwatch, [INSTANCE_ID], CAP, now=now):
+            return now, ec2.calls + cloudwatch.calls
+    return None, ec2.calls + cloudwatch.calls
+
+
+def describe(series, cutoff):
+    if cutoff is None:
+        return f"{'never':>8} {used_by(series, MONTH_START + MONTH_SECONDS) / GB:>8.1f}"
+    return f"{(cutoff - MONTH_START) / 86400:>7.2f}d {used_by(series, cutoff) / GB:>8.1f}"
+
+
+def main():
+    print(f"Cap: {CAP / GB:.0f} GB. Columns: stop time (day of month) and GB really used by then.\n")
+    print(f"{'scenario':<32} {'old alarm':>17}   {'usage engine':>17} {'calls':>6}")
+    for name, series in SCENARIOS.items():
+        cutoff, calls = engine_cutoff(series)
+        print(f"{name:<32} {describe(series, legacy_cutoff(series))}   {describe(series, cutoff)} {calls:>6}")
+
+
+if __name__ == "__main__":
+    main()
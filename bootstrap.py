@@ -0,0 +1,168 @@
+"""Throughput tuning for OpenVPN Access Server, applied through instance user data.
+
+render() fills a bash template that cloud-init runs on first boot. The
+template does three things:
+- Sizes the kernel socket buffers and backlog and switches to fq/BBR.
+- Runs one OpenVPN daemon per vCPU, mostly UDP with TCP 443 kept as a
+  fallback.
+- Sets the socket buffers, tunnel MTU and MSS clamp of the daemons and of
+  the profiles they hand out, so both ends agree.
+
+The values come from deploy-time parameters, defaulted from the instance
+type's vCPU count. validate() checks a rendered script without AWS, and
+check() does it for a range of instance types:
+
+    python3 openvpn_aws.py bootstrap --instance-type c5n.xlarge --vcpus 4
+    python3 openvpn_aws.py bootstrap --check
+"""
+import re
+import shutil
+import subprocess
+from string import Template
+
+USER_DATA_LIMIT = 16384  # EC2 limit on raw user data, before base64 encoding
+DEFAULT_SOCKET_BUFFER = 524288
+DEFAULT_TUN_MTU = 1500
+DEFAULT_MSSFIX = 1400
+MAX_SOCKET_BUFFER = 16 * 1024 ** 2
+MAX_DAEMONS = 64
+TUNING_KEYS = ("vpn_daemons", "socket_buffer", "tun_mtu", "mssfix")
+# Directives a client must set to the same value as the server, or the tunnel breaks on large packets.
+MATCHING_DIRECTIVES = ("tun-mtu", "mssfix")
+CONFIG_TEXT_PATTERN = re.compile(r'config_put vpn\.(server|client)\.config_text "([^"]*)"')
+# vCPU counts of instance types the check renders for, covering burstable to network-optimised sizes.
+SAMPLE_INSTANCE_TYPES = {
+    "t2.micro": 1, "t3.micro": 2, "t3.medium": 2, "t4g.small": 2, "c5.large": 2, "c5.xlarge": 4,
+    "c5n.2xlarge": 8, "c6gn.4xlarge": 16, "m5.8xlarge": 32, "c5n.18xlarge": 72,
+}
+
+TEMPLATE = Template("""#!/bin/bash
+# OpenVPN Access Server throughput tuning for $instance_type ($vcpus vCPU), rendered by openvpn_aws.
+set -uo pipefail
+exec >> /var/log/openvpn-tuning.log 2>&1
+
+cat > /etc/sysctl.d/90-openvpn-tuning.conf <<'SYSCTL'
+net.core.rmem_max = $kernel_buffer_max
+net.core.wmem_max = $kernel_buffer_max
+net.core.rmem_default = $socket_buffer
+net.core.wmem_default = $socket_buffer
+net.core.netdev_max_backlog = $netdev_backlog
+net.ipv4.udp_rmem_min = 16384
+net.ipv4.udp_wmem_min = 16384
+net.ipv4.ip_forward = 1
+net.ipv4.tcp_mtu_probing = 1
+net.core.default_qdisc = fq
+net.ipv4.tcp_congestion_control = bbr
+SYSCTL
+modprobe tcp_bbr || true
+sysctl --system > /dev/null
+
+# Access Server finishes its own first-boot setup before sacli answers.
+SACLI=/usr/local/openvpn_as/scripts/sacli
+for attempt in $$(seq 1 60); do
+    "$$SACLI" status > /dev/null 2>&1 && break
+    sleep 5
+done
+
+config_put() {
+    "$$SACLI" --key "$$1" --value "$$2" ConfigPut > /dev/null
+}
+config_put vpn.server.daemon.protocols both
+config_put vpn.server.daemon.udp.port 1194
+config_put vpn.server.daemon.udp.n_daemons $udp_daemons
+config_put vpn.server.daemon.tcp.port 443
+config_put vpn.server.daemon.tcp.n_daemons $tcp_daemons
+config_put vpn.server.config_text "sndbuf $socket_buffer
+rcvbuf $socket_buffer
+tun-mtu $tun_mtu
+mssfix $mssfix"
+config_put vpn.client.config_text "sndbuf $socket_buffer
+rcvbuf $socket_buffer
+tun-mtu $tun_mtu
+mssfix $mssfix"
+"$$SACLI" start > /dev/null
+echo "OpenVPN tuning applied: $udp_daemons UDP and $tcp_daemons TCP daemon(s)."
+""")
+
+
+def parameters(vcpus, vpn_daemons=None, socket_buffer=None, tun_mtu=None, mssfix=None):
+    """Returns the template values for an instance with vcpus, filling in defaults."""
+    daemons = vpn_daemons or min(vcpus, MAX_DAEMONS)
+    # UDP carries the traffic; TCP 443 is the fallback for networks that block UDP.
+    tcp_daemons = max(1, daemons // 4)
+    udp_daemons = max(1, daemons - tcp_daemons)
+    socket_buffer = DEFAULT_SOCKET_BUFFER if socket_buffer is None else socket_buffer
+    return {
+        "vcpus": vcpus,
+        "udp_daemons": udp_daemons,
+        "tcp_daemons": tcp_daemons,
+        "socket_buffer": socket_buffer,
+        "kernel_buffer_max": max(2 * socket_buffer, 4 * 1024 ** 2),
+        "netdev_backlog": min(65536, 5000 * max(1, vcpus // 4)),
+        "tun_mtu": tun_mtu or DEFAULT_TUN_MTU,
+        "mssfix": mssfix or DEFAULT_MSSFIX,
+    }
+
+
+def check_parameters(values):
+    """Returns a list of problems with the template values."""
+    errors = []
+    if values["udp_daemons"] + values["tcp_daemons"] > MAX_DAEMONS:
+        errors.append(f"{values['udp_daemons'] + values['tcp_daemons']} daemons is more than {MAX_DAEMONS}.")
+    if values["udp_daemons"] + values["tcp_daemons"] > 2 * values["vcpus"] + 1:
+        errors.append(f"{values['udp_daemons'] + values['tcp_daemons']} daemons on {values['vcpus']} vCPU(s) "
+                      f"would only contend for the same cores.")
+    if not 0 < values["socket_buffer"] <= MAX_SOCKET_BUFFER:
+        errors.append(f"socket_buffer must be between 1 and {MAX_SOCKET_BUFFER} bytes.")
+    if not 576 <= values["tun_mtu"] <= 1500:
+        errors.append("tun_mtu must be between 576 and 1500; internet paths don't carry jumbo frames.")
+    if not 536 <= values["mssfix"] <= values["tun_mtu"] - 40:
+        errors.append(f"mssfix must be between 536 and tun_mtu - 40 ({values['tun_mtu'] - 40}).")
+    return errors
+
+
+def render(instance_type, vcpus, tuning=None):
+    """Returns the user data script for instance_type, or raises ValueError for bad tuning values."""
+    values = parameters(vcpus, **{key: value for key, value in (tuning or {}).items() if key in TUNING_KEYS})
+    errors = check_parameters(values)
+    if errors:
+        raise ValueError(" ".join(errors))
+    return TEMPLATE.substitute(values, instance_type=instance_type)
+
+
+def validate(script):
+    """Returns a list of problems with a rendered script."""
+    errors = []
+    if len(script.encode()) > USER_DATA_LIMIT:
+        errors.append(f"The script is {len(script.encode())} bytes; EC2 accepts at most {USER_DATA_LIMIT}.")
+    if not script.startswith("#!/bin/bash\n"):
+        errors.append("The script does not start with a bash shebang, so cloud-init would not run it.")
+    sysctl = script.split("<<'SYSCTL'\n", 1)[-1].split("\nSYSCTL\n", 1)[0]
+    for line in sysctl.splitlines():
+        if not re.match(r"^[a-z0-9_.]+ = [a-z0-9]+$", line):
+            errors.append(f"Malformed sysctl line: {line!r}")
+    config_text = {side: dict(line.split(" ", 1) for line in text.splitlines() if " " in line)
+                   for side, text in CONFIG_TEXT_PATTERN.findall(script)}
+    for directive in MATCHING_DIRECTIVES:
+        server = config_text.get("server", {}).get(directive)
+        client = config_text.get("client", {}).get(directive)
+        if server != client:
+            errors.append(f"{directive} is {server or 'unset'} on the server but {client or 'unset'} in the "
+                          f"client profiles.")
+    bash = shutil.which("bash")
+    if bash:
+        result = subprocess.run([bash, "-n"], input=script, capture_output=True, text=True)
+        if result.returncode:
+            errors.append(f"bash -n: {result.stderr.strip()}")
+    return errors
+
+
+def check(instance_types=None, tuning=None):
+    """Renders and validates the script for each instance type. Returns {instance_type: errors}."""
+    results = {}
+    for instance_type, vcpus in (instance_types or SAMPLE_INSTANCE_TYPES).items():
+        try:
+            results[instance_type] = validate(render(instance_type, vcpus, tuning))
+        except ValueError as e:
+            results[instance_type] = [str(e)]
+    return results
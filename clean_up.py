@@ -1,10 +1,32 @@
-import boto3
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+import discovery_cache
+import instrumentation
+import journal
+import usage
+from aws_clients import get_client, lazy_client
+from retries import call_ignoring, call_with_retries, error_code
+from scheduler import Step, all_succeeded, print_timing_report, run_steps
+from waiters import wait_for_instance_state, wait_for_load_balancer_deleted
+
+# Errors that only mean another resource has not finished going away yet.
+DEPENDENCY_ERRORS = ("DependencyViolation", "DeleteConflict", "InvalidIPAddress.InUse", "ResourceInUseException",
+                     "ResourceInUse")
+# Errors that mean the resource is already gone, e.g. deleted by an earlier, interrupted cleanup.
+NOT_FOUND_ERRORS = ("InvalidVpcID.NotFound", "InvalidSubnetID.NotFound", "InvalidInternetGatewayID.NotFound",
+                    "InvalidRouteTableID.NotFound", "InvalidGroup.NotFound", "InvalidAllocationID.NotFound",
+                    "InvalidKeyPair.NotFound", "NoSuchEntity", "ResourceNotFoundException",
+                    "LoadBalancerNotFound", "TargetGroupNotFound")
+# The data cap Lambda and its schedule serve every server in the region, and its IAM role every region.
+SHARED_KEYS = ("lambda_function_name", "lambda_function_arn", "usage_check_rule_name", "lambda_role_name")
+LAMBDA_FUNCTION_NAME = "StopEC2Instance"  # The data cap Lambda vpn_create deploys in every region
 
 
 def delete_resources_file(file_path="resources.json"):
-    """Deletes the resources.json file if it exists."""
+    """Deletes the resources.json file and its deploy journal if they exist."""
+    journal.remove(journal.journal_path(file_path))
     try:
         if os.path.exists(file_path):
             os.remove(file_path)
@@ -16,36 +38,63 @@ def delete_resources_file(file_path="resources.json"):
 
 
 def load_resources_from_file(filename="resources.json"):
-    """Loads the resources from a JSON file."""
+    """Loads the resources from a JSON file, plus anything an interrupted deploy journaled."""
+    resources = {}
     try:
         with open(filename, "r") as file:
             resources = json.load(file)
         print(f"Resources loaded from '{filename}'.")
-        return resources
     except FileNotFoundError:
-        print(f"'{filename}' not found. No resources to clean up.")
-        return {}
+        print(f"'{filename}' not found.")
     except Exception as e:
         print(f"Error loading resources from file: {e}")
-        return {}
+
+    journaled = journal.replay(journal.journal_path(filename))
+    if journaled:
+        print(f"Including {len(journaled)} record(s) from the journal of an interrupted deploy.")
+        resources.update(journaled)
+    if not resources:
+        print("No resources to clean up.")
+    return resources
 
 
 def safe_execute(action, resource_name, resource_id, error_message):
-    """Executes an action safely with error handling."""
+    """Executes an action safely, retrying while other resources still depend on it."""
     try:
-        action()
+        call_ignoring(lambda: call_with_retries(action, DEPENDENCY_ERRORS,
+                                                f"{error_message.capitalize()} {resource_name} {resource_id}"),
+                      NOT_FOUND_ERRORS)
         print(f"{resource_name} {resource_id} deleted successfully.")
+        return True
     except Exception as e:
         print(f"Error {error_message} {resource_name} {resource_id}: {e}")
+        return False
+
+
+def delete_cloudwatch_alarms(alarm_names):
+    """Deletes CloudWatch alarms in a single call."""
+    print(f"Deleting CloudWatch Alarm(s): {', '.join(alarm_names)}...")
+    return safe_execute(
+        lambda: cloudwatch_client.delete_alarms(AlarmNames=alarm_names),
+        "CloudWatch Alarm(s)",
+        ", ".join(alarm_names),
+        "deleting"
+    )
 
 
-def delete_cloudwatch_alarm(alarm_name):
-    """Deletes a CloudWatch alarm."""
-    print(f"Deleting CloudWatch Alarm: {alarm_name}...")
-    safe_execute(
-        lambda: cloudwatch_client.delete_alarms(AlarmNames=[alarm_name]),
-        "CloudWatch Alarm",
-        alarm_name,
+def delete_usage_check_rule(rule_name):
+    """Removes the data usage check schedule and its target."""
+    print(f"Deleting usage check rule: {rule_name}...")
+    try:
+        call_ignoring(lambda: events_client.remove_targets(Rule=rule_name, Ids=["usage-check"]),
+                      ["ResourceNotFoundException"])
+    except Exception as e:
+        print(f"Error removing the targets of usage check rule {rule_name}: {e}")
+        return False
+    return safe_execute(
+        lambda: events_client.delete_rule(Name=rule_name),
+        "Usage check rule",
+        rule_name,
         "deleting"
     )
 
@@ -53,7 +102,7 @@ def delete_cloudwatch_alarm(alarm_name):
 def delete_lambda_function(function_name):
     """Deletes a Lambda function."""
     print(f"Deleting Lambda Function: {function_name}...")
-    safe_execute(
+    return safe_execute(
         lambda: lambda_client.delete_function(FunctionName=function_name),
         "Lambda Function",
         function_name,
@@ -61,33 +110,70 @@ def delete_lambda_function(function_name):
     )
 
 
-def terminate_ec2_instance(instance_id):
-    """Terminates an EC2 instance."""
-    print(f"Terminating EC2 Instance: {instance_id}...")
+def delete_lambda_role(role_name):
+    """Detaches the policies from the Lambda IAM role and deletes it."""
+    print(f"Deleting IAM Role: {role_name}...")
     try:
-        ec2_client.terminate_instances(InstanceIds=[instance_id])
-        print(f"Waiting for EC2 instance {instance_id} to terminate...")
-        ec2_client.get_waiter('instance_terminated').wait(InstanceIds=[instance_id])
-        print(f"EC2 Instance {instance_id} terminated.")
+        attached = iam_client.list_attached_role_policies(RoleName=role_name)["AttachedPolicies"]
+        for policy in attached:
+            iam_client.detach_role_policy(RoleName=role_name, PolicyArn=policy["PolicyArn"])
+        for policy_name in iam_client.list_role_policies(RoleName=role_name)["PolicyNames"]:
+            iam_client.delete_role_policy(RoleName=role_name, PolicyName=policy_name)
     except Exception as e:
-        print(f"Error terminating EC2 Instance {instance_id}: {e}")
+        if error_code(e) in NOT_FOUND_ERRORS:
+            print(f"IAM Role {role_name} is already gone.")
+            return True
+        print(f"Error removing policies from IAM Role {role_name}: {e}")
+        return False
+    discovery_cache.invalidate("iam_role", discovery_cache.GLOBAL_REGION, role_name)
+    return safe_execute(
+        lambda: iam_client.delete_role(RoleName=role_name),
+        "IAM Role",
+        role_name,
+        "deleting"
+    )
 
 
-def release_elastic_ip(public_ip):
-    """Releases an Elastic IP."""
+def terminate_ec2_instances(instance_ids):
+    """Terminates EC2 instances with one call and waits for all of them."""
+    print(f"Terminating EC2 Instance(s): {', '.join(instance_ids)}...")
+    try:
+        ec2_client.terminate_instances(InstanceIds=instance_ids)
+        print(f"Waiting for EC2 instance(s) {', '.join(instance_ids)} to terminate...")
+        wait_for_instance_state(ec2_client, instance_ids, "terminated")
+        print(f"EC2 Instance(s) {', '.join(instance_ids)} terminated.")
+        return True
+    except Exception as e:
+        print(f"Error terminating EC2 Instance(s) {', '.join(instance_ids)}: {e}")
+        return False
+
+
+def release_elastic_ip(public_ip, allocation_id=None):
+    """Disassociates and releases an Elastic IP without waiting for the instance to terminate."""
     print(f"Releasing Elastic IP: {public_ip}...")
     try:
-        allocation_id = ec2_client.describe_addresses(PublicIps=[public_ip])["Addresses"][0]["AllocationId"]
-        ec2_client.release_address(AllocationId=allocation_id)
-        print(f"Elastic IP {public_ip} released.")
+        if allocation_id:
+            address = ec2_client.describe_addresses(AllocationIds=[allocation_id])["Addresses"][0]
+        else:
+            address = ec2_client.describe_addresses(PublicIps=[public_ip])["Addresses"][0]
+        if "AssociationId" in address:
+            ec2_client.disassociate_address(AssociationId=address["AssociationId"])
     except Exception as e:
         print(f"Error releasing Elastic IP {public_ip}: {e}")
+        return False
+    return safe_execute(
+        lambda: ec2_client.release_address(AllocationId=address["AllocationId"]),
+        "Elastic IP",
+        public_ip,
+        "releasing"
+    )
 
 
 def delete_security_group(sg_id):
     """Deletes a security group."""
     print(f"Deleting Security Group: {sg_id}...")
-    safe_execute(
+    discovery_cache.invalidate("security_group", aws_region)
+    return safe_execute(
         lambda: ec2_client.delete_security_group(GroupId=sg_id),
         "Security Group",
         sg_id,
@@ -99,17 +185,29 @@ def detach_and_delete_internet_gateway(igw_id, vpc_id):
     """Detaches and deletes an Internet Gateway."""
     print(f"Detaching and deleting Internet Gateway: {igw_id}...")
     try:
-        ec2_client.detach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
-        ec2_client.delete_internet_gateway(InternetGatewayId=igw_id)
-        print(f"Internet Gateway {igw_id} deleted.")
+        # Detaching fails while the VPC still has mapped public addresses. A gateway
+        # recorded by an interrupted deploy may never have been attached.
+        call_ignoring(lambda: call_with_retries(
+            lambda: ec2_client.detach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id),
+            DEPENDENCY_ERRORS,
+            f"Detaching Internet Gateway {igw_id}"
+        ), ["Gateway.NotAttached"])
     except Exception as e:
         print(f"Error deleting Internet Gateway {igw_id}: {e}")
+        return False
+    return safe_execute(
+        lambda: ec2_client.delete_internet_gateway(InternetGatewayId=igw_id),
+        "Internet Gateway",
+        igw_id,
+        "deleting"
+    )
 
 
 def delete_subnet(subnet_id):
     """Deletes a subnet."""
     print(f"Deleting Subnet: {subnet_id}...")
-    safe_execute(
+    discovery_cache.invalidate("vpc_inventory", aws_region)
+    return safe_execute(
         lambda: ec2_client.delete_subnet(SubnetId=subnet_id),
         "Subnet",
         subnet_id,
@@ -120,7 +218,7 @@ def delete_subnet(subnet_id):
 def delete_route_table(route_table_id):
     """Deletes a route table."""
     print(f"Deleting Route Table: {route_table_id}...")
-    safe_execute(
+    return safe_execute(
         lambda: ec2_client.delete_route_table(RouteTableId=route_table_id),
         "Route Table",
         route_table_id,
@@ -131,7 +229,8 @@ def delete_route_table(route_table_id):
 def delete_vpc(vpc_id):
     """Deletes a VPC."""
     print(f"Deleting VPC: {vpc_id}...")
-    safe_execute(
+    discovery_cache.invalidate("vpc_inventory", aws_region)
+    return safe_execute(
         lambda: ec2_client.delete_vpc(VpcId=vpc_id),
         "VPC",
         vpc_id,
@@ -139,65 +238,259 @@ def delete_vpc(vpc_id):
     )
 
 
-def main():
-    print("Deleting resources from AWS...")
+def delete_key_pair(key_pair_id):
+    """Deletes a key pair this tool created."""
+    print(f"Deleting Key Pair: {key_pair_id}...")
+    discovery_cache.invalidate("key_pair", aws_region)
+    return safe_execute(
+        lambda: ec2_client.delete_key_pair(KeyPairId=key_pair_id),
+        "Key Pair",
+        key_pair_id,
+        "deleting"
+    )
+
+
+def delete_load_balancer(load_balancer_arn):
+    """Deletes a load balancer and waits until it is gone, since its interfaces block the subnets."""
+    print(f"Deleting Load Balancer: {load_balancer_arn}...")
+    if not safe_execute(lambda: elbv2_client.delete_load_balancer(LoadBalancerArn=load_balancer_arn),
+                        "Load Balancer", load_balancer_arn, "deleting"):
+        return False
     try:
-        global ec2_client, lambda_client, cloudwatch_client, dynamodb_client
+        wait_for_load_balancer_deleted(elbv2_client, load_balancer_arn)
+        return True
+    except Exception as e:
+        print(f"Error waiting for Load Balancer {load_balancer_arn} to be deleted: {e}")
+        return False
 
-        # Load resources from the JSON file
-        resources = load_resources_from_file()
-        if not resources:
-            print("No resources to delete. Exiting.")
-            return
 
-        # Determine the AWS region from the resources file
-        region = resources.get("region", "eu-west-2")  # Default to "eu-west-2" if not specified
-        print(f"Using region: {region}")
+def delete_target_group(target_group_arn):
+    """Deletes a target group once no load balancer forwards to it."""
+    print(f"Deleting Target Group: {target_group_arn}...")
+    return safe_execute(
+        lambda: elbv2_client.delete_target_group(TargetGroupArn=target_group_arn),
+        "Target Group",
+        target_group_arn,
+        "deleting"
+    )
 
-        # Initialize AWS clients
-        ec2_client = boto3.client("ec2", region_name=region)
-        lambda_client = boto3.client("lambda", region_name=region)
-        cloudwatch_client = boto3.client("cloudwatch", region_name=region)
-        dynamodb_client = boto3.client("dynamodb", region_name=region)
 
-        # Delete resources in reverse order
-        if "cloudwatch_alarm_name" in resources:
-            delete_cloudwatch_alarm(resources["cloudwatch_alarm_name"])
+def recorded_instance_ids(resources):
+    """Returns the instance IDs in resources, including the single-instance key of older files."""
+    instance_ids = list(resources.get("instance_ids", []))
+    if "instance_id" in resources and resources["instance_id"] not in instance_ids:
+        instance_ids.append(resources["instance_id"])
+    return instance_ids
 
-        if "lambda_function_name" in resources:
-            delete_lambda_function(resources["lambda_function_name"])
 
-        if "instance_id" in resources:
-            terminate_ec2_instance(resources["instance_id"])
+def recorded_elastic_ips(resources):
+    """Returns (public_ip, allocation_id) pairs for every Elastic IP in resources."""
+    elastic_ips = [(eip["public_ip"], eip["allocation_id"]) for eip in resources.get("elastic_ips", {}).values()]
+    if "elastic_ip" in resources:
+        elastic_ips.append((resources["elastic_ip"], resources.get("elastic_ip_allocation_id")))
+    return elastic_ips
+
+
+def recorded_alarm_names(resources):
+    """Returns the CloudWatch alarm names in resources."""
+    alarm_names = list(resources.get("cloudwatch_alarm_names", []))
+    if "cloudwatch_alarm_name" in resources:
+        alarm_names.append(resources["cloudwatch_alarm_name"])
+    return alarm_names
+
+
+def other_capped_instances(instance_ids):
+    """Returns the region's other servers that still rely on the shared data cap Lambda."""
+    try:
+        return [instance_id for instance_id in usage.describe_instances(ec2_client)
+                if instance_id not in instance_ids]
+    except Exception as e:
+        print(f"Error checking for other servers using the data cap Lambda: {e}")
+        return None
+
+
+def data_cap_in_use_elsewhere(function_name, instance_ids, deleting_function):
+    """Returns whether a data cap Lambda or capped server outside this teardown exists in any region.
+
+    The Lambda IAM role is global, so it may only go once nothing in any
+    region can still run under it. Returns True when this can't be checked.
+    """
+    def in_use(region):
+        if [instance_id for instance_id in usage.describe_instances(get_client("ec2", region))
+                if instance_id not in instance_ids]:
+            return True
+        if region == aws_region and deleting_function:
+            return False
+        try:
+            get_client("lambda", region).get_function(FunctionName=function_name)
+        except Exception as e:
+            if error_code(e) != "ResourceNotFoundException":
+                raise
+            return False
+        return True
 
-        if "elastic_ip" in resources:
-            release_elastic_ip(resources["elastic_ip"])
+    try:
+        regions = [region["RegionName"] for region in ec2_client.describe_regions()["Regions"]]
+        with ThreadPoolExecutor(max_workers=min(len(regions), 16) or 1) as executor:
+            return any(executor.map(in_use, regions))
+    except Exception as e:
+        print(f"Error checking other regions for data cap Lambdas: {e}")
+        return True
+
+
+def delete_unused_lambda_role(role_name, function_name, instance_ids, deleting_function):
+    """Deletes the Lambda IAM role unless a data cap Lambda or capped server anywhere could still use it."""
+    if data_cap_in_use_elsewhere(function_name, instance_ids, deleting_function):
+        print(f"Keeping IAM Role {role_name}: data cap Lambdas in other regions may still use it.")
+        return True
+    return delete_lambda_role(role_name)
+
+
+def build_teardown_steps(resources):
+    """Builds the reverse dependency graph of deletions for the recorded resources."""
+    steps = []
+    instance_steps = []
+    instance_ids = recorded_instance_ids(resources)
+    alarm_names = recorded_alarm_names(resources)
+    if alarm_names:
+        steps.append(Step("delete_cloudwatch_alarms", lambda: delete_cloudwatch_alarms(alarm_names)))
+
+    if "usage_check_rule_name" in resources:
+        steps.append(Step("delete_usage_check_rule",
+                          lambda: delete_usage_check_rule(resources["usage_check_rule_name"])))
+
+    if "lambda_function_name" in resources:
+        steps.append(Step("delete_lambda_function",
+                          lambda: delete_lambda_function(resources["lambda_function_name"])))
+
+    if "lambda_role_name" in resources:
+        after = ["delete_lambda_function"] if "lambda_function_name" in resources else []
+        steps.append(Step("delete_lambda_role", lambda: delete_unused_lambda_role(
+            resources["lambda_role_name"], resources.get("lambda_function_name", LAMBDA_FUNCTION_NAME), instance_ids,
+            "lambda_function_name" in resources), after=after))
+
+    if instance_ids:
+        steps.append(Step("terminate_ec2_instances", lambda: terminate_ec2_instances(instance_ids)))
+        instance_steps.append("terminate_ec2_instances")
+
+    eip_steps = []
+    for public_ip, allocation_id in recorded_elastic_ips(resources):
+        name = f"release_elastic_ip:{public_ip}"
+        steps.append(Step(name, lambda public_ip=public_ip, allocation_id=allocation_id:
+                          release_elastic_ip(public_ip, allocation_id)))
+        eip_steps.append(name)
+
+    load_balancer_steps = []
+    if "load_balancer_arn" in resources:
+        steps.append(Step("delete_load_balancer", lambda: delete_load_balancer(resources["load_balancer_arn"])))
+        load_balancer_steps.append("delete_load_balancer")
+    for key, target_group_arn in sorted(resources.get("target_group_arns", {}).items()):
+        steps.append(Step(f"delete_target_group:{key}",
+                          lambda target_group_arn=target_group_arn: delete_target_group(target_group_arn),
+                          after=load_balancer_steps))
+    # The load balancer's interfaces and public addresses live in the subnets until it is gone.
+    instance_steps = instance_steps + load_balancer_steps
+
+    vpc_steps = []
+    if "security_group_id" in resources:
+        steps.append(Step("delete_security_group", lambda: delete_security_group(resources["security_group_id"]),
+                          after=instance_steps))
+        vpc_steps.append("delete_security_group")
+
+    if "internet_gateway_id" in resources and "vpc_id" in resources:
+        steps.append(Step("delete_internet_gateway", lambda: detach_and_delete_internet_gateway(
+            resources["internet_gateway_id"], resources["vpc_id"]), after=instance_steps + eip_steps))
+        vpc_steps.append("delete_internet_gateway")
+
+    subnet_steps = []
+    for subnet_id in resources.get("subnets", []):
+        name = f"delete_subnet:{subnet_id}"
+        steps.append(Step(name, lambda subnet_id=subnet_id: delete_subnet(subnet_id), after=instance_steps))
+        subnet_steps.append(name)
+    vpc_steps.extend(subnet_steps)
+
+    if "route_table_id" in resources:
+        # The route table stays associated with the public subnet until that subnet is gone.
+        steps.append(Step("delete_route_table", lambda: delete_route_table(resources["route_table_id"]),
+                          after=subnet_steps))
+        vpc_steps.append("delete_route_table")
+
+    if "vpc_id" in resources:
+        steps.append(Step("delete_vpc", lambda: delete_vpc(resources["vpc_id"]), after=vpc_steps))
+
+    if "key_pair_id" in resources:
+        # Only set for key pairs found by the sweeper through their deployment tag.
+        steps.append(Step("delete_key_pair", lambda: delete_key_pair(resources["key_pair_id"]), after=instance_steps))
+
+    return steps
+
+
+def init_clients(region):
+    """Points the delete_* functions at one region."""
+    global ec2_client, iam_client, lambda_client, cloudwatch_client, events_client, elbv2_client, aws_region
+    aws_region = region
+
+    # Clients are shared and cached; each is only built if a deletion needs it.
+    ec2_client = lazy_client("ec2", region)
+    iam_client = lazy_client("iam", region)
+    lambda_client = lazy_client("lambda", region)
+    cloudwatch_client = lazy_client("cloudwatch", region)
+    events_client = lazy_client("events", region)
+    elbv2_client = lazy_client("elbv2", region)
+
+
+def without_shared_resources_in_use(resources, instance_ids):
+    """Leaves the data cap Lambda and its schedule out while other servers in the region use them."""
+    if "lambda_function_name" not in resources and "usage_check_rule_name" not in resources:
+        return resources
+    others = other_capped_instances(instance_ids)
+    if others == []:
+        return resources
+    if others:
+        print(f"Keeping the data cap Lambda and its schedule for {len(others)} other server(s): "
+              f"{', '.join(others)}.")
+    return {key: value for key, value in resources.items() if key not in SHARED_KEYS}
 
-        if "security_group_id" in resources:
-            delete_security_group(resources["security_group_id"])
 
-        if "internet_gateway_id" in resources and "vpc_id" in resources:
-            detach_and_delete_internet_gateway(resources["internet_gateway_id"], resources["vpc_id"])
+def destroy(resources):
+    """Deletes every resource recorded in resources. Returns True if all deletions succeeded."""
+    # Determine the AWS region from the resources file
+    region = resources.get("region", "eu-west-2")  # Default to "eu-west-2" if not specified
+    print(f"Using region: {region}")
+    init_clients(region)
 
-        if "subnets" in resources:
-            for subnet_id in resources["subnets"]:
-                delete_subnet(subnet_id)
+    resources = without_shared_resources_in_use(resources, recorded_instance_ids(resources))
 
-        if "route_table_id" in resources:
-            delete_route_table(resources["route_table_id"])
+    # Independent deletions run concurrently; each step waits only for what blocks it.
+    _, timings = run_steps(build_teardown_steps(resources), skip_dependents_on_failure=False)
+    instrumentation.record_steps("teardown", timings)
+    print_timing_report(timings, f"Teardown timing report ({region})")
+    return all_succeeded(timings)
 
-        if "vpc_id" in resources:
-            delete_vpc(resources["vpc_id"])
 
-        print("All resources deleted successfully.")
+def main(resources_file="resources.json"):
+    print("Deleting resources from AWS...")
+    try:
+        # Load resources from the JSON file
+        resources = load_resources_from_file(resources_file)
+        if not resources:
+            print("No resources to delete. Exiting.")
+            delete_resources_file(resources_file)
+            return True
+
+        if destroy(resources):
+            print("All resources deleted successfully.")
+            delete_resources_file(resources_file)
+            return True
+        # Keep the record of what is left, so the clean-up can simply be run again.
+        print(f"Some resources could not be deleted. Check the errors above. '{resources_file}' was kept; "
+              f"run the clean-up again to retry.")
+        return False
     except Exception as e:
         print(f"An error occurred during cleanup: {e}")
-    finally:
-        # Delete the resources.json file
-        delete_resources_file()
+        return False
 
 
 if __name__ == "__main__":
     main()
-    delete_resources_file()  # Ensure file cleanup happens
-
+    instrumentation.write_reports("teardown")
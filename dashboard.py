@@ -0,0 +1,117 @@
+"""Month-to-date data usage and state of deployed servers.
+
+Each region costs one describe_instances and one get_metric_data call (more
+only past 166 servers per region), however many servers it runs. Regions
+are queried concurrently.
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import usage
+from aws_clients import get_client
+
+DAY = 86400
+GB = 1024 ** 3
+
+
+def load_deployments(resources_file=None, state_dir=None):
+    """Returns {region: [resources, ...]} from a resources file or a fleet state tree."""
+    files = []
+    if state_dir:
+        for name in sorted(os.listdir(state_dir)):
+            path = os.path.join(state_dir, name, "resources.json")
+            if os.path.isfile(path):
+                files.append(path)
+    else:
+        files.append(resources_file)
+
+    deployments = {}
+    for path in files:
+        with open(path, "r") as file:
+            resources = json.load(file)
+        deployments.setdefault(resources.get("region", "eu-west-2"), []).append(resources)
+    return deployments
+
+
+def projected_cap_date(total, cap, now):
+    """Projects when the cap is reached at the month-to-date rate.
+
+    Returns "reached", a UNIX timestamp, or None if it will not be reached this month.
+    """
+    if total >= cap:
+        return "reached"
+    start = usage.month_start(now)
+    if total <= 0 or now <= start:
+        return None
+    eta = now + (cap - total) * (now - start) / total
+    return eta if eta < usage.month_start(start + 32 * DAY) else None
+
+
+def region_status(region, deployments, now):
+    """Collects the state and month-to-date usage of every server recorded for a region."""
+    instance_ids, elastic_ips = [], {}
+    for resources in deployments:
+        instance_ids.extend(resources.get("instance_ids", []))
+        if "instance_id" in resources:
+            instance_ids.append(resources["instance_id"])  # resources.json written by older versions
+            elastic_ips[resources["instance_id"]] = resources.get("elastic_ip")
+        elastic_ips.update({instance_id: eip["public_ip"]
+                            for instance_id, eip in resources.get("elastic_ips", {}).items()})
+    if not instance_ids:
+        return []
+
+    instances = usage.describe_instances(get_client("ec2", region), instance_ids)
+    start = usage.month_start(now)
+    # Daily sums stay well inside CloudWatch's retention for the whole month.
+    series = usage.fetch_usage(get_client("cloudwatch", region), instance_ids, start,
+                               int(now) // DAY * DAY + DAY, period=DAY)
+
+    rows = []
+    for instance_id in instance_ids:
+        state, tags = instances.get(instance_id, ("not found", {}))
+        total = int(sum(series[instance_id].values()))
+        cap = int(tags.get(usage.TAG_CAP, usage.DATA_CAP_BYTES))
+        rows.append({
+            "region": region,
+            "instance_id": instance_id,
+            "state": state,
+            "public_ip": elastic_ips.get(instance_id),
+            "month_to_date_bytes": total,
+            "cap_bytes": cap,
+            "projected_cap_date": projected_cap_date(total, cap, now),
+        })
+    return rows
+
+
+def collect(deployments, now=None):
+    """Returns one status row per recorded server, querying every region concurrently."""
+    now = time.time() if now is None else now
+    if not deployments:
+        return []
+    with ThreadPoolExecutor(max_workers=len(deployments)) as executor:
+        futures = [executor.submit(region_status, region, items, now) for region, items in deployments.items()]
+        return [row for future in futures for row in future.result()]
+
+
+def format_projection(projection):
+    if projection is None:
+        return "not this month"
+    if projection == "reached":
+        return "reached"
+    return time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(projection))
+
+
+def render(rows, output_format="table"):
+    """Prints the status rows as a table or as JSON."""
+    if output_format == "json":
+        print(json.dumps(rows, indent=4))
+        return
+    print(f"{'Region':<15} {'Instance':<21} {'State':<10} {'Public IP':<16} {'Used (GB)':>10} {'Cap':>5}  "
+          f"Cap reached")
+    for row in rows:
+        used = row["month_to_date_bytes"] / GB
+        percent = 100 * row["month_to_date_bytes"] / row["cap_bytes"]
+        print(f"{row['region']:<15} {row['instance_id']:<21} {row['state']:<10} {row['public_ip'] or '-':<16} "
+              f"{used:>10.2f} {percent:>4.0f}%  {format_projection(row['projected_cap_date'])}")
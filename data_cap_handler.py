@@ -0,0 +1,46 @@
+"""Lambda handler that stops servers once they reach their monthly data cap.
+
+One function serves every server in a region. Scheduled invocations check
+each instance tagged with usage.TAG_CAP; a CloudWatch alarm event, or an
+event carrying "instance_ids", stops the instances it names straight away.
+Packaged together with usage.py by vpn_create.build_lambda_package.
+"""
+import os
+
+import boto3
+
+import usage
+
+# Built once per execution environment so warm invocations skip client setup.
+ec2 = boto3.client("ec2")
+cloudwatch = boto3.client("cloudwatch")
+DEFAULT_CAP_BYTES = int(os.environ.get("DATA_CAP_BYTES", usage.DATA_CAP_BYTES))
+
+
+def event_instance_ids(event):
+    """Returns the instances an event targets, or None when it names none."""
+    if not isinstance(event, dict):
+        return None
+    if event.get("instance_ids"):
+        return list(event["instance_ids"])
+
+    alarm = event.get("alarmData")
+    if not alarm or alarm.get("state", {}).get("value") != "ALARM":
+        return None
+    instance_ids = []
+    for metric in alarm.get("configuration", {}).get("metrics", []):
+        dimensions = metric.get("metricStat", {}).get("metric", {}).get("dimensions", {})
+        if "InstanceId" in dimensions and dimensions["InstanceId"] not in instance_ids:
+            instance_ids.append(dimensions["InstanceId"])
+    return instance_ids or None
+
+
+def lambda_handler(event, context):
+    instance_ids = event_instance_ids(event)
+    if instance_ids:
+        stopped = usage.stop_running(ec2, instance_ids)
+    else:
+        stopped = usage.enforce_cap(ec2, cloudwatch, default_cap=DEFAULT_CAP_BYTES)
+    if stopped:
+        print(f"Stopped instances: {', '.join(stopped)}")
+    return {"stopped": stopped}
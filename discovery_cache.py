@@ -0,0 +1,167 @@
+"""Local cache for AWS discovery lookups.
+
+Entries are scoped by AWS account and region and expire after a per-kind TTL.
+Only positive results are cached, and the tool invalidates an entry itself
+whenever it creates or deletes the resource behind it.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+CACHE_FILE = os.environ.get("OPENVPN_AWS_CACHE_FILE",
+                            os.path.join(os.path.expanduser("~"), ".cache", "openvpn_aws", "discovery.json"))
+TTLS = {
+    "account": 7 * 86400,
+    "vpc_inventory": 300,
+    "security_group": 3600,
+    "key_pair": 86400,
+    "iam_role": 86400,
+    "image": 86400,
+    "instance_type_info": 7 * 86400,
+    "instance_type_offerings": 86400,
+    "service_quota": 86400,
+}
+GLOBAL_REGION = "global"
+
+enabled = os.environ.get("OPENVPN_AWS_NO_CACHE") is None
+_entries = None
+_account = None
+_lock = threading.Lock()
+
+
+def _read_file():
+    try:
+        with open(CACHE_FILE, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_file(entries):
+    """Writes the cache atomically so a crash never leaves a truncated file."""
+    directory = os.path.dirname(CACHE_FILE)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".discovery-")
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(entries, file)
+        os.replace(temp_path, CACHE_FILE)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+def _load():
+    global _entries
+    if _entries is None:
+        _entries = _read_file()
+    return _entries
+
+
+def _update(change):
+    """Applies change(entries) to the file contents and the in-memory copy."""
+    global _entries
+    with _lock:
+        # Re-read so entries written by other processes (e.g. fleet regions) are kept.
+        entries = _read_file()
+        now = time.time()
+        for entry_key in [k for k, entry in entries.items() if entry.get("expires", 0) <= now]:
+            del entries[entry_key]
+        change(entries)
+        try:
+            _write_file(entries)
+        except Exception as e:
+            print(f"Error writing discovery cache '{CACHE_FILE}': {e}")
+        _entries = entries
+
+
+def _account_scope():
+    """Identifies the AWS account, without an API call when the credentials were seen before."""
+    global _account, enabled
+    if _account is not None:
+        return _account
+    from aws_clients import get_client, get_session
+    try:
+        credentials = get_session().get_credentials()
+        if credentials is None:
+            return None
+        access_key = hashlib.sha256(credentials.access_key.encode()).hexdigest()[:16]
+        account = _get_entry("account", GLOBAL_REGION, access_key, scope="credentials")
+        if account is None:
+            account = get_client("sts").get_caller_identity()["Account"]
+            _put_entry("account", GLOBAL_REGION, access_key, account, scope="credentials")
+    except Exception as e:
+        print(f"Discovery cache disabled, could not identify the AWS account: {e}")
+        enabled = False
+        return None
+    _account = account
+    return account
+
+
+def _entry_key(kind, region, key, scope):
+    return f"{scope}|{region}|{kind}|{key}"
+
+
+def _get_entry(kind, region, key, scope):
+    with _lock:
+        entry = _load().get(_entry_key(kind, region, key, scope))
+    if entry and entry["expires"] > time.time():
+        return entry["value"]
+    return None
+
+
+def _put_entry(kind, region, key, value, scope):
+    entry = {"value": value, "expires": time.time() + TTLS[kind]}
+    _update(lambda entries: entries.__setitem__(_entry_key(kind, region, key, scope), entry))
+
+
+def get(kind, region, key):
+    """Returns a cached value, or None when it is missing, expired or caching is disabled."""
+    scope = _account_scope() if enabled else None
+    if scope is None:
+        return None
+    return _get_entry(kind, region, key, scope)
+
+
+def put(kind, region, key, value):
+    """Caches value for the kind's TTL."""
+    scope = _account_scope() if enabled and value is not None else None
+    if scope is not None:
+        _put_entry(kind, region, key, value, scope)
+
+
+def invalidate(kind, region, key=None):
+    """Drops one entry, or every entry of a kind in the region when key is None."""
+    scope = _account_scope() if enabled else None
+    if scope is None:
+        return
+    prefix = f"{scope}|{region}|{kind}|"
+
+    def drop(entries):
+        for entry_key in list(entries):
+            if entry_key == prefix + str(key) or (key is None and entry_key.startswith(prefix)):
+                del entries[entry_key]
+
+    _update(drop)
+
+
+def cached(kind, region, key, fetch):
+    """Returns the cached value or calls fetch() and caches a non-None result."""
+    value = get(kind, region, key)
+    if value is not None:
+        return value
+    value = fetch()
+    put(kind, region, key, value)
+    return value
+
+
+def clear():
+    """Deletes the whole cache file."""
+    global _entries
+    with _lock:
+        _entries = {}
+        if os.path.exists(CACHE_FILE):
+            os.remove(CACHE_FILE)
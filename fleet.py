@@ -0,0 +1,143 @@
+"""Non-interactive multi-region deploy and teardown.
+
+Each region is provisioned in its own process with its own clients and
+resources, and its state is written to <state-dir>/<region>/resources.json
+(next to the region's .pem file).
+
+    python3 fleet.py deploy --regions eu-west-2=2 us-east-1=1 --key-name vpn-fleet
+    python3 fleet.py deploy --spec fleet.json
+    python3 fleet.py destroy
+
+A spec file looks like {"key_name": "vpn-fleet", "regions": {"eu-west-2": 2}}.
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import clean_up
+import vpn_create
+
+DEFAULT_STATE_DIR = "fleet_state"
+
+
+def parse_region_counts(values):
+    """Parses ["eu-west-2=2", "us-east-1"] into {"eu-west-2": 2, "us-east-1": 1}."""
+    regions = {}
+    for value in values:
+        region, _, count = value.partition("=")
+        regions[region.strip()] = int(count) if count else 1
+    return regions
+
+
+def deploy_region(region, count, key_name, state_dir):
+    """Provisions one region in the current process. Returns (region, succeeded, resources)."""
+    region_dir = os.path.abspath(os.path.join(state_dir, region))
+    os.makedirs(region_dir, exist_ok=True)
+    # Key pairs are written to the working directory.
+    os.chdir(region_dir)
+    vpn_create.resources.clear()
+    try:
+        vpn_create.init_clients(region)
+        ok = vpn_create.deploy({"key_name": key_name, "instance_count": count}, create_new_vpc=True)
+    except Exception as e:
+        print(f"An error occurred while deploying {region}: {e}")
+        ok = False
+    return region, ok, dict(vpn_create.resources)
+
+
+def destroy_region(region_dir):
+    """Deletes the resources recorded for one region. Returns (region, succeeded)."""
+    region = os.path.basename(region_dir)
+    os.chdir(region_dir)
+    resources = clean_up.load_resources_from_file()
+    if not resources:
+        return region, True
+    try:
+        ok = clean_up.destroy(resources)
+    except Exception as e:
+        print(f"An error occurred while cleaning up {region}: {e}")
+        ok = False
+    if ok:
+        clean_up.delete_resources_file()
+    return region, ok
+
+
+def deploy_fleet(regions, key_name, state_dir=DEFAULT_STATE_DIR):
+    """Deploys every region concurrently. Returns True if all regions succeeded."""
+    state_dir = os.path.abspath(state_dir)
+    existing = [r for r in regions if os.path.exists(os.path.join(state_dir, r, "resources.json"))]
+    if existing:
+        print(f"State already exists for {', '.join(existing)}. Destroy it first or use another --state-dir.")
+        return False
+
+    print(f"Deploying {sum(regions.values())} server(s) across {len(regions)} region(s)...")
+    with ProcessPoolExecutor(max_workers=len(regions)) as executor:
+        futures = [executor.submit(deploy_region, region, count, key_name, state_dir)
+                   for region, count in regions.items()]
+        results = [future.result() for future in futures]
+
+    print("\nFleet summary:")
+    for region, ok, resources in results:
+        ips = ", ".join(eip["public_ip"] for eip in resources.get("elastic_ips", {}).values()) or "-"
+        print(f"  {region:<16} {'ok' if ok else 'FAILED':<7} instances: {len(resources.get('instance_ids', []))}"
+              f"  elastic IPs: {ips}")
+    print(f"State written to {state_dir}")
+    return all(ok for _, ok, _ in results)
+
+
+def destroy_fleet(state_dir=DEFAULT_STATE_DIR, regions=None):
+    """Tears down every region in the state tree concurrently."""
+    state_dir = os.path.abspath(state_dir)
+    if not os.path.isdir(state_dir):
+        print(f"'{state_dir}' not found. No fleet to clean up.")
+        return True
+    region_dirs = [os.path.join(state_dir, name) for name in sorted(os.listdir(state_dir))
+                   if os.path.isfile(os.path.join(state_dir, name, "resources.json"))
+                   and (not regions or name in regions)]
+    if not region_dirs:
+        print("No region state found. Nothing to clean up.")
+        return True
+
+    with ProcessPoolExecutor(max_workers=len(region_dirs)) as executor:
+        results = list(executor.map(destroy_region, region_dirs))
+
+    print("\nFleet teardown summary:")
+    for region, ok in results:
+        print(f"  {region:<16} {'ok' if ok else 'FAILED (state kept for a retry)'}")
+    return all(ok for _, ok in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deploy or destroy OpenVPN servers in several regions at once.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    deploy_parser = subparsers.add_parser("deploy", help="Provision servers in every listed region concurrently.")
+    deploy_parser.add_argument("--regions", nargs="+", default=[], metavar="REGION[=COUNT]")
+    deploy_parser.add_argument("--key-name", help="Key pair name, created per region if missing.")
+    deploy_parser.add_argument("--spec", help="JSON file with 'regions' and 'key_name'.")
+    deploy_parser.add_argument("--state-dir", default=DEFAULT_STATE_DIR)
+
+    destroy_parser = subparsers.add_parser("destroy", help="Delete everything recorded in the state tree.")
+    destroy_parser.add_argument("--regions", nargs="+", default=[], metavar="REGION")
+    destroy_parser.add_argument("--state-dir", default=DEFAULT_STATE_DIR)
+
+    args = parser.parse_args()
+    if args.command == "deploy":
+        spec = {}
+        if args.spec:
+            with open(args.spec, "r") as file:
+                spec = json.load(file)
+        regions = dict(spec.get("regions", {}))
+        regions.update(parse_region_counts(args.regions))
+        key_name = args.key_name or spec.get("key_name")
+        if not regions or not key_name:
+            parser.error("deploy needs at least one region and a key pair name (--regions/--key-name or --spec).")
+        ok = deploy_fleet(regions, key_name, args.state_dir)
+    else:
+        ok = destroy_fleet(args.state_dir, args.regions)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Per-region AMI and instance type resolution.
+
+Finds the current OpenVPN Access Server AMI in a region, checks that the
+instance type exists there, runs the AMI's architecture and is offered in
+the availability zones the server would launch in. All lookups run
+concurrently and their results go through the discovery cache, so a repeat
+deploy resolves without any API call.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import discovery_cache
+from aws_clients import get_client
+from retries import error_code
+
+DEFAULT_INSTANCE_TYPE = "t2.micro"
+# The AWS Marketplace account, which owns every Marketplace AMI (not OpenVPN Inc.'s own account).
+# It publishes images of many vendors, so the name filter is what selects the Access Server ones.
+IMAGE_OWNER = "679593333241"
+IMAGE_NAME_PATTERN = "OpenVPN Access Server*"
+SSM_PREFIX = "resolve:ssm:"
+
+
+def _describe_image(ec2, image_id):
+    images = ec2.describe_images(ImageIds=[image_id])["Images"]
+    return images[0] if images else None
+
+
+def lookup_image(region, image_id=None):
+    """Returns {"image_id", "name", "architecture"} or None.
+
+    image_id may be an AMI ID, "resolve:ssm:<parameter>" for an AMI published
+    as an SSM public parameter, or None for the newest Access Server AMI.
+    """
+    def fetch():
+        ec2 = get_client("ec2", region)
+        if image_id and image_id.startswith(SSM_PREFIX):
+            parameter = get_client("ssm", region).get_parameter(Name=image_id[len(SSM_PREFIX):])
+            image = _describe_image(ec2, parameter["Parameter"]["Value"])
+        elif image_id:
+            image = _describe_image(ec2, image_id)
+        else:
+            images = ec2.describe_images(Owners=[IMAGE_OWNER], Filters=[
+                {"Name": "name", "Values": [IMAGE_NAME_PATTERN]},
+                {"Name": "state", "Values": ["available"]},
+                {"Name": "image-type", "Values": ["machine"]},
+            ])["Images"]
+            image = max(images, key=lambda item: item["CreationDate"], default=None)
+        if image is None:
+            return None
+        return {"image_id": image["ImageId"], "name": image.get("Name", ""), "architecture": image["Architecture"]}
+
+    try:
+        return discovery_cache.cached("image", region, image_id or IMAGE_NAME_PATTERN, fetch)
+    except Exception as e:
+        if error_code(e) not in ("InvalidAMIID.Malformed", "InvalidAMIID.NotFound", "ParameterNotFound"):
+            raise
+        return None
+
+
+def lookup_instance_type(region, instance_type):
+    """Returns {"architectures", "vcpus"} for an instance type, or None if the region doesn't have it."""
+    def fetch():
+        try:
+            types = get_client("ec2", region).describe_instance_types(InstanceTypes=[instance_type])["InstanceTypes"]
+        except Exception as e:
+            if error_code(e) != "InvalidInstanceType":
+                raise
+            return None
+        if not types:
+            return None
+        return {"architectures": types[0]["ProcessorInfo"]["SupportedArchitectures"],
+                "vcpus": types[0]["VCpuInfo"]["DefaultVCpus"]}
+
+    return discovery_cache.cached("instance_type_info", region, instance_type, fetch)
+
+
+def offered_zones(region, instance_type):
+    """Returns the sorted availability zones offering instance_type, or None if there are none."""
+    def fetch():
+        paginator = get_client("ec2", region).get_paginator("describe_instance_type_offerings")
+        zones = set()
+        for page in paginator.paginate(LocationType="availability-zone",
+                                       Filters=[{"Name": "instance-type", "Values": [instance_type]}]):
+            zones.update(offering["Location"] for offering in page["InstanceTypeOfferings"])
+        return sorted(zones) or None
+
+    return discovery_cache.cached("instance_type_offerings", region, instance_type, fetch)
+
+
+def subnet_zone(region, subnet_id):
+    """Returns the availability zone of a subnet, or None if it doesn't exist."""
+    try:
+        subnets = get_client("ec2", region).describe_subnets(SubnetIds=[subnet_id])["Subnets"]
+    except Exception as e:
+        if error_code(e) != "InvalidSubnetID.NotFound":
+            raise
+        return None
+    return subnets[0]["AvailabilityZone"] if subnets else None
+
+
+def resolve_launch_config(region, instance_type=None, image_id=None, subnet_id=None):
+    """Resolves and checks what the server will be launched with, without creating anything.
+
+    Returns (config, errors). config has image_id, instance_type, its vcpus,
+    the offered_zones and the availability_zones to create subnets in; errors
+    lists every problem found.
+    """
+    instance_type = instance_type or DEFAULT_INSTANCE_TYPE
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        image_future = executor.submit(lookup_image, region, image_id)
+        type_info_future = executor.submit(lookup_instance_type, region, instance_type)
+        zones_future = executor.submit(offered_zones, region, instance_type)
+        subnet_future = executor.submit(subnet_zone, region, subnet_id) if subnet_id else None
+        image = image_future.result()
+        type_info = type_info_future.result()
+        zones = zones_future.result()
+        zone = subnet_future.result() if subnet_future else None
+
+    architectures = type_info["architectures"] if type_info else None
+    errors = []
+    if image is None:
+        errors.append(f"No OpenVPN Access Server image {image_id or IMAGE_NAME_PATTERN!r} was found in {region}.")
+    if architectures is None:
+        errors.append(f"Instance type {instance_type} does not exist in {region}.")
+    elif image and image["architecture"] not in architectures:
+        errors.append(f"Image {image['image_id']} is {image['architecture']}, but {instance_type} only runs "
+                      f"{', '.join(architectures)}.")
+    if architectures is not None and not zones:
+        errors.append(f"Instance type {instance_type} is not offered in any availability zone of {region}.")
+    if subnet_id and zone is None:
+        errors.append(f"Subnet {subnet_id} was not found in {region}.")
+    elif subnet_id and zones and zone not in zones:
+        errors.append(f"Instance type {instance_type} is not offered in {zone}, the zone of subnet {subnet_id}. "
+                      f"It is offered in {', '.join(zones)}.")
+    if errors:
+        return None, errors
+
+    config = {"image_id": image["image_id"], "instance_type": instance_type, "vcpus": type_info["vcpus"],
+              "offered_zones": zones, "availability_zones": zones[:2]}
+    return config, []
@@ -0,0 +1,196 @@
+"""Opt-in per-API-call and per-step instrumentation.
+
+When enabled, every client built by aws_clients gets botocore before-call,
+after-call and needs-retry hooks that record, per service and operation, the
+call count, latency histogram, retries, throttles and errors. Deploy and
+teardown also record their step timings. write_reports saves a JSON report
+and a Prometheus textfile (for node_exporter's textfile collector).
+
+Enable with OPENVPN_AWS_METRICS_DIR or the CLI's --metrics-dir.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+METRICS_DIR = os.environ.get("OPENVPN_AWS_METRICS_DIR")
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+THROTTLE_CODES = ("Throttling", "ThrottlingException", "ThrottledException", "RequestThrottled",
+                  "RequestThrottledException", "RequestLimitExceeded", "TooManyRequestsException",
+                  "SlowDown", "PriorRequestNotComplete", "EC2ThrottledException")
+HANDLER_ID = "openvpn-aws-instrumentation"
+
+enabled = METRICS_DIR is not None
+_calls = {}
+_steps = []
+_lock = threading.Lock()
+
+
+def enable(metrics_dir=None):
+    """Turns instrumentation on for clients built from now on."""
+    global enabled, METRICS_DIR
+    enabled = True
+    if metrics_dir:
+        METRICS_DIR = metrics_dir
+
+
+def attach(client):
+    """Registers the recording hooks on one client."""
+    events = client.meta.events
+    events.register("before-call", _before_call, unique_id=f"{HANDLER_ID}-before")
+    events.register("after-call", _after_call, unique_id=f"{HANDLER_ID}-after")
+    events.register("after-call-error", _after_call_error, unique_id=f"{HANDLER_ID}-error")
+    events.register("needs-retry", _needs_retry, unique_id=f"{HANDLER_ID}-retry")
+
+
+def _operation_stats(service, operation):
+    key = (service, operation)
+    stats = _calls.get(key)
+    if stats is None:
+        stats = _calls[key] = {"count": 0, "errors": 0, "retries": 0, "throttles": 0, "latencies": []}
+    return stats
+
+
+def _before_call(model, context, **kwargs):
+    context["instrumentation"] = (model.service_model.service_name, model.name, time.perf_counter())
+
+
+def _finish_call(context, retries, error_code):
+    service, operation, start = context.pop("instrumentation", (None, None, None))
+    if start is None:
+        return
+    latency = time.perf_counter() - start
+    with _lock:
+        stats = _operation_stats(service, operation)
+        stats["count"] += 1
+        stats["retries"] += retries
+        stats["latencies"].append(latency)
+        if error_code:
+            stats["errors"] += 1
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    _finish_call(context, retries, parsed.get("Error", {}).get("Code"))
+
+
+def _after_call_error(exception, context, **kwargs):
+    # Raised before a response was parsed, e.g. connection failures.
+    _finish_call(context, 0, type(exception).__name__)
+
+
+def _needs_retry(response=None, operation=None, **kwargs):
+    # Fires once per attempt, so throttled attempts that were retried are counted too.
+    if not response or operation is None:
+        return
+    code = (response[1] or {}).get("Error", {}).get("Code")
+    if code in THROTTLE_CODES:
+        with _lock:
+            _operation_stats(operation.service_model.service_name, operation.name)["throttles"] += 1
+
+
+def record_steps(run, timings):
+    """Records the per-step durations of a scheduler run."""
+    if not enabled:
+        return
+    with _lock:
+        for name, timing in timings.items():
+            _steps.append({"run": run, "step": name, "status": timing["status"], "duration": timing["duration"]})
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report():
+    """Returns the recorded calls and steps as a JSON-serialisable dictionary."""
+    with _lock:
+        calls = []
+        for (service, operation), stats in sorted(_calls.items()):
+            latencies = stats["latencies"]
+            calls.append({
+                "service": service,
+                "operation": operation,
+                "count": stats["count"],
+                "errors": stats["errors"],
+                "retries": stats["retries"],
+                "throttles": stats["throttles"],
+                "latency_seconds": {
+                    "total": sum(latencies),
+                    "p50": _percentile(latencies, 0.5) if latencies else 0.0,
+                    "p95": _percentile(latencies, 0.95) if latencies else 0.0,
+                    "max": max(latencies, default=0.0),
+                    "buckets": {str(bound): sum(1 for latency in latencies if latency <= bound)
+                                for bound in LATENCY_BUCKETS},
+                },
+            })
+        return {"generated_at": time.time(), "api_calls": calls, "steps": list(_steps)}
+
+
+def _label_value(value):
+    # The exposition format requires backslash, double quote and line feed to be escaped in label values.
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{_label_value(value)}"' for key, value in labels.items())
+
+
+def prometheus_text(data):
+    """Renders a report in the Prometheus text exposition format."""
+    lines = [
+        "# HELP openvpn_aws_api_call_duration_seconds Latency of AWS API calls.",
+        "# TYPE openvpn_aws_api_call_duration_seconds histogram",
+    ]
+    for call in data["api_calls"]:
+        labels = _labels(service=call["service"], operation=call["operation"])
+        for bound, count in call["latency_seconds"]["buckets"].items():
+            lines.append(f'openvpn_aws_api_call_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'openvpn_aws_api_call_duration_seconds_bucket{{{labels},le="+Inf"}} {call["count"]}')
+        lines.append(f"openvpn_aws_api_call_duration_seconds_sum{{{labels}}} {call['latency_seconds']['total']:.6f}")
+        lines.append(f"openvpn_aws_api_call_duration_seconds_count{{{labels}}} {call['count']}")
+    for metric, key, help_text in (("openvpn_aws_api_errors_total", "errors", "AWS API calls that failed."),
+                                   ("openvpn_aws_api_retries_total", "retries", "Retried AWS API attempts."),
+                                   ("openvpn_aws_api_throttles_total", "throttles", "Throttled AWS API attempts.")):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for call in data["api_calls"]:
+            lines.append(f"{metric}{{{_labels(service=call['service'], operation=call['operation'])}}} {call[key]}")
+    lines.append("# HELP openvpn_aws_step_duration_seconds Duration of deploy and teardown steps.")
+    lines.append("# TYPE openvpn_aws_step_duration_seconds gauge")
+    for step in data["steps"]:
+        labels = _labels(run=step["run"], step=step["step"], status=step["status"])
+        lines.append(f"openvpn_aws_step_duration_seconds{{{labels}}} {step['duration']:.6f}")
+    lines.append("# HELP openvpn_aws_report_timestamp_seconds When the report was written.")
+    lines.append("# TYPE openvpn_aws_report_timestamp_seconds gauge")
+    lines.append(f"openvpn_aws_report_timestamp_seconds {data['generated_at']:.0f}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomically(path, content):
+    """Replaces path in one step so a collector never reads a half-written file."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".metrics-")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+def write_reports(name):
+    """Writes <name>.json and <name>.prom to the metrics directory when enabled."""
+    if not enabled or not METRICS_DIR:
+        return
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        data = report()
+        json_path = os.path.join(METRICS_DIR, f"openvpn_aws_{name}.json")
+        _write_atomically(json_path, json.dumps(data, indent=4))
+        _write_atomically(os.path.join(METRICS_DIR, f"openvpn_aws_{name}.prom"), prometheus_text(data))
+        print(f"API call metrics written to '{json_path}' and its .prom textfile.")
+    except Exception as e:
+        print(f"Error writing API call metrics to '{METRICS_DIR}': {e}")
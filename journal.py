@@ -0,0 +1,51 @@
+"""Write-ahead journal of created resources.
+
+Every create step appends a record as soon as its AWS call succeeds, so a
+deploy that dies halfway still leaves an exact list of what exists. Each
+record sets one top-level key of the resources dictionary.
+"""
+import json
+import os
+import threading
+
+_lock = threading.Lock()
+
+
+def journal_path(resources_file):
+    """Returns the journal file kept next to a resources file."""
+    return f"{resources_file}.journal"
+
+
+def append(path, key, value):
+    """Appends one record and forces it to disk before returning."""
+    line = json.dumps({"key": key, "value": value}) + "\n"
+    with _lock:
+        with open(path, "a") as file:
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def replay(path):
+    """Rebuilds the resources dictionary from a journal. A torn final record is ignored."""
+    resources = {}
+    try:
+        with open(path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f"Ignoring an incomplete record at the end of '{path}'.")
+                    break
+                resources[record["key"]] = record["value"]
+    except FileNotFoundError:
+        pass
+    return resources
+
+
+def remove(path):
+    """Deletes the journal once its contents are safely in the resources file."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
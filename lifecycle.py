@@ -0,0 +1,82 @@
+"""Pause and resume a deployed VPN without tearing it down.
+
+Pausing stops the instances and keeps everything else: the VPC, security
+group, key pair and Elastic IPs, which stay associated while an instance is
+stopped. Resuming starts them again and only waits until the OpenVPN ports
+answer, instead of re-provisioning.
+"""
+import time
+
+import clean_up
+from aws_clients import get_client
+from retries import error_code
+from waiters import describe_instance_states, wait_for_instance_state, wait_for_tcp_ports
+
+# Access Server accepts OpenVPN over TCP 443 once its daemons are up. UDP 1194
+# gives no answer to a bare probe, so readiness is judged on TCP.
+READINESS_PORTS = (443,)
+RESUME_TIMEOUT = 300
+
+
+def recorded_public_ips(resources):
+    """Returns the Elastic IPs of the recorded instances."""
+    public_ips = [eip["public_ip"] for eip in resources.get("elastic_ips", {}).values()]
+    if "elastic_ip" in resources:
+        public_ips.append(resources["elastic_ip"])  # resources.json written by older versions
+    return public_ips
+
+
+def pause(resources, hibernate=False, wait=True):
+    """Stops the recorded instances, hibernating them if asked. Returns True on success."""
+    instance_ids = clean_up.recorded_instance_ids(resources)
+    if not instance_ids:
+        print("No instances are recorded. Nothing to pause.")
+        return False
+    ec2 = get_client("ec2", resources.get("region", "eu-west-2"))
+    print(f"{'Hibernating' if hibernate else 'Stopping'} EC2 instance(s) {', '.join(instance_ids)}...")
+    try:
+        try:
+            ec2.stop_instances(InstanceIds=instance_ids, Hibernate=hibernate)
+        except Exception as e:
+            # Hibernation only works on instances launched with it enabled.
+            if not hibernate or error_code(e) not in ("UnsupportedHibernationConfiguration", "UnsupportedOperation"):
+                raise
+            print(f"Hibernation is not available for these instances ({error_code(e)}). Stopping them instead.")
+            ec2.stop_instances(InstanceIds=instance_ids)
+        if wait:
+            wait_for_instance_state(ec2, instance_ids, "stopped")
+    except Exception as e:
+        print(f"Error pausing EC2 instance(s): {e}")
+        return False
+    print("Paused. The Elastic IP(s), security group and VPC are kept; resume with "
+          "`python3 openvpn_aws.py resume`.")
+    return True
+
+
+def resume(resources, timeout=RESUME_TIMEOUT):
+    """Starts the recorded instances and waits for OpenVPN to answer. Returns True on success."""
+    instance_ids = clean_up.recorded_instance_ids(resources)
+    if not instance_ids:
+        print("No instances are recorded. Nothing to resume.")
+        return False
+    ec2 = get_client("ec2", resources.get("region", "eu-west-2"))
+    start = time.monotonic()
+    print(f"Starting EC2 instance(s) {', '.join(instance_ids)}...")
+    try:
+        states = describe_instance_states(ec2, instance_ids)
+        stopping = [instance_id for instance_id, state in states.items() if state == "stopping"]
+        if stopping:
+            # Instances still stopping cannot be started yet.
+            wait_for_instance_state(ec2, stopping, "stopped", timeout=timeout)
+        to_start = [instance_id for instance_id, state in states.items() if state in ("stopping", "stopped")]
+        if to_start:
+            ec2.start_instances(InstanceIds=to_start)
+        wait_for_instance_state(ec2, instance_ids, "running", timeout=timeout)
+        print(f"Instance(s) running after {time.monotonic() - start:.0f}s. Waiting for OpenVPN to answer...")
+        endpoints = [(public_ip, port) for public_ip in recorded_public_ips(resources) for port in READINESS_PORTS]
+        wait_for_tcp_ports(endpoints, timeout=max(1, timeout - (time.monotonic() - start)))
+    except Exception as e:
+        print(f"Error resuming EC2 instance(s): {e}")
+        return False
+    print(f"Resumed in {time.monotonic() - start:.0f}s.")
+    return True
@@ -0,0 +1,460 @@
+"""Command line entry point for deploying and managing the OpenVPN server.
+
+    python3 openvpn_aws.py create --region eu-west-2 --key-name vpn --no-input
+    python3 openvpn_aws.py create --config deploy.json
+    python3 openvpn_aws.py inventory --region eu-west-2 --format json
+    python3 openvpn_aws.py status --state-dir fleet_state
+    python3 openvpn_aws.py profiles --users-file users.txt
+    python3 openvpn_aws.py probe --state-dir fleet_state --template client.ovpn
+    python3 openvpn_aws.py create --region eu-west-2 --key-name vpn --scale-out --count 2 --max-instances 6
+    python3 openvpn_aws.py scale --watch
+    python3 openvpn_aws.py pause --hibernate
+    python3 openvpn_aws.py resume
+    python3 openvpn_aws.py destroy
+    python3 openvpn_aws.py sweep --all --dry-run
+
+Options can come from a JSON config file; flags given on the command line
+win. boto3 is only imported once a command actually talks to AWS, so --help
+and `validate` return immediately.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+REGION_PATTERN = re.compile(r"^[a-z]{2}(-gov)?-[a-z]+-\d+$")
+VPC_PATTERN = re.compile(r"^vpc-[0-9a-f]+$")
+SUBNET_PATTERN = re.compile(r"^subnet-[0-9a-f]+$")
+KEY_NAME_PATTERN = re.compile(r"^[\w .\-@]{1,255}$")
+INSTANCE_TYPE_PATTERN = re.compile(r"^[a-z][a-z0-9-]*\.[a-z0-9-]+$")
+IMAGE_ID_PATTERN = re.compile(r"^(ami-[0-9a-f]+|resolve:ssm:/\S+)$")
+CONFIG_KEYS = ("region", "vpc_id", "subnet_id", "key_name", "instance_count", "instance_type", "image_id",
+               "vpn_daemons", "socket_buffer", "tun_mtu", "mssfix", "scale_out", "max_instances", "resources_file")
+
+
+def load_config(path):
+    """Loads deploy options from a JSON config file."""
+    if not path:
+        return {}
+    with open(path, "r") as file:
+        config = json.load(file)
+    unknown = sorted(set(config) - set(CONFIG_KEYS))
+    if unknown:
+        raise ValueError(f"Unknown config keys in '{path}': {', '.join(unknown)}")
+    return config
+
+
+def merge_options(args):
+    """Combines the config file with command line flags; flags take precedence."""
+    options = load_config(args.config)
+    for key in CONFIG_KEYS:
+        value = getattr(args, key, None)
+        if value is not None:
+            options[key] = value
+    options.setdefault("resources_file", "resources.json")
+    if not getattr(args, "resume", False):
+        # A resumed deploy takes the count from its journal unless --count is given.
+        options.setdefault("instance_count", 1)
+    return options
+
+
+def validate_options(options, require_all=True):
+    """Returns a list of problems with the deploy options."""
+    errors = []
+    region = options.get("region")
+    if region and not REGION_PATTERN.match(region):
+        errors.append(f"'{region}' is not a valid AWS region name.")
+    if options.get("vpc_id") and not VPC_PATTERN.match(options["vpc_id"]):
+        errors.append(f"'{options['vpc_id']}' is not a valid VPC ID.")
+    if options.get("subnet_id") and not SUBNET_PATTERN.match(options["subnet_id"]):
+        errors.append(f"'{options['subnet_id']}' is not a valid subnet ID.")
+    if options.get("subnet_id") and not options.get("vpc_id"):
+        errors.append("subnet_id is only used together with vpc_id.")
+    if options.get("key_name") and not KEY_NAME_PATTERN.match(options["key_name"]):
+        errors.append(f"'{options['key_name']}' is not a valid key pair name.")
+    if options.get("instance_type") and not INSTANCE_TYPE_PATTERN.match(options["instance_type"]):
+        errors.append(f"'{options['instance_type']}' is not a valid instance type.")
+    if options.get("image_id") and not IMAGE_ID_PATTERN.match(options["image_id"]):
+        errors.append(f"'{options['image_id']}' is not an AMI ID or resolve:ssm:<parameter>.")
+    count = options.get("instance_count", 1)
+    if not isinstance(count, int) or count < 1:
+        errors.append("instance_count must be a positive integer.")
+    for key in ("vpn_daemons", "socket_buffer", "tun_mtu", "mssfix", "max_instances"):
+        if options.get(key) is not None and (not isinstance(options[key], int) or options[key] < 1):
+            errors.append(f"{key} must be a positive integer.")
+    if options.get("max_instances") and not options.get("scale_out"):
+        errors.append("max_instances is only used together with scale_out.")
+    elif isinstance(options.get("max_instances"), int) and isinstance(count, int) \
+            and options["max_instances"] < count:
+        errors.append("max_instances must be at least instance_count.")
+
+    if require_all:
+        for key in ("region", "key_name"):
+            if not options.get(key):
+                errors.append(f"{key} is required.")
+        if options.get("vpc_id") and not options.get("subnet_id"):
+            errors.append("subnet_id is required when vpc_id is given.")
+    return errors
+
+
+def is_interactive(args):
+    """True when prompting for missing options is allowed."""
+    return not args.no_input and sys.stdin.isatty()
+
+
+def cmd_validate(args):
+    options = merge_options(args)
+    errors = validate_options(options)
+    for error in errors:
+        print(f"error: {error}")
+    if not errors:
+        print("Configuration is valid.")
+    return not errors
+
+
+def cmd_bootstrap(args):
+    import bootstrap
+    tuning = {key: getattr(args, key) for key in bootstrap.TUNING_KEYS if getattr(args, key) is not None}
+    if args.check:
+        results = bootstrap.check(tuning=tuning)
+        for instance_type, errors in results.items():
+            print(f"{instance_type:<14} {'ok' if not errors else 'FAILED: ' + ' '.join(errors)}")
+        return not any(results.values())
+    vcpus = args.vcpus or bootstrap.SAMPLE_INSTANCE_TYPES.get(args.instance_type)
+    if not vcpus:
+        print(f"error: the vCPU count of {args.instance_type} is not known here; pass --vcpus.")
+        return False
+    script = bootstrap.render(args.instance_type, vcpus, tuning)
+    errors = bootstrap.validate(script)
+    for error in errors:
+        print(f"error: {error}", file=sys.stderr)
+    print(script, end="")
+    return not errors
+
+
+def cmd_create(args):
+    options = merge_options(args)
+    interactive = is_interactive(args) and not args.resume
+    # A resumed deploy takes the region and key pair from the journal.
+    errors = validate_options(options, require_all=not interactive and not args.resume)
+    if errors:
+        for error in errors:
+            print(f"error: {error}")
+        return False
+
+    import vpn_create
+    if args.resume:
+        return vpn_create.create(options, options["resources_file"], resume=True)
+    if interactive:
+        return vpn_create.main(options)
+    return vpn_create.create(options, options["resources_file"])
+
+
+def cmd_inventory(args):
+    if not REGION_PATTERN.match(args.region):
+        print(f"error: '{args.region}' is not a valid AWS region name.")
+        return False
+    import vpn_create
+    vpn_create.init_clients(args.region)
+    vpn_create.list_vpcs(args.format)
+    return True
+
+
+def cmd_clear_cache(args):
+    import discovery_cache
+    discovery_cache.clear()
+    print(f"Discovery cache '{discovery_cache.CACHE_FILE}' cleared.")
+    return True
+
+
+def cmd_destroy(args):
+    import clean_up
+    return clean_up.main(args.resources_file)
+
+
+def cmd_profiles(args):
+    import profiles
+    users = profiles.read_users(args.users, args.users_file)
+    if not users:
+        print("error: no users given; pass --users or --users-file.")
+        return False
+    try:
+        targets = profiles.load_targets(args.resources_file, args.state_dir)
+    except FileNotFoundError as e:
+        print(f"'{e.filename}' not found. Nothing has been deployed from this directory.")
+        return False
+    return profiles.generate(targets, users, args.output_dir, autologin=args.autologin)
+
+
+def cmd_probe(args):
+    import probe
+    if args.hosts:
+        endpoints = [probe.Endpoint(host) for host in args.hosts]
+    else:
+        try:
+            endpoints = probe.load_endpoints(args.resources_file, args.state_dir)
+        except FileNotFoundError as e:
+            print(f"'{e.filename}' not found. Nothing has been deployed from this directory.")
+            return False
+    if not endpoints:
+        print("No servers are recorded. Nothing to probe.")
+        return False
+    for endpoint in endpoints:
+        endpoint.tcp_port, endpoint.udp_port = args.tcp_port, args.udp_port
+    print(f"Probing {len(endpoints)} endpoint(s), {args.samples} sample(s) each...")
+    ranked = probe.probe(endpoints, samples=args.samples, timeout=args.timeout)
+    probe.print_ranking(ranked)
+    if args.template:
+        with open(args.template, "r") as file:
+            profile = probe.profile_with_remotes(file.read(), ranked)
+        with open(args.output, "w") as file:
+            file.write(profile)
+        print(f"Profile with {len(probe.remote_lines(ranked))} remote line(s) written to '{args.output}'.")
+    return any(probe.latency(result) is not None for _, result in ranked)
+
+
+def cmd_sweep(args):
+    import sweeper
+    return sweeper.sweep(args.deployment_ids, args.regions, dry_run=args.dry_run)
+
+
+def load_resources(resources_file):
+    """Loads a resources file, or returns None after saying it is missing."""
+    try:
+        with open(resources_file, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        print(f"'{resources_file}' not found. Nothing has been deployed from this directory.")
+        return None
+
+
+def save_resources(resources_file, resources):
+    """Writes a resources file atomically."""
+    temp_file = f"{resources_file}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump(resources, file, indent=4)
+    os.replace(temp_file, resources_file)
+
+
+def cmd_scale(args):
+    resources = load_resources(args.resources_file)
+    if resources is None:
+        return False
+    import journal
+    import scaling
+    # Servers launched by a scale run that died before saving are in its journal.
+    journal_file = journal.journal_path(args.resources_file)
+    resources.update(journal.replay(journal_file))
+    policy = {key: getattr(args, key) for key in ("min_instances", "max_instances", "cpu_high", "cpu_low")
+              if getattr(args, key) is not None}
+    for key in ("network_out_high", "network_out_low"):
+        if getattr(args, key) is not None:
+            policy[key] = getattr(args, key) * 1024 ** 2
+    while True:
+        ok = scaling.scale(resources, policy, dry_run=args.dry_run, resources_file=args.resources_file)
+        if not args.dry_run:
+            save_resources(args.resources_file, resources)
+            journal.remove(journal_file)
+        if not args.watch:
+            return ok
+        time.sleep(args.interval)
+
+
+def cmd_pause(args):
+    resources = load_resources(args.resources_file)
+    if resources is None:
+        return False
+    import lifecycle
+    return lifecycle.pause(resources, hibernate=args.hibernate, wait=not args.no_wait)
+
+
+def cmd_resume(args):
+    resources = load_resources(args.resources_file)
+    if resources is None:
+        return False
+    import lifecycle
+    return lifecycle.resume(resources, timeout=args.timeout)
+
+
+def cmd_status(args):
+    import dashboard
+    try:
+        deployments = dashboard.load_deployments(args.resources_file, args.state_dir)
+    except FileNotFoundError as e:
+        print(f"'{e.filename}' not found. Nothing has been deployed from this directory.")
+        return False
+    dashboard.render(dashboard.collect(deployments), args.format)
+    return True
+
+
+def add_deploy_options(parser):
+    parser.add_argument("--config", help="JSON file with deploy options.")
+    parser.add_argument("--region", help="AWS region, e.g. eu-west-2.")
+    parser.add_argument("--vpc-id", dest="vpc_id", help="Existing VPC to use; a new VPC is created if omitted.")
+    parser.add_argument("--subnet-id", dest="subnet_id", help="Subnet of --vpc-id to launch into.")
+    parser.add_argument("--key-name", dest="key_name", help="Key pair name, created if it doesn't exist.")
+    parser.add_argument("--count", dest="instance_count", type=int, help="Number of servers to launch.")
+    parser.add_argument("--instance-type", dest="instance_type", help="EC2 instance type (default t2.micro).")
+    parser.add_argument("--image-id", dest="image_id",
+                        help="AMI ID or resolve:ssm:<parameter>; the newest OpenVPN Access Server AMI by default.")
+    parser.add_argument("--resources-file", dest="resources_file", help="Where to record created resources.")
+    parser.add_argument("--scale-out", dest="scale_out", action="store_true", default=None,
+                        help="Put the servers behind a network load balancer, so `scale` can add and drain them. "
+                             "--count becomes the minimum.")
+    parser.add_argument("--max-instances", dest="max_instances", type=int,
+                        help="Most servers `scale` may run (default 10).")
+    add_tuning_options(parser)
+
+
+def add_tuning_options(parser):
+    parser.add_argument("--vpn-daemons", dest="vpn_daemons", type=int,
+                        help="OpenVPN daemons per server (default one per vCPU, a quarter of them TCP).")
+    parser.add_argument("--socket-buffer", dest="socket_buffer", type=int,
+                        help="OpenVPN send/receive socket buffer in bytes (default 524288).")
+    parser.add_argument("--tun-mtu", dest="tun_mtu", type=int, help="Tunnel MTU (default 1500).")
+    parser.add_argument("--mssfix", dest="mssfix", type=int, help="TCP MSS clamp inside the tunnel (default 1400).")
+
+
+def add_metrics_option(parser):
+    parser.add_argument("--metrics-dir", dest="metrics_dir",
+                        help="Write per-API-call and per-step metrics (JSON and Prometheus textfile) here.")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Deploy and manage a free OpenVPN server on AWS.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create", help="Provision the VPN server.")
+    add_deploy_options(create_parser)
+    create_parser.add_argument("--no-input", action="store_true", help="Never prompt; fail if an option is missing.")
+    create_parser.add_argument("--no-cache", action="store_true", help="Ignore the local discovery cache.")
+    create_parser.add_argument("--resume", action="store_true",
+                               help="Continue an interrupted deploy, redoing only the missing steps.")
+    add_metrics_option(create_parser)
+    create_parser.set_defaults(handler=cmd_create)
+
+    validate_parser = subparsers.add_parser("validate", help="Check deploy options without calling AWS.")
+    add_deploy_options(validate_parser)
+    validate_parser.set_defaults(handler=cmd_validate)
+
+    inventory_parser = subparsers.add_parser("inventory", help="List the VPCs and subnets in a region.")
+    inventory_parser.add_argument("--region", required=True, help="AWS region, e.g. eu-west-2.")
+    inventory_parser.add_argument("--format", choices=("table", "json"), default="table")
+    inventory_parser.add_argument("--no-cache", action="store_true", help="Ignore the local discovery cache.")
+    inventory_parser.set_defaults(handler=cmd_inventory)
+
+    bootstrap_parser = subparsers.add_parser("bootstrap", help="Print or check the tuning script servers boot with.")
+    bootstrap_parser.add_argument("--instance-type", dest="instance_type", default="t2.micro")
+    bootstrap_parser.add_argument("--vcpus", type=int, help="vCPUs of --instance-type, if it isn't a known one.")
+    bootstrap_parser.add_argument("--check", action="store_true",
+                                  help="Render and validate the script for a range of instance types.")
+    add_tuning_options(bootstrap_parser)
+    bootstrap_parser.set_defaults(handler=cmd_bootstrap)
+
+    clear_cache_parser = subparsers.add_parser("clear-cache", help="Forget all cached AWS discovery lookups.")
+    clear_cache_parser.set_defaults(handler=cmd_clear_cache)
+
+    destroy_parser = subparsers.add_parser("destroy", help="Delete everything recorded in the resources file.")
+    destroy_parser.add_argument("--resources-file", dest="resources_file", default="resources.json")
+    add_metrics_option(destroy_parser)
+    destroy_parser.set_defaults(handler=cmd_destroy)
+
+    profiles_parser = subparsers.add_parser("profiles", help="Create users and fetch their .ovpn profiles in bulk.")
+    profiles_parser.add_argument("--users", nargs="+", help="Usernames to issue profiles for.")
+    profiles_parser.add_argument("--users-file", dest="users_file", help="File with one username per line.")
+    profiles_parser.add_argument("--resources-file", dest="resources_file", default="resources.json")
+    profiles_parser.add_argument("--state-dir", dest="state_dir", help="Issue on every server of a fleet.py state tree.")
+    profiles_parser.add_argument("--output-dir", dest="output_dir", default="profiles",
+                                 help="Where to write profiles-<ip>.tar.gz (default ./profiles).")
+    profiles_parser.add_argument("--autologin", action="store_true",
+                                 help="Issue auto-login profiles that need no password to connect.")
+    profiles_parser.set_defaults(handler=cmd_profiles)
+
+    probe_parser = subparsers.add_parser("probe", help="Rank servers by TCP 443 / UDP 1194 handshake latency.")
+    probe_parser.add_argument("--resources-file", dest="resources_file", default="resources.json")
+    probe_parser.add_argument("--state-dir", dest="state_dir", help="Probe every server of a fleet.py state tree.")
+    probe_parser.add_argument("--hosts", nargs="+", help="Probe these hosts instead of the recorded servers.")
+    probe_parser.add_argument("--samples", type=int, default=5, help="Handshakes per endpoint and protocol.")
+    probe_parser.add_argument("--timeout", type=float, default=2, help="Seconds to wait for each handshake.")
+    probe_parser.add_argument("--tcp-port", dest="tcp_port", type=int, default=443)
+    probe_parser.add_argument("--udp-port", dest="udp_port", type=int, default=1194)
+    probe_parser.add_argument("--template", help="Client profile to copy, with its remote lines replaced "
+                                                 "by the ranked endpoints. The servers must share a CA.")
+    probe_parser.add_argument("--output", default="nearest.ovpn", help="Where to write the profile.")
+    probe_parser.set_defaults(handler=cmd_probe)
+
+    sweep_parser = subparsers.add_parser("sweep", help="Find and delete deployments by their tags, "
+                                                       "without a resources file.")
+    sweep_target = sweep_parser.add_mutually_exclusive_group(required=True)
+    sweep_target.add_argument("--deployment-id", dest="deployment_ids", nargs="+", metavar="ID",
+                              help="Deployment IDs to delete, as recorded in resources.json.")
+    sweep_target.add_argument("--all", dest="deployment_ids", action="store_const", const=None,
+                              help="Delete every deployment made by this tool.")
+    sweep_parser.add_argument("--regions", nargs="+", help="Only sweep these regions (default: all enabled). "
+                                                           "The IAM role is only deleted when all are swept.")
+    sweep_parser.add_argument("--dry-run", action="store_true", help="List what would be deleted.")
+    sweep_parser.set_defaults(handler=cmd_sweep)
+
+    pause_parser = subparsers.add_parser("pause", help="Stop the servers but keep their addresses and network.")
+    pause_parser.add_argument("--resources-file", dest="resources_file", default="resources.json")
+    pause_parser.add_argument("--hibernate", action="store_true",
+                              help="Hibernate instead of stopping, where the instance supports it.")
+    pause_parser.add_argument("--no-wait", action="store_true", help="Return without waiting for the stop.")
+    pause_parser.set_defaults(handler=cmd_pause)
+
+    resume_parser = subparsers.add_parser("resume", help="Start paused servers and wait for OpenVPN to answer.")
+    resume_parser.add_argument("--resources-file", dest="resources_file", default="resources.json")
+    resume_parser.add_argument("--timeout", type=int, default=300, help="Seconds to wait (default 300).")
+    resume_parser.set_defaults(handler=cmd_resume)
+
+    scale_parser = subparsers.add_parser("scale", help="Add or drain load-balanced servers by their "
+                                                       "bandwidth and CPU.")
+    scale_parser.add_argument("--resources-file", dest="resources_file", default="resources.json")
+    scale_parser.add_argument("--dry-run", action="store_true", help="Only show what would be done.")
+    scale_parser.add_argument("--watch", action="store_true", help="Keep evaluating every --interval seconds.")
+    scale_parser.add_argument("--interval", type=int, default=300, help="Seconds between evaluations (default 300).")
+    scale_parser.add_argument("--min", dest="min_instances", type=int,
+                              help="Fewest servers (default: the deploy's --count).")
+    scale_parser.add_argument("--max", dest="max_instances", type=int,
+                              help="Most servers (default: the deploy's --max-instances, or 10).")
+    scale_parser.add_argument("--network-high", dest="network_out_high", type=float,
+                              help="Per-server NetworkOut in MiB/s above which servers are added (default 8).")
+    scale_parser.add_argument("--network-low", dest="network_out_low", type=float,
+                              help="Per-server NetworkOut in MiB/s below which one is drained (default 2).")
+    scale_parser.add_argument("--cpu-high", dest="cpu_high", type=float,
+                              help="CPU percent above which servers are added (default 70).")
+    scale_parser.add_argument("--cpu-low", dest="cpu_low", type=float,
+                              help="CPU percent below which one is drained (default 20).")
+    scale_parser.set_defaults(handler=cmd_scale)
+
+    status_parser = subparsers.add_parser("status", help="Show server state and month-to-date data usage.")
+    status_parser.add_argument("--resources-file", dest="resources_file", default="resources.json")
+    status_parser.add_argument("--state-dir", help="Report on every region of a fleet.py state tree instead.")
+    status_parser.add_argument("--format", choices=("table", "json"), default="table")
+    status_parser.set_defaults(handler=cmd_status)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if getattr(args, "no_cache", False):
+        import discovery_cache
+        discovery_cache.enabled = False
+    if getattr(args, "metrics_dir", None):
+        import instrumentation
+        instrumentation.enable(args.metrics_dir)
+    try:
+        ok = args.handler(args)
+    except (OSError, ValueError) as e:
+        print(f"error: {e}")
+        ok = False
+    if args.command in ("create", "destroy"):
+        import instrumentation
+        instrumentation.write_reports(args.command)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""One-pass checks that run before a deploy creates anything.
+
+Everything a deploy could fail on part-way is looked up in one concurrent
+batch:
+- the image and instance type, and the availability zones that offer it
+  and are currently available;
+- the Elastic IP and VPC quotas against what the region already uses;
+- resources with the names the deploy would use (security group, key pair,
+  data cap Lambda and its schedule).
+
+It also picks the zones and a VPC CIDR that doesn't overlap the region's
+existing VPCs. A deploy that can't succeed therefore fails after about one
+round of API calls, with nothing to clean up.
+"""
+import ipaddress
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import discovery_cache
+import images
+from aws_clients import get_client
+from retries import error_code
+
+# Service Quotas codes and the AWS defaults used when the quota can't be read.
+QUOTAS = {
+    "elastic_ips": ("ec2", "L-0263D0A3", 5),  # EC2-VPC Elastic IPs
+    "vpcs": ("vpc", "L-F678F1CE", 5),  # VPCs per Region
+}
+VPC_CIDR_POOL = ipaddress.ip_network("10.0.0.0/8")
+VPC_PREFIX = 16
+SUBNET_PREFIX = 24
+SUBNET_COUNT = 2  # Subnets in a new VPC; the zones are spread across them in turn
+SECURITY_GROUP_NAME = "OpenVPN-Security-Group"
+LAMBDA_FUNCTION_NAME = "StopEC2Instance"
+USAGE_CHECK_RULE_NAME = "MonthlyDataUsageCheck"
+
+
+def available_zones(region):
+    """Returns the availability zones of the region that are opted in and available."""
+    response = get_client("ec2", region).describe_availability_zones(Filters=[
+        {"Name": "zone-type", "Values": ["availability-zone"]},
+        {"Name": "state", "Values": ["available"]},
+    ])
+    return {zone["ZoneName"] for zone in response["AvailabilityZones"]}
+
+
+def quota(region, name):
+    """Returns the account's quota, or the AWS default if Service Quotas can't be read."""
+    service_code, quota_code, default = QUOTAS[name]
+
+    def fetch():
+        try:
+            response = get_client("service-quotas", region).get_service_quota(
+                ServiceCode=service_code, QuotaCode=quota_code)
+        except Exception as e:
+            if error_code(e) not in ("AccessDeniedException", "NoSuchResourceException"):
+                raise
+            return None
+        return int(response["Quota"]["Value"])
+
+    return discovery_cache.cached("service_quota", region, quota_code, fetch) or default
+
+
+def vpcs(region):
+    """Returns (number of VPCs, their associated IPv4 CIDR blocks) in the region.
+
+    A VPC can have secondary blocks, so there can be more blocks than VPCs.
+    Blocks that are being or have been disassociated are left out.
+    """
+    count, cidrs = 0, []
+    for page in get_client("ec2", region).get_paginator("describe_vpcs").paginate():
+        for vpc in page["Vpcs"]:
+            count += 1
+            if "CidrBlockAssociationSet" not in vpc:
+                cidrs.append(vpc["CidrBlock"])
+                continue
+            cidrs.extend(association["CidrBlock"] for association in vpc["CidrBlockAssociationSet"]
+                         if association.get("CidrBlockState", {}).get("State") == "associated")
+    return count, cidrs
+
+
+def elastic_ip_count(region):
+    return len(get_client("ec2", region).describe_addresses()["Addresses"])
+
+
+def key_pair_exists(region, key_name):
+    try:
+        get_client("ec2", region).describe_key_pairs(KeyNames=[key_name])
+    except Exception as e:
+        if error_code(e) != "InvalidKeyPair.NotFound":
+            raise
+        return False
+    return True
+
+
+def security_group_id(region, vpc_id):
+    groups = get_client("ec2", region).describe_security_groups(Filters=[
+        {"Name": "group-name", "Values": [SECURITY_GROUP_NAME]},
+        {"Name": "vpc-id", "Values": [vpc_id]},
+    ])["SecurityGroups"]
+    return groups[0]["GroupId"] if groups else None
+
+
+def function_exists(region):
+    try:
+        get_client("lambda", region).get_function(FunctionName=LAMBDA_FUNCTION_NAME)
+    except Exception as e:
+        if error_code(e) != "ResourceNotFoundException":
+            raise
+        return False
+    return True
+
+
+def rule_exists(region):
+    try:
+        get_client("events", region).describe_rule(Name=USAGE_CHECK_RULE_NAME)
+    except Exception as e:
+        if error_code(e) != "ResourceNotFoundException":
+            raise
+        return False
+    return True
+
+
+def pick_vpc_cidr(existing_cidrs):
+    """Returns the first /16 of 10.0.0.0/8 that overlaps none of existing_cidrs, or None."""
+    existing = [ipaddress.ip_network(cidr) for cidr in existing_cidrs]
+    for candidate in VPC_CIDR_POOL.subnets(new_prefix=VPC_PREFIX):
+        if not any(candidate.overlaps(network) for network in existing):
+            return str(candidate)
+    return None
+
+
+def subnet_cidrs(vpc_cidr, count=None):
+    """Returns the CIDRs of the first count (SUBNET_COUNT by default) subnets of vpc_cidr, skipping the .0 block."""
+    count = SUBNET_COUNT if count is None else count
+    subnets = ipaddress.ip_network(vpc_cidr).subnets(new_prefix=SUBNET_PREFIX)
+    next(subnets)
+    return [str(next(subnets)) for _ in range(count)]
+
+
+def check(region, context, resources=None):
+    """Runs every preflight lookup concurrently.
+
+    context holds the deploy options; resources holds what an interrupted
+    run already created. Returns (config, errors, notes): config has the
+    launch settings plus the availability_zones and vpc_cidr to build with,
+    errors lists everything that would make the deploy fail, and notes lists
+    existing resources it will reuse.
+    """
+    resources = resources or {}
+    vpc_id = context.get("vpc_id")
+    create_new_vpc = not vpc_id and "vpc_id" not in resources
+    key_name = context.get("key_name")
+    lookups = {
+        "launch_config": lambda: images.resolve_launch_config(
+            region, context.get("instance_type"), context.get("image_id"), context.get("subnet_id")),
+        "available_zones": lambda: available_zones(region),
+        "elastic_ip_quota": lambda: quota(region, "elastic_ips"),
+        "elastic_ip_count": lambda: elastic_ip_count(region),
+        "function_exists": lambda: function_exists(region),
+        "rule_exists": lambda: rule_exists(region),
+    }
+    if create_new_vpc:
+        lookups["vpc_quota"] = lambda: quota(region, "vpcs")
+        lookups["vpcs"] = lambda: vpcs(region)
+    if key_name and "key_pair_name" not in resources:
+        lookups["key_pair_exists"] = lambda: key_pair_exists(region, key_name)
+    # A resumed deploy whose recorded group is gone looks in its recorded VPC.
+    group_vpc_id = vpc_id or resources.get("vpc_id")
+    if group_vpc_id and "security_group_id" not in resources:
+        lookups["security_group_id"] = lambda: security_group_id(region, group_vpc_id)
+
+    errors = []
+    found = {}
+    with ThreadPoolExecutor(max_workers=len(lookups)) as executor:
+        futures = {name: executor.submit(lookup) for name, lookup in lookups.items()}
+        for name, future in futures.items():
+            try:
+                found[name] = future.result()
+            except Exception as e:
+                errors.append(f"Preflight lookup '{name}' failed in {region}: {e}")
+    if errors:
+        return None, errors, []
+
+    config, launch_errors = found["launch_config"]
+    errors.extend(launch_errors)
+    notes = []
+    if config:
+        zones = [zone for zone in config["offered_zones"] if zone in found["available_zones"]]
+        if not zones:
+            errors.append(f"None of the zones offering {config['instance_type']} in {region} "
+                          f"({', '.join(config['offered_zones'])}) is available.")
+        config["availability_zones"] = zones[:2]
+
+    # Scale-out servers are reached through the load balancer and get no Elastic IPs.
+    needed_ips = 0 if context.get("scale_out") else \
+        context.get("instance_count", 1) - len(resources.get("elastic_ips", {}))
+    if needed_ips > 0 and found["elastic_ip_count"] + needed_ips > found["elastic_ip_quota"]:
+        errors.append(f"{needed_ips} more Elastic IP(s) are needed, but {region} already uses "
+                      f"{found['elastic_ip_count']} of its quota of {found['elastic_ip_quota']}.")
+
+    vpc_cidr = resources.get("vpc_cidr")
+    if create_new_vpc:
+        vpc_count, existing_cidrs = found["vpcs"]
+        if vpc_count >= found["vpc_quota"]:
+            errors.append(f"{region} already has {vpc_count} VPC(s), its quota is "
+                          f"{found['vpc_quota']}. Use --vpc-id to deploy into an existing one.")
+        vpc_cidr = vpc_cidr or pick_vpc_cidr(existing_cidrs)
+        if vpc_cidr is None:
+            errors.append(f"Every /{VPC_PREFIX} of {VPC_CIDR_POOL} overlaps an existing VPC in {region}.")
+    elif "vpc_id" in resources:
+        vpc_cidr = vpc_cidr or "10.0.0.0/16"  # What deploys before the CIDR was picked always used
+
+    # These lookups are live, so they also refresh the cache entries the create steps read.
+    if found.get("key_pair_exists") is False:
+        discovery_cache.invalidate("key_pair", region, key_name)
+    if "security_group_id" in found and not found["security_group_id"]:
+        discovery_cache.invalidate("security_group", region, f"{group_vpc_id}:{SECURITY_GROUP_NAME}")
+    if found.get("key_pair_exists"):
+        discovery_cache.put("key_pair", region, key_name, True)
+        if not os.path.exists(f"{key_name}.pem"):
+            notes.append(f"Key pair '{key_name}' already exists, but '{key_name}.pem' is not in this directory. "
+                         f"The servers will only accept the existing key.")
+        else:
+            notes.append(f"Key pair '{key_name}' already exists and will be reused.")
+    if found.get("security_group_id"):
+        discovery_cache.put("security_group", region, f"{group_vpc_id}:{SECURITY_GROUP_NAME}",
+                            found["security_group_id"])
+        notes.append(f"Security group '{SECURITY_GROUP_NAME}' ({found['security_group_id']}) in {group_vpc_id} "
+                     f"will be reused.")
+    if found["function_exists"]:
+        notes.append(f"Lambda function {LAMBDA_FUNCTION_NAME} already exists and will be updated in place.")
+    if found["rule_exists"]:
+        notes.append(f"EventBridge rule {USAGE_CHECK_RULE_NAME} already exists and will be reused.")
+
+    if errors:
+        return None, errors, notes
+    config["vpc_cidr"] = vpc_cidr
+    return config, [], notes
@@ -0,0 +1,194 @@
+"""Endpoint latency probe and nearest-server ordering.
+
+Measures the handshake latency of every recorded server from where it runs:
+- TCP 443: the time a connect() takes, i.e. one SYN/SYN-ACK round trip.
+- UDP 1194: the time until the server answers an OpenVPN hard reset.
+  Servers that require tls-auth or tls-crypt stay silent on this probe, so
+  no UDP answer is reported as unknown, not as down.
+
+Every endpoint and protocol is probed concurrently. Each probe takes a few
+samples and reports their median, jitter (mean difference between
+consecutive samples) and loss. Endpoints are ranked by UDP latency, which
+is what clients connect over first, or by TCP latency where UDP got no
+answer. The ranking can be written into a client profile as `remote` lines,
+fastest first.
+
+    python3 openvpn_aws.py probe --state-dir fleet_state
+    python3 openvpn_aws.py probe --template client.ovpn --output nearest.ovpn
+"""
+import os
+import socket
+import statistics
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dashboard
+from lifecycle import recorded_public_ips
+
+TCP_PORT = 443
+UDP_PORT = 1194
+SAMPLES = 5
+SAMPLE_INTERVAL = 0.2
+PROBE_TIMEOUT = 2
+MAX_PARALLEL_PROBES = 64
+# OpenVPN control packets: the opcode in the top five bits, key ID 0 in the low three.
+P_CONTROL_HARD_RESET_CLIENT_V2 = 7
+P_CONTROL_HARD_RESET_SERVER_V2 = 8
+SERVER_POLL_TIMEOUT = 4  # Seconds a client gives each remote before trying the next
+
+
+class Endpoint:
+    """A server to probe. Ports can differ per endpoint, e.g. for local stand-ins."""
+
+    def __init__(self, host, region=None, tcp_port=TCP_PORT, udp_port=UDP_PORT):
+        self.host = host
+        self.region = region
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+
+
+def load_endpoints(resources_file="resources.json", state_dir=None):
+    """Returns an Endpoint for every server in a resources file or a fleet state tree."""
+    return [Endpoint(public_ip, region)
+            for region, deployments in dashboard.load_deployments(resources_file, state_dir).items()
+            for resources in deployments
+            for public_ip in recorded_public_ips(resources)]
+
+
+def hard_reset_packet():
+    """Returns a P_CONTROL_HARD_RESET_CLIENT_V2 packet with a random session ID."""
+    return struct.pack("!B8sBI", P_CONTROL_HARD_RESET_CLIENT_V2 << 3, os.urandom(8), 0, 0)
+
+
+def tcp_handshake(host, port, timeout=PROBE_TIMEOUT):
+    """Returns the seconds a TCP connect takes, or None if it fails."""
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return time.perf_counter() - start
+    except OSError:
+        return None
+
+
+def udp_handshake(host, port, timeout=PROBE_TIMEOUT):
+    """Returns the seconds until the server answers an OpenVPN hard reset, or None without an answer."""
+    family = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0][0]
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        start = time.perf_counter()
+        try:
+            sock.sendto(hard_reset_packet(), (host, port))
+            data, _ = sock.recvfrom(2048)
+        except OSError:
+            return None
+    if not data or data[0] >> 3 != P_CONTROL_HARD_RESET_SERVER_V2:
+        return None
+    return time.perf_counter() - start
+
+
+def measure(handshake, host, port, samples=SAMPLES, interval=SAMPLE_INTERVAL, timeout=PROBE_TIMEOUT):
+    """Takes samples of one handshake. Returns {"median", "jitter", "loss"}; median is None if none answered."""
+    times = []
+    for index in range(samples):
+        if index:
+            time.sleep(interval)
+        seconds = handshake(host, port, timeout)
+        if seconds is not None:
+            times.append(seconds)
+    return {
+        "median": statistics.median(times) if times else None,
+        "jitter": statistics.mean(abs(a - b) for a, b in zip(times, times[1:])) if len(times) > 1 else 0.0,
+        "loss": 1 - len(times) / samples,
+    }
+
+
+def latency(result):
+    """Returns the UDP median of a probe result, the TCP one if UDP got no answer, or None."""
+    if result["udp"]["median"] is not None:
+        return result["udp"]["median"]
+    return result["tcp"]["median"]
+
+
+def probe(endpoints, samples=SAMPLES, interval=SAMPLE_INTERVAL, timeout=PROBE_TIMEOUT):
+    """Probes TCP and UDP on every endpoint concurrently.
+
+    Returns [(endpoint, {"tcp": stats, "udp": stats})], fastest first and
+    unreachable endpoints last.
+    """
+    endpoints = list(endpoints)
+    if not endpoints:
+        return []
+    with ThreadPoolExecutor(max_workers=min(2 * len(endpoints), MAX_PARALLEL_PROBES)) as executor:
+        futures = [(endpoint, {
+            "tcp": executor.submit(measure, tcp_handshake, endpoint.host, endpoint.tcp_port, samples, interval,
+                                   timeout),
+            "udp": executor.submit(measure, udp_handshake, endpoint.host, endpoint.udp_port, samples, interval,
+                                   timeout),
+        }) for endpoint in endpoints]
+        results = [(endpoint, {protocol: future.result() for protocol, future in probes.items()})
+                   for endpoint, probes in futures]
+
+    def rank(item):
+        seconds = latency(item[1])
+        protocol = "udp" if item[1]["udp"]["median"] is not None else "tcp"
+        return seconds is None, seconds or 0.0, item[1][protocol]["jitter"]
+
+    return sorted(results, key=rank)
+
+
+def remote_lines(ranked):
+    """Returns `remote` lines for the reachable endpoints, fastest first.
+
+    Each endpoint gets its UDP remote first, unless only TCP answered, so a
+    client falls back to TCP 443 on the same server before trying the next.
+    """
+    lines = []
+    for endpoint, result in ranked:
+        if latency(result) is None:
+            continue
+        udp = f"remote {endpoint.host} {endpoint.udp_port} udp"
+        tcp = f"remote {endpoint.host} {endpoint.tcp_port} tcp"
+        tcp_only = result["udp"]["median"] is None and result["tcp"]["median"] is not None
+        lines.extend([tcp, udp] if tcp_only else [udp, tcp])
+    return lines
+
+
+def profile_with_remotes(template, ranked):
+    """Returns the template profile with its remote lines replaced by the ranked ones.
+
+    Servers only accept a profile signed by their own CA, so the endpoints
+    must share one, e.g. an Access Server cluster.
+    """
+    remotes = remote_lines(ranked)
+    if not remotes:
+        raise ValueError("No endpoint answered, so there are no remote lines to write.")
+    lines = template.splitlines()
+    kept, insert_at = [], None
+    for line in lines:
+        directive = line.strip().split(" ", 1)[0]
+        if directive in ("remote", "remote-random", "proto"):
+            if directive == "remote" and insert_at is None:
+                insert_at = len(kept)
+            continue
+        kept.append(line)
+    if insert_at is None:
+        insert_at = next((index + 1 for index, line in enumerate(kept) if line.strip() == "client"), 0)
+    block = remotes if any(line.startswith("server-poll-timeout") for line in kept) \
+        else remotes + [f"server-poll-timeout {SERVER_POLL_TIMEOUT}"]
+    return "\n".join(kept[:insert_at] + block + kept[insert_at:]) + "\n"
+
+
+def format_stats(stats):
+    if stats["median"] is None:
+        return f"{'-':>8} {'-':>7} {stats['loss']:>5.0%}"
+    return f"{stats['median'] * 1000:>6.1f}ms {stats['jitter'] * 1000:>5.1f}ms {stats['loss']:>5.0%}"
+
+
+def print_ranking(ranked):
+    print(f"{'#':>2}  {'endpoint':<16} {'region':<15} {'tcp':>8} {'jitter':>7} {'loss':>5}  "
+          f"{'udp':>8} {'jitter':>7} {'loss':>5}")
+    for index, (endpoint, result) in enumerate(ranked, 1):
+        rank = index if latency(result) is not None else "-"
+        print(f"{rank:>2}  {endpoint.host:<16} {endpoint.region or '-':<15} {format_stats(result['tcp'])}  "
+              f"{format_stats(result['udp'])}")
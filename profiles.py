@@ -0,0 +1,160 @@
+"""Bulk client profile generation.
+
+Every server gets one SSH session. The session runs a script that creates
+any missing Access Server users and writes one .ovpn profile per user, then
+streams them back as a tar.gz on stdout. Issuing 500 profiles therefore
+costs one round trip per server, and servers in a fleet are handled
+concurrently. Each server has its own CA, so every server gets its own
+archive, written to <output-dir>/profiles-<ip>.tar.gz.
+
+    python3 openvpn_aws.py profiles --users alice bob
+    python3 openvpn_aws.py profiles --users-file users.txt --state-dir fleet_state
+"""
+import base64
+import json
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SSH_USER = "openvpnas"
+MAX_PARALLEL_SERVERS = 16
+CHUNK_SIZE = 65536
+# Names end up in a remote shell script, so only allow what Access Server usernames commonly use.
+USERNAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._@+-]{0,63}$")
+
+REMOTE_SCRIPT = """set -euo pipefail
+SACLI="${SACLI:-/usr/local/openvpn_as/scripts/sacli}"
+OUT="$(mktemp -d)"
+trap 'rm -rf "$OUT"' EXIT
+echo '%(users)s' | base64 -d > "$OUT/.users"
+while read -r user; do
+    "$SACLI" --user "$user" --key type --value user_connect UserPropPut > /dev/null
+    %(autologin)s
+done < "$OUT/.users"
+# Profiles are read-only lookups, so fetch them in parallel.
+export SACLI OUT
+# A user whose profile fails is reported missing instead of failing the whole batch.
+xargs -P "$(nproc)" -I{} sh -c '"$SACLI" --user "$1" %(profile_call)s > "$OUT/$1.ovpn"' _ {} < "$OUT/.users" || true
+find "$OUT" -name '*.ovpn' -empty -delete
+rm "$OUT/.users"
+tar -czf - -C "$OUT" .
+"""
+
+
+def read_users(users=None, users_file=None):
+    """Returns the unique usernames from a list and/or a file with one per line ("#" starts a comment)."""
+    names = list(users or [])
+    if users_file:
+        with open(users_file, "r") as file:
+            names.extend(line.split("#", 1)[0].strip() for line in file)
+    unique = list(dict.fromkeys(name for name in names if name))
+    invalid = [name for name in unique if not USERNAME_PATTERN.match(name)]
+    if invalid:
+        raise ValueError(f"Invalid username(s): {', '.join(invalid[:5])}")
+    return unique
+
+
+def remote_script(users, autologin=False):
+    """Returns the script one server runs to create the users and archive their profiles.
+
+    The usernames travel base64-encoded, so no name can end a quoted block
+    and run as a command.
+    """
+    return REMOTE_SCRIPT % {
+        "users": base64.b64encode(("\n".join(users) + "\n").encode()).decode(),
+        "autologin": ('"$SACLI" --user "$user" --key prop_autologin --value true UserPropPut > /dev/null'
+                      if autologin else ":"),
+        "profile_call": "GetAutologin" if autologin else "GetUserlogin",
+    }
+
+
+def ssh_command(host, pem_file):
+    """Returns the command that runs a script from stdin as root on host."""
+    return ["ssh", "-i", pem_file, "-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=accept-new",
+            "-o", "ConnectTimeout=15", "-o", "ServerAliveInterval=15", f"{SSH_USER}@{host}", "sudo bash -s"]
+
+
+def load_targets(resources_file="resources.json", state_dir=None):
+    """Returns (public_ip, pem_file) for every server in a resources file or a fleet state tree."""
+    if state_dir:
+        files = [os.path.join(state_dir, name, "resources.json") for name in sorted(os.listdir(state_dir))
+                 if os.path.isfile(os.path.join(state_dir, name, "resources.json"))]
+    else:
+        files = [resources_file]
+    targets = []
+    for path in files:
+        with open(path, "r") as file:
+            resources = json.load(file)
+        # Deploys write the key pair next to their resources file.
+        pem_file = os.path.join(os.path.dirname(os.path.abspath(path)), f"{resources.get('key_pair_name')}.pem")
+        public_ips = [eip["public_ip"] for eip in resources.get("elastic_ips", {}).values()]
+        if "elastic_ip" in resources:
+            public_ips.append(resources["elastic_ip"])  # resources.json written by older versions
+        targets.extend((public_ip, pem_file) for public_ip in public_ips)
+    return targets
+
+
+def fetch_profiles(host, pem_file, users, output_dir, autologin=False):
+    """Runs the batch on one server and streams its archive to disk.
+
+    Returns (host, archive path or None, missing usernames, seconds, error).
+    """
+    start = time.monotonic()
+    archive = os.path.join(output_dir, f"profiles-{host}.tar.gz")
+    partial = archive + ".partial"
+    try:
+        with open(partial, "wb") as output, tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(ssh_command(host, pem_file), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=stderr_file)
+            process.stdin.write(remote_script(users, autologin).encode())
+            process.stdin.close()
+            # Copy as it arrives so hundreds of profiles never sit in memory at once.
+            for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b""):
+                output.write(chunk)
+            process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode(errors="replace").strip()
+        if process.returncode:
+            raise RuntimeError(stderr.splitlines()[-1] if stderr else f"ssh exited with {process.returncode}")
+        with tarfile.open(partial, "r:gz") as tar:
+            received = {os.path.basename(name)[:-len(".ovpn")] for name in tar.getnames() if name.endswith(".ovpn")}
+        os.replace(partial, archive)
+    except Exception as e:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return host, None, users, time.monotonic() - start, str(e)
+    missing = [user for user in users if user not in received]
+    return host, archive, missing, time.monotonic() - start, None
+
+
+def generate(targets, users, output_dir="profiles", autologin=False):
+    """Fetches every user's profile from every server concurrently. Returns True if none are missing."""
+    if not targets:
+        print("No servers are recorded. Nothing to generate profiles on.")
+        return False
+    if not shutil.which("ssh"):
+        print("An ssh client is required to generate profiles.")
+        return False
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"Generating {len(users)} profile(s) on {len(targets)} server(s)...")
+    with ThreadPoolExecutor(max_workers=min(len(targets), MAX_PARALLEL_SERVERS)) as executor:
+        futures = [executor.submit(fetch_profiles, host, pem_file, users, output_dir, autologin)
+                   for host, pem_file in targets]
+        results = [future.result() for future in futures]
+
+    ok = True
+    for host, archive, missing, seconds, error in results:
+        if error:
+            print(f"  {host:<16} FAILED after {seconds:.0f}s: {error}")
+        elif missing:
+            print(f"  {host:<16} {len(users) - len(missing)}/{len(users)} profile(s) in '{archive}'; "
+                  f"missing: {', '.join(missing[:5])}")
+        else:
+            print(f"  {host:<16} {len(users)} profile(s) in '{archive}' ({seconds:.0f}s)")
+        ok = ok and not error and not missing
+    return ok
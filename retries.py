@@ -0,0 +1,51 @@
+import random
+import time
+
+RETRY_ATTEMPTS = 8
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 30
+
+
+def error_code(error):
+    """Returns the AWS error code carried by a botocore ClientError, or None."""
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code")
+
+
+def backoff_delay(attempt, base_delay=None, max_delay=None):
+    """Exponential backoff with jitter for the given 1-based attempt number."""
+    base_delay = RETRY_BASE_DELAY if base_delay is None else base_delay
+    max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+    ceiling = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def call_with_retries(action, retry_codes, description, attempts=None,
+                      base_delay=None, max_delay=None, should_retry=None):
+    """Calls action(), retrying with jittered backoff while it fails with one of retry_codes.
+
+    should_retry can further narrow retries, e.g. to errors with a specific message.
+    Any other error, or the last failed attempt, is raised to the caller.
+    """
+    attempts = RETRY_ATTEMPTS if attempts is None else attempts
+    for attempt in range(1, attempts + 1):
+        try:
+            return action()
+        except Exception as e:
+            code = error_code(e)
+            retryable = code in retry_codes and (should_retry is None or should_retry(e))
+            if not retryable or attempt == attempts:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"{description}: {code}, retrying in {delay:.1f}s (attempt {attempt}/{attempts})...")
+            time.sleep(delay)
+
+
+def call_ignoring(action, ignored_codes):
+    """Calls action(), treating failures with one of ignored_codes as already done."""
+    try:
+        return action()
+    except Exception as e:
+        if error_code(e) not in ignored_codes:
+            raise
+        return None
@@ -0,0 +1,248 @@
+"""Bandwidth-driven horizontal scaling behind a network load balancer.
+
+A deploy created with --scale-out puts its servers behind a network load
+balancer that forwards UDP 1194 and TCP 443, instead of giving each server
+an Elastic IP. `scale` then compares the servers' NetworkOut and CPU with
+the policy thresholds:
+- When the fleet average stays above a high threshold for every evaluation
+  period, it launches enough servers to bring the average back to the
+  middle of the band.
+- When both metrics stay below their low thresholds, it drains the least
+  busy server. The server is deregistered so its connections can finish,
+  then terminated.
+
+decide() holds the whole policy and only takes metric series, so it can be
+checked offline (benchmarks/bench_scaling.py). For clients to connect
+through the load balancer to any server, the servers must share their
+Access Server configuration, e.g. as a cluster.
+
+    python3 openvpn_aws.py scale --dry-run
+    python3 openvpn_aws.py scale --watch
+"""
+import math
+import time
+from datetime import datetime, timezone
+
+import bootstrap
+import clean_up
+import images
+import journal
+import usage
+import vpn_create
+from aws_clients import get_client
+from waiters import wait_for_targets_drained
+
+DEFAULT_POLICY = {
+    "min_instances": 1,
+    "max_instances": 10,
+    "network_out_high": 8 * 1024 ** 2,  # Bytes per second per server
+    "network_out_low": 2 * 1024 ** 2,
+    "cpu_high": 70.0,  # Percent
+    "cpu_low": 20.0,
+    "evaluation_periods": 2,  # Consecutive periods a threshold must be crossed for
+    "period": usage.PERIOD,  # Basic monitoring publishes one datapoint per 5 minutes
+    "cooldown": 900,  # Seconds after a scaling action before the next one
+    "max_step": 4,  # Most servers added at once
+}
+QUERIES_PER_INSTANCE = 2
+DRAIN_TIMEOUT = vpn_create.DEREGISTRATION_DELAY + 180
+
+
+def fleet_averages(series):
+    """Averages the per-server metrics of each period.
+
+    series maps instance IDs to {"network_out": {period_start: bytes per
+    second}, "cpu": {period_start: percent}}. Returns [(period_start,
+    network_out, cpu)], oldest first, for the periods that have both.
+    """
+    sums = {}
+    for metrics in series.values():
+        for index, key in enumerate(("network_out", "cpu")):
+            for timestamp, value in metrics.get(key, {}).items():
+                totals = sums.setdefault(timestamp, [0.0, 0, 0.0, 0])
+                totals[2 * index] += value
+                totals[2 * index + 1] += 1
+    return [(timestamp, network / network_count, cpu / cpu_count)
+            for timestamp, (network, network_count, cpu, cpu_count) in sorted(sums.items())
+            if network_count and cpu_count]
+
+
+def decide(series, current, policy=None, now=None, last_scaled=None):
+    """Returns (desired server count, reason) for the fleet's recent metrics.
+
+    A threshold only counts when it is crossed in every one of the last
+    evaluation_periods periods, so a single spike or dip changes nothing.
+    Scaling out jumps straight to the count that brings the busiest metric
+    back to the middle of its band. Scaling in removes one server at a time,
+    and only when the others would stay below the high thresholds.
+    """
+    policy = dict(DEFAULT_POLICY, **(policy or {}))
+    minimum = policy["min_instances"]
+    maximum = max(policy["max_instances"], minimum)
+    if current < minimum:
+        return minimum, f"below the minimum of {minimum}"
+    if current > maximum:
+        return maximum, f"above the maximum of {maximum}"
+    now = time.time() if now is None else now
+    if last_scaled is not None and now - last_scaled < policy["cooldown"]:
+        return current, f"cooling down for another {policy['cooldown'] - (now - last_scaled):.0f}s"
+    periods = fleet_averages(series)[-policy["evaluation_periods"]:]
+    if len(periods) < policy["evaluation_periods"]:
+        return current, "not enough datapoints yet"
+    network = [network_out for _, network_out, _ in periods]
+    cpu = [cpu for _, _, cpu in periods]
+
+    if min(network) > policy["network_out_high"] or min(cpu) > policy["cpu_high"]:
+        load = max(min(network) / ((policy["network_out_high"] + policy["network_out_low"]) / 2),
+                   min(cpu) / ((policy["cpu_high"] + policy["cpu_low"]) / 2))
+        desired = min(max(current + 1, math.ceil(current * load)), current + policy["max_step"], maximum)
+        if desired == current:
+            return current, f"over the high thresholds, but already at the maximum of {maximum}"
+        return desired, (f"over the high thresholds for {len(periods)} periods "
+                         f"({min(network) / 1024 ** 2:.1f} MiB/s out, {min(cpu):.0f}% CPU per server)")
+
+    if max(network) < policy["network_out_low"] and max(cpu) < policy["cpu_low"] and current > minimum:
+        remaining = current - 1
+        if max(network) * current / remaining < policy["network_out_high"] \
+                and max(cpu) * current / remaining < policy["cpu_high"]:
+            return remaining, (f"under the low thresholds for {len(periods)} periods "
+                               f"({max(network) / 1024 ** 2:.1f} MiB/s out, {max(cpu):.0f}% CPU per server)")
+    return current, "within the thresholds"
+
+
+def metric_queries(instance_ids, period):
+    """Builds the NetworkOut (Sum) and CPUUtilization (Average) queries of every instance."""
+    queries = []
+    for index, instance_id in enumerate(instance_ids):
+        for query_id, metric, stat in (("networkout", "NetworkOut", "Sum"), ("cpu", "CPUUtilization", "Average")):
+            queries.append({
+                "Id": f"{query_id}{index}",
+                "MetricStat": {
+                    "Metric": {"Namespace": "AWS/EC2", "MetricName": metric,
+                               "Dimensions": [{"Name": "InstanceId", "Value": instance_id}]},
+                    "Period": period,
+                    "Stat": stat,
+                },
+            })
+    return queries
+
+
+def fetch_metrics(cloudwatch, instance_ids, start, end, period=usage.PERIOD):
+    """Returns the series decide() takes for instance_ids between start and end.
+
+    Uses as few get_metric_data calls as the per-call query limit allows.
+    """
+    series = {instance_id: {"network_out": {}, "cpu": {}} for instance_id in instance_ids}
+    chunk = usage.MAX_QUERIES_PER_CALL // QUERIES_PER_INSTANCE
+    for offset in range(0, len(instance_ids), chunk):
+        batch = instance_ids[offset:offset + chunk]
+        kwargs = {
+            "MetricDataQueries": metric_queries(batch, period),
+            "StartTime": datetime.fromtimestamp(start, timezone.utc),
+            "EndTime": datetime.fromtimestamp(end, timezone.utc),
+            "ScanBy": "TimestampAscending",
+        }
+        while True:
+            response = cloudwatch.get_metric_data(**kwargs)
+            for result in response["MetricDataResults"]:
+                prefix, key = ("networkout", "network_out") if result["Id"].startswith("networkout") \
+                    else ("cpu", "cpu")
+                instance_id = batch[int(result["Id"][len(prefix):])]
+                for timestamp, value in zip(result["Timestamps"], result["Values"]):
+                    # NetworkOut sums bytes over the period; the policy works in bytes per second.
+                    series[instance_id][key][int(timestamp.timestamp())] = \
+                        value / period if key == "network_out" else value
+            if not response.get("NextToken"):
+                break
+            kwargs["NextToken"] = response["NextToken"]
+    return series
+
+
+def least_busy(series, instance_ids, count):
+    """Returns the count servers with the lowest latest NetworkOut, whose draining disrupts the fewest clients."""
+    def latest(instance_id):
+        values = series.get(instance_id, {}).get("network_out", {})
+        return values[max(values)] if values else 0.0
+    return sorted(instance_ids, key=latest)[:count]
+
+
+def add_servers(resources, count, resources_file=None):
+    """Launches count more servers like the deployment's others and puts them behind the load balancer.
+
+    Returns True on success. With resources_file, new instance IDs are
+    journaled next to it as soon as they exist, so a crash while they are
+    registered never loses track of them.
+    """
+    region = resources["region"]
+    settings = resources["scale_out"]
+    type_info = images.lookup_instance_type(region, resources["instance_type"])
+    user_data = bootstrap.render(resources["instance_type"], type_info["vcpus"], resources.get("tuning"))
+    # vpn_create tags and records through its module state, so point it at this deployment.
+    vpn_create.journal_file = journal.journal_path(resources_file) if resources_file else None
+    vpn_create.resources.clear()
+    vpn_create.resources.update(resources)
+    vpn_create.init_clients(region)
+    instance_ids = vpn_create.launch_ec2_instance(resources["key_pair_name"], settings["security_group_id"],
+                                                  settings["subnet_id"], resources["image_id"],
+                                                  resources["instance_type"], count, user_data)
+    if not instance_ids:
+        return False
+    resources["instance_ids"] = clean_up.recorded_instance_ids(resources) + instance_ids
+    return vpn_create.register_targets(instance_ids, resources["target_group_arns"],
+                                       settings["security_group_id"], settings["subnet_id"])
+
+
+def drain_servers(resources, instance_ids):
+    """Takes servers out of the load balancer, lets their connections drain and terminates them.
+
+    Returns True on success.
+    """
+    region = resources["region"]
+    elbv2 = get_client("elbv2", region)
+    target_group_arns = list(resources["target_group_arns"].values())
+    print(f"Draining instance(s) {', '.join(instance_ids)} from the load balancer...")
+    try:
+        for target_group_arn in target_group_arns:
+            elbv2.deregister_targets(TargetGroupArn=target_group_arn,
+                                     Targets=[{"Id": instance_id} for instance_id in instance_ids])
+        wait_for_targets_drained(elbv2, target_group_arns, instance_ids, timeout=DRAIN_TIMEOUT)
+    except Exception as e:
+        print(f"Error draining instance(s) {', '.join(instance_ids)}: {e}")
+        return False
+    clean_up.init_clients(region)
+    if not clean_up.terminate_ec2_instances(instance_ids):
+        return False
+    resources["instance_ids"] = [instance_id for instance_id in clean_up.recorded_instance_ids(resources)
+                                 if instance_id not in instance_ids]
+    return True
+
+
+def scale(resources, policy=None, dry_run=False, now=None, resources_file=None):
+    """Runs one scaling evaluation for a scale-out deployment and acts on it.
+
+    Updates resources in place, and journals launches next to resources_file
+    if given. Returns True unless a scaling action failed.
+    """
+    if "scale_out" not in resources or "target_group_arns" not in resources:
+        print("This deployment was not created with --scale-out. Nothing to scale.")
+        return False
+    recorded = {key: value for key, value in resources["scale_out"].items() if key in DEFAULT_POLICY}
+    policy = {**DEFAULT_POLICY, **recorded, **(policy or {})}
+    now = time.time() if now is None else now
+    instance_ids = clean_up.recorded_instance_ids(resources)
+    # Only whole periods; the current one is still being collected.
+    end = int(now) // policy["period"] * policy["period"]
+    start = end - (policy["evaluation_periods"] + 1) * policy["period"]
+    series = fetch_metrics(get_client("cloudwatch", resources["region"]), instance_ids, start, end,
+                           policy["period"])
+    desired, reason = decide(series, len(instance_ids), policy, now, resources.get("last_scaled"))
+    print(f"{len(instance_ids)} server(s), {desired} wanted: {reason}.")
+    if dry_run or desired == len(instance_ids):
+        return True
+
+    if desired > len(instance_ids):
+        ok = add_servers(resources, desired - len(instance_ids), resources_file)
+    else:
+        ok = drain_servers(resources, least_busy(series, instance_ids, len(instance_ids) - desired))
+    resources["last_scaled"] = now
+    return ok
@@ -0,0 +1,164 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_MAX_WORKERS = 8
+SUCCESS_STATES = ("ok", "reused")
+
+
+class Step:
+    """A unit of work in a provisioning graph.
+
+    `requires` names values the action takes as positional arguments, `provides`
+    names the values it returns, and `after` lists steps that must finish first
+    without passing any value along.
+    """
+
+    def __init__(self, name, action, requires=(), provides=(), after=()):
+        self.name = name
+        self.action = action
+        self.requires = tuple(requires)
+        self.provides = tuple(provides)
+        self.after = tuple(after)
+
+
+def _step_dependencies(steps, context):
+    """Maps every step name to the names of the steps it depends on."""
+    producers = {}
+    for step in steps:
+        for key in step.provides:
+            producers[key] = step.name
+
+    names = {step.name for step in steps}
+    dependencies = {}
+    for step in steps:
+        unknown = set(step.after) - names
+        if unknown:
+            raise ValueError(f"Step '{step.name}' runs after unknown steps: {', '.join(sorted(unknown))}.")
+        deps = set(step.after)
+        for key in step.requires:
+            if key in producers:
+                deps.add(producers[key])
+            elif key not in context:
+                raise ValueError(f"Step '{step.name}' requires '{key}', which no step provides.")
+        dependencies[step.name] = deps
+    return dependencies
+
+
+def _store_result(step, result, context):
+    """Stores a step's return value in the context. Returns False if the step failed."""
+    if not step.provides:
+        return result is not False
+    values = (result,) if len(step.provides) == 1 else tuple(result or (None,) * len(step.provides))
+    if any(value is None for value in values):
+        return False
+    context.update(zip(step.provides, values))
+    return True
+
+
+def run_steps(steps, context=None, max_workers=DEFAULT_MAX_WORKERS, skip_dependents_on_failure=True):
+    """Runs steps concurrently as soon as their dependencies are done.
+
+    Returns the final context and a {step_name: timing} dictionary. Steps whose
+    outputs are already in the context (e.g. from a resumed deploy) are marked
+    "reused" and not run. When skip_dependents_on_failure is False every step
+    still runs after its dependencies finish, which is what a best-effort
+    teardown wants.
+    """
+    context = dict(context or {})
+    dependencies = _step_dependencies(steps, context)
+    by_name = {step.name: step for step in steps}
+    timings = {}
+    pending = dict(by_name)
+    for step in steps:
+        if step.provides and all(key in context for key in step.provides):
+            timings[step.name] = {"start": None, "end": None, "duration": 0.0, "status": "reused"}
+            del pending[step.name]
+    running = {}
+    running_names = set()
+    origin = time.monotonic()
+
+    def run(step):
+        timings[step.name] = {"start": time.monotonic() - origin}
+        try:
+            return step.action(*[context[key] for key in step.requires])
+        except Exception as e:
+            print(f"Error in step '{step.name}': {e}")
+            return False if not step.provides else None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, step in list(pending.items()):
+                deps = dependencies[name]
+                if any(dep in pending or dep in running_names for dep in deps):
+                    continue
+                del pending[name]
+                failed_deps = [dep for dep in deps if timings[dep]["status"] not in SUCCESS_STATES]
+                if failed_deps and skip_dependents_on_failure:
+                    print(f"Skipping step '{name}' because {', '.join(sorted(failed_deps))} did not complete.")
+                    timings[name] = {"start": None, "end": None, "duration": 0.0, "status": "skipped"}
+                    continue
+                running[executor.submit(run, step)] = step
+                running_names.add(name)
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                running_names.discard(step.name)
+                ok = _store_result(step, future.result(), context)
+                timing = timings[step.name]
+                timing["end"] = time.monotonic() - origin
+                timing["duration"] = timing["end"] - timing["start"]
+                timing["status"] = "ok" if ok else "failed"
+
+    for name, timing in timings.items():
+        timing["depends_on"] = sorted(dependencies[name])
+    return context, timings
+
+
+def prefixed_steps(steps, prefix):
+    """Renames steps and their `after` references so several graphs can run as one."""
+    return [Step(prefix + step.name, step.action, step.requires, step.provides,
+                 [prefix + name for name in step.after]) for step in steps]
+
+
+def all_succeeded(timings):
+    """True if every step ran successfully or was reused."""
+    return all(timing["status"] in SUCCESS_STATES for timing in timings.values())
+
+
+def critical_path(timings):
+    """Returns the chain of steps that determined the total run time."""
+    finished = {name: t for name, t in timings.items() if t.get("end") is not None}
+    if not finished:
+        return []
+    name = max(finished, key=lambda n: finished[n]["end"])
+    path = [name]
+    while True:
+        deps = [dep for dep in finished[name]["depends_on"] if dep in finished]
+        if not deps:
+            break
+        name = max(deps, key=lambda n: finished[n]["end"])
+        path.append(name)
+    return list(reversed(path))
+
+
+def print_timing_report(timings, title="Timing report"):
+    """Prints per-step timings and marks the critical path."""
+    path = critical_path(timings)
+    ran = [(name, t) for name, t in timings.items() if t.get("start") is not None]
+    ran.sort(key=lambda item: item[1]["start"])
+    wall_clock = max((t["end"] for _, t in ran), default=0.0)
+    serial = sum(t["duration"] for _, t in ran)
+
+    print(f"\n{title}:")
+    print(f"  {'step':<28} {'start':>8} {'duration':>9}  status")
+    for name, t in ran:
+        marker = "*" if name in path else " "
+        print(f"{marker} {name:<28} {t['start']:>7.1f}s {t['duration']:>8.1f}s  {t['status']}")
+    for name, t in timings.items():
+        if t.get("start") is None:
+            print(f"  {name:<28} {'-':>8} {'-':>9}  {t['status']}")
+    print(f"\nCritical path (*): {' -> '.join(path)}")
+    print(f"Wall-clock: {wall_clock:.1f}s, serial equivalent: {serial:.1f}s")
@@ -0,0 +1,221 @@
+"""Finds and deletes deployments by their tags, without a resources.json.
+
+Every resource a deploy creates carries the OpenVPN:DeploymentId tag. The
+sweeper finds them with one paginated Resource Groups Tagging API query per
+region, plus one IAM role listing for the Lambda role, groups them by
+deployment and deletes them with clean_up's teardown steps: all deployments
+of a region run as one concurrent, dependency-ordered graph, and regions are
+swept in parallel processes.
+
+    python3 openvpn_aws.py sweep --deployment-id 3f9c2a7b1e04
+    python3 openvpn_aws.py sweep --all --dry-run
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import clean_up
+import instrumentation
+import preflight
+from aws_clients import get_client
+from scheduler import all_succeeded, prefixed_steps, print_timing_report, run_steps
+from vpn_create import DEPLOYMENT_TAG, ROLE_PATH
+
+HOME_REGION = "eu-west-2"  # Where regions are listed and IAM is called from
+SWEEP_MAX_WORKERS = 32  # Deletions mostly wait on AWS, so many can run at once
+# EC2 resource types from the ARN and the resources key that clean_up expects them under.
+SINGLE_KEYS = {"vpc": "vpc_id", "internet-gateway": "internet_gateway_id", "route-table": "route_table_id",
+               "security-group": "security_group_id", "key-pair": "key_pair_id"}
+LIST_KEYS = {"subnet": "subnets", "instance": "instance_ids"}
+
+
+def parse_arn(arn):
+    """Splits an ARN into (service, resource type, resource ID)."""
+    _, _, service, _, _, resource = arn.split(":", 5)
+    separator = "/" if "/" in resource else ":"
+    resource_type, _, resource_id = resource.partition(separator)
+    return service, resource_type, resource_id
+
+
+def add_resource(resources, arn):
+    """Records one tagged resource under the key clean_up's teardown uses for it."""
+    service, resource_type, resource_id = parse_arn(arn)
+    if service == "ec2" and resource_type in SINGLE_KEYS:
+        resources[SINGLE_KEYS[resource_type]] = resource_id
+    elif service == "ec2" and resource_type in LIST_KEYS:
+        resources.setdefault(LIST_KEYS[resource_type], []).append(resource_id)
+    elif service == "ec2" and resource_type == "elastic-ip":
+        resources.setdefault("elastic_ips", {})[resource_id] = {"allocation_id": resource_id}
+    elif service == "lambda" and resource_type == "function":
+        resources["lambda_function_name"] = resource_id
+        resources["lambda_function_arn"] = arn
+    elif service == "events" and resource_type == "rule":
+        resources["usage_check_rule_name"] = resource_id
+    elif service == "elasticloadbalancing" and resource_type == "loadbalancer":
+        resources["load_balancer_arn"] = arn
+    elif service == "elasticloadbalancing" and resource_type == "targetgroup":
+        # Named openvpn-<deployment ID>-<udp|tcp>
+        resources.setdefault("target_group_arns", {})[resource_id.split("/")[0].rsplit("-", 1)[-1]] = arn
+
+
+def tag_filters(deployment_ids=None):
+    """Matches the given deployments, or every deployment when deployment_ids is empty."""
+    if deployment_ids:
+        return [{"Key": DEPLOYMENT_TAG, "Values": list(deployment_ids)}]
+    return [{"Key": DEPLOYMENT_TAG}]
+
+
+def discover_region(region, deployment_ids=None):
+    """Returns {deployment_id: resources} for the tagged resources in one region."""
+    deployments = {}
+    paginator = get_client("resourcegroupstaggingapi", region).get_paginator("get_resources")
+    for page in paginator.paginate(TagFilters=tag_filters(deployment_ids), ResourcesPerPage=100):
+        for mapping in page["ResourceTagMappingList"]:
+            tags = {tag["Key"]: tag["Value"] for tag in mapping["Tags"]}
+            resources = deployments.setdefault(tags[DEPLOYMENT_TAG], {"region": region})
+            add_resource(resources, mapping["ResourceARN"])
+
+    # The tags don't carry the public IPs, which release_elastic_ip reports by.
+    allocation_ids = [allocation_id for resources in deployments.values()
+                      for allocation_id in resources.get("elastic_ips", {})]
+    if allocation_ids:
+        addresses = get_client("ec2", region).describe_addresses(
+            Filters=[{"Name": "allocation-id", "Values": allocation_ids}])["Addresses"]
+        public_ips = {address["AllocationId"]: address["PublicIp"] for address in addresses}
+        for resources in deployments.values():
+            for allocation_id, eip in resources.get("elastic_ips", {}).items():
+                eip["public_ip"] = public_ips.get(allocation_id, allocation_id)
+    return deployments
+
+
+def discover_roles(deployment_ids=None):
+    """Returns {deployment_id: [role name]} for the Lambda roles deploys created."""
+    iam = get_client("iam")
+    roles = {}
+    for page in iam.get_paginator("list_roles").paginate(PathPrefix=ROLE_PATH):
+        for role in page["Roles"]:
+            tags = {tag["Key"]: tag["Value"] for tag in iam.list_role_tags(RoleName=role["RoleName"])["Tags"]}
+            deployment_id = tags.get(DEPLOYMENT_TAG)
+            if deployment_id and (not deployment_ids or deployment_id in deployment_ids):
+                roles.setdefault(deployment_id, []).append(role["RoleName"])
+    return roles
+
+
+def list_regions():
+    """Returns the regions enabled for the account."""
+    return sorted(region["RegionName"] for region in get_client("ec2", HOME_REGION).describe_regions()["Regions"])
+
+
+def summarize(resources):
+    """Describes what a discovered deployment consists of, e.g. "vpc_id, 2 instance_ids"."""
+    parts = []
+    for key, value in resources.items():
+        if key == "region" or key == "lambda_function_arn":
+            continue
+        parts.append(f"{len(value)} {key}" if isinstance(value, (list, dict)) else key)
+    return ", ".join(parts)
+
+
+def shared_resources(region):
+    """Returns the region's data cap Lambda and schedule under their teardown keys, if they exist.
+
+    They carry the tag of whichever deployment created them, so a sweep of
+    later deployment IDs finds them by name instead.
+    """
+    shared = {}
+    if preflight.function_exists(region):
+        shared["lambda_function_name"] = preflight.LAMBDA_FUNCTION_NAME
+    if preflight.rule_exists(region):
+        shared["usage_check_rule_name"] = preflight.USAGE_CHECK_RULE_NAME
+    return shared
+
+
+def sweep_region(region, deployment_ids=None, dry_run=False):
+    """Discovers and deletes the tagged deployments of one region.
+
+    The region's data cap Lambda and schedule go with the last servers that
+    use them. Returns (region, succeeded, deployment IDs found).
+    """
+    try:
+        deployments = discover_region(region, deployment_ids)
+    except Exception as e:
+        print(f"Error discovering tagged resources in {region}: {e}")
+        return region, False, []
+    for deployment_id, resources in sorted(deployments.items()):
+        print(f"{region}: deployment {deployment_id}: {summarize(resources)}")
+    if dry_run or not deployments:
+        return region, True, sorted(deployments)
+
+    clean_up.init_clients(region)
+    instance_ids = [instance_id for resources in deployments.values()
+                    for instance_id in clean_up.recorded_instance_ids(resources)]
+    # One check for the whole region: servers outside the sweep keep the shared Lambda alive.
+    others = clean_up.other_capped_instances(instance_ids)
+    if others != []:
+        if others:
+            print(f"{region}: keeping the data cap Lambda and its schedule for {len(others)} other server(s).")
+        deployments = {deployment_id: {key: value for key, value in resources.items()
+                                       if key not in clean_up.SHARED_KEYS}
+                       for deployment_id, resources in deployments.items()}
+    elif deployment_ids and not any(key in resources for resources in deployments.values()
+                                    for key in ("lambda_function_name", "usage_check_rule_name")):
+        try:
+            shared = shared_resources(region)
+        except Exception as e:
+            print(f"Error looking up the data cap Lambda in {region}: {e}")
+            shared = {}
+        if shared:
+            print(f"{region}: no other servers are left, so the data cap Lambda and its schedule go too.")
+            deployments[min(deployments)].update(shared)
+
+    steps = [step for deployment_id, resources in sorted(deployments.items())
+             for step in prefixed_steps(clean_up.build_teardown_steps(resources), f"{deployment_id}:")]
+    _, timings = run_steps(steps, max_workers=SWEEP_MAX_WORKERS, skip_dependents_on_failure=False)
+    instrumentation.record_steps("sweep", timings)
+    print_timing_report(timings, f"Sweep timing report ({region})")
+    return region, all_succeeded(timings), sorted(deployments)
+
+
+def sweep(deployment_ids=None, regions=None, dry_run=False):
+    """Deletes every resource tagged with the given deployment IDs, or with any ID if none are given.
+
+    Sweeps every enabled region unless regions is given. The Lambda IAM role
+    is global, so it is only deleted once no data cap Lambda or capped server
+    is left in any region. It carries the tag of the deployment that created
+    it, so it is also deleted with the last deployment of any other ID.
+    Returns True on success.
+    """
+    regions = list(regions or list_regions())
+    print(f"Sweeping {len(regions)} region(s) for deployment(s) {', '.join(deployment_ids or ['(all)'])}...")
+    if len(regions) == 1:
+        results = [sweep_region(regions[0], deployment_ids, dry_run)]
+    else:
+        # clean_up keeps its clients in module globals, so each region gets its own process.
+        with ProcessPoolExecutor(max_workers=min(len(regions), 16)) as executor:
+            futures = [executor.submit(sweep_region, region, deployment_ids, dry_run) for region in regions]
+            results = [future.result() for future in futures]
+
+    ok = all(succeeded for _, succeeded, _ in results)
+    roles = discover_roles(deployment_ids)
+    if dry_run:
+        for deployment_id, role_names in sorted(roles.items()):
+            for role_name in role_names:
+                print(f"IAM: deployment {deployment_id}: role {role_name}")
+    elif any(found for _, _, found in results) or roles:
+        clean_up.init_clients(HOME_REGION)
+        # Checks every region, including those the sweep found nothing in or did not search.
+        in_use = not ok or clean_up.data_cap_in_use_elsewhere(preflight.LAMBDA_FUNCTION_NAME, [], False)
+        if deployment_ids and not in_use:
+            for deployment_id, role_names in discover_roles().items():
+                roles.setdefault(deployment_id, role_names)
+        for role_name in sorted({name for role_names in roles.values() for name in role_names}):
+            if in_use:
+                print(f"Keeping IAM Role {role_name}: data cap Lambdas may still use it.")
+            else:
+                ok = clean_up.delete_lambda_role(role_name) and ok
+
+    print("\nSweep summary:")
+    for region, succeeded, found in results:
+        if found or not succeeded:
+            print(f"  {region:<16} {'ok' if succeeded else 'FAILED':<7} deployments: {', '.join(found) or '-'}")
+    if not any(found for _, _, found in results) and not roles:
+        print("  No tagged resources found.")
+    return ok
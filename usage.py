@@ -0,0 +1,199 @@
+"""Monthly data usage accounting and cap enforcement.
+
+Usage is the combined NetworkIn + NetworkOut of an instance over the current
+calendar month (UTC). The running total is kept on the instance itself as
+tags, so each check only queries the periods since the previous one instead
+of the whole month. Datapoints younger than SETTLE_DELAY can still change,
+so they are added to the total provisionally and only committed once settled.
+
+Servers opt in with the TAG_CAP tag, whose value is their cap in bytes, so
+one function can look after every server in a region. This module is
+packaged into that Lambda and only needs the clients passed to it.
+"""
+import time
+from datetime import datetime, timezone
+
+DATA_CAP_BYTES = 100 * 1024 ** 3  # 100 GB of combined ingress and egress per month
+PERIOD = 300  # Basic monitoring publishes one datapoint per 5 minutes
+SETTLE_DELAY = 900  # CloudWatch may still revise datapoints younger than this
+MAX_QUERIES_PER_CALL = 500  # get_metric_data limit
+QUERIES_PER_INSTANCE = 3
+
+TAG_CAP = "OpenVPN:DataCapBytes"
+TAG_MONTH = "OpenVPN:UsageMonth"
+TAG_BYTES = "OpenVPN:UsageBytes"
+TAG_THROUGH = "OpenVPN:UsageThrough"
+
+
+def month_key(now):
+    """Returns the "YYYY-MM" of a UNIX timestamp in UTC."""
+    return datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m")
+
+
+def month_start(now):
+    """Returns the UNIX timestamp of the start of now's calendar month in UTC."""
+    moment = datetime.fromtimestamp(now, timezone.utc)
+    return int(datetime(moment.year, moment.month, 1, tzinfo=timezone.utc).timestamp())
+
+
+def settled_until(now):
+    """Returns the end of the last period whose datapoint will no longer change."""
+    return int(now - SETTLE_DELAY) // PERIOD * PERIOD
+
+
+def load_state(tags, now):
+    """Reads the running total from instance tags, starting afresh in a new month."""
+    month = month_key(now)
+    if tags.get(TAG_MONTH) != month:
+        return {"month": month, "total": 0, "through": month_start(now)}
+    return {"month": month, "total": int(tags.get(TAG_BYTES, 0)),
+            "through": int(tags.get(TAG_THROUGH, month_start(now)))}
+
+
+def state_tags(state):
+    """Returns the EC2 tags that persist a running total."""
+    return [
+        {"Key": TAG_MONTH, "Value": state["month"]},
+        {"Key": TAG_BYTES, "Value": str(state["total"])},
+        {"Key": TAG_THROUGH, "Value": str(state["through"])},
+    ]
+
+
+def accumulate(state, series, now):
+    """Adds the datapoints after state["through"] to the running total.
+
+    series maps period start timestamps to bytes. Returns the new state and
+    the provisional bytes of periods that have not settled yet.
+    """
+    cutoff = max(state["through"], settled_until(now))
+    committed = state["total"]
+    provisional = 0
+    for timestamp, value in series.items():
+        if timestamp < state["through"]:
+            continue
+        if timestamp + PERIOD <= cutoff:
+            committed += value
+        else:
+            provisional += value
+    new_state = {"month": state["month"], "total": int(committed), "through": cutoff}
+    return new_state, int(provisional)
+
+
+def usage_queries(instance_ids, period=PERIOD):
+    """Builds metric math queries returning NetworkIn + NetworkOut per instance."""
+    queries = []
+    for index, instance_id in enumerate(instance_ids):
+        for metric in ("NetworkIn", "NetworkOut"):
+            queries.append({
+                "Id": f"{metric.lower()}{index}",
+                "MetricStat": {
+                    "Metric": {"Namespace": "AWS/EC2", "MetricName": metric,
+                               "Dimensions": [{"Name": "InstanceId", "Value": instance_id}]},
+                    "Period": period,
+                    "Stat": "Sum",
+                },
+                "ReturnData": False,
+            })
+        queries.append({
+            "Id": f"total{index}",
+            "Expression": f"FILL(networkin{index}, 0) + FILL(networkout{index}, 0)",
+            "Label": instance_id,
+        })
+    return queries
+
+
+def fetch_usage(cloudwatch, instance_ids, start, end, period=PERIOD):
+    """Returns {instance_id: {period_start: bytes}} between start and end.
+
+    Uses as few get_metric_data calls as the per-call query limit allows.
+    """
+    series = {instance_id: {} for instance_id in instance_ids}
+    if start >= end:
+        return series
+    chunk = MAX_QUERIES_PER_CALL // QUERIES_PER_INSTANCE
+    for offset in range(0, len(instance_ids), chunk):
+        batch = instance_ids[offset:offset + chunk]
+        kwargs = {
+            "MetricDataQueries": usage_queries(batch, period),
+            "StartTime": datetime.fromtimestamp(start, timezone.utc),
+            "EndTime": datetime.fromtimestamp(end, timezone.utc),
+            "ScanBy": "TimestampAscending",
+        }
+        while True:
+            response = cloudwatch.get_metric_data(**kwargs)
+            for result in response["MetricDataResults"]:
+                instance_id = batch[int(result["Id"][len("total"):])]
+                for timestamp, value in zip(result["Timestamps"], result["Values"]):
+                    series[instance_id][int(timestamp.timestamp())] = value
+            if not response.get("NextToken"):
+                break
+            kwargs["NextToken"] = response["NextToken"]
+    return series
+
+
+def describe_instances(ec2, instance_ids=None):
+    """Returns {instance_id: (state_name, tags)} for the given or every capped instance.
+
+    Terminated instances and instances that no longer exist are left out.
+    """
+    filters = [{"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]}]
+    if instance_ids:
+        filters.append({"Name": "instance-id", "Values": list(instance_ids)})
+    else:
+        filters.append({"Name": "tag-key", "Values": [TAG_CAP]})
+    instances = {}
+    paginator = ec2.get_paginator("describe_instances")
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])}
+                instances[instance["InstanceId"]] = (instance["State"]["Name"], tags)
+    return instances
+
+
+def check_usage(ec2, cloudwatch, instance_ids=None, default_cap=DATA_CAP_BYTES, now=None):
+    """Brings the running totals of the given or every capped instance up to date.
+
+    Returns {instance_id: {"state", "total", "provisional", "cap"}}.
+    """
+    now = time.time() if now is None else now
+    instances = describe_instances(ec2, instance_ids)
+    if not instances:
+        return {}
+
+    states = {instance_id: load_state(tags, now) for instance_id, (_, tags) in instances.items()}
+    start = min(state["through"] for state in states.values())
+    series = fetch_usage(cloudwatch, list(instances), start, int(now) // PERIOD * PERIOD + PERIOD)
+
+    usage = {}
+    for instance_id, state in states.items():
+        new_state, provisional = accumulate(state, series[instance_id], now)
+        if new_state != state:
+            ec2.create_tags(Resources=[instance_id], Tags=state_tags(new_state))
+        instance_state, tags = instances[instance_id]
+        usage[instance_id] = {"state": instance_state, "total": new_state["total"], "provisional": provisional,
+                              "cap": int(tags.get(TAG_CAP, default_cap))}
+    return usage
+
+
+def stop_running(ec2, instance_ids):
+    """Stops whichever of instance_ids are pending or running with one call. Returns their IDs."""
+    running = [instance_id for instance_id, (state, _) in describe_instances(ec2, instance_ids).items()
+               if state in ("pending", "running")]
+    if running:
+        ec2.stop_instances(InstanceIds=running)
+    return running
+
+
+def enforce_cap(ec2, cloudwatch, instance_ids=None, default_cap=DATA_CAP_BYTES, now=None):
+    """Updates the running totals and stops every instance that reached its cap.
+
+    Without instance_ids every instance tagged with TAG_CAP is checked.
+    Returns the IDs of the instances that were stopped.
+    """
+    usage = check_usage(ec2, cloudwatch, instance_ids, default_cap, now)
+    over_cap = [instance_id for instance_id, info in usage.items()
+                if info["state"] in ("pending", "running") and info["total"] + info["provisional"] >= info["cap"]]
+    if over_cap:
+        ec2.stop_instances(InstanceIds=over_cap)
+    return over_cap
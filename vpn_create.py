@@ -1,91 +1,194 @@
-import boto3
 import os
-import time
+import io
 import json
+import base64
+import hashlib
+import threading
+import uuid
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import bootstrap
+import discovery_cache
+import instrumentation
+import journal
+import preflight
+import usage
+from aws_clients import lazy_client
+from retries import call_ignoring, call_with_retries, error_code
+from scheduler import Step, all_succeeded, print_timing_report, run_steps
+from waiters import wait_for_instance_state
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_MODULES = ("data_cap_handler.py", "usage.py")
+USAGE_CHECK_SCHEDULE = "rate(15 minutes)"
+USAGE_CHECK_TARGET_ID = "usage-check"
+LAMBDA_ROLE_POLICIES = (
+    "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole",  # Logs
+    "arn:aws:iam::aws:policy/AmazonEC2FullAccess",  # Reading usage tags and stopping instances
+    "arn:aws:iam::aws:policy/CloudWatchReadOnlyAccess",  # Reading network metrics
+)
+# New IAM roles usually become assumable within 5-10 seconds; retry Lambda calls quickly until then.
+ROLE_PROPAGATION_ATTEMPTS = 12
+ROLE_PROPAGATION_BASE_DELAY = 1
+ROLE_PROPAGATION_MAX_DELAY = 5
+# Scale-out deployments: (target group suffix, protocol, port) forwarded by the network load balancer.
+LOAD_BALANCER_LISTENERS = (("udp", "UDP", 1194), ("tcp", "TCP", 443))
+DEREGISTRATION_DELAY = 120  # Seconds a drained server keeps its connections before it is terminated
+DEPLOYMENT_TAG = "OpenVPN:DeploymentId"  # Lets sweeper.py find a deployment without its resources.json
+ROLE_PATH = "/openvpn-aws/"
 
 resources = {}  # Dictionary to track created resources
+journal_file = None  # Write-ahead journal for the current deploy
+_record_lock = threading.Lock()
+
+
+def record_resource(key, value):
+    """Records a created resource and appends it to the journal before moving on."""
+    with _record_lock:
+        resources[key] = value
+        if journal_file:
+            journal.append(journal_file, key, value)
+
+
+def deployment_tags(name=None):
+    """Returns the tags that mark a resource as part of the current deployment."""
+    tags = [{"Key": DEPLOYMENT_TAG, "Value": resources["deployment_id"]}]
+    if name:
+        tags.append({"Key": "Name", "Value": name})
+    return tags
+
+
+def tag_specifications(resource_type, name=None):
+    """Returns TagSpecifications that tag an EC2 resource in its create call."""
+    return [{"ResourceType": resource_type, "Tags": deployment_tags(name)}]
+
 
 def save_resources_to_file(filename="resources.json"):
-    """Saves the created resources to a JSON file."""
+    """Saves the created resources to a JSON file. Returns True on success."""
     try:
         with open(filename, "w") as file:
             json.dump(resources, file, indent=4)
         print(f"Resources saved to '{filename}'.")
+        return True
     except Exception as e:
         print(f"Error saving resources to file: {e}")
+        return False
+
+def fetch_vpc_inventory():
+    """Fetches every VPC and subnet in the region, reusing a recent cached listing."""
+    return discovery_cache.cached("vpc_inventory", resources["region"], "all", describe_vpc_inventory)
+
+
+def describe_vpc_inventory():
+    """Describes every VPC and subnet in the region with one paginated call per resource type."""
+    vpcs = []
+    for page in ec2_client.get_paginator("describe_vpcs").paginate():
+        vpcs.extend(page["Vpcs"])
+
+    # One region-wide subnet listing, grouped in memory, instead of a call per VPC.
+    subnets_by_vpc = {}
+    for page in ec2_client.get_paginator("describe_subnets").paginate():
+        for subnet in page["Subnets"]:
+            subnets_by_vpc.setdefault(subnet["VpcId"], []).append({
+                "subnet_id": subnet["SubnetId"],
+                "cidr_block": subnet["CidrBlock"],
+                "availability_zone": subnet["AvailabilityZone"],
+                "public": subnet["MapPublicIpOnLaunch"],
+            })
+
+    return [
+        {
+            "vpc_id": vpc["VpcId"],
+            "cidr_block": vpc["CidrBlock"],
+            "is_default": vpc["IsDefault"],
+            "tags": {tag["Key"]: tag["Value"] for tag in vpc.get("Tags", [])},
+            "subnets": subnets_by_vpc.get(vpc["VpcId"], []),
+        }
+        for vpc in vpcs
+    ]
+
+
+def print_inventory(inventory, output_format="table"):
+    """Prints the VPC inventory as a table or as JSON."""
+    if output_format == "json":
+        print(json.dumps(inventory, indent=4))
+        return
 
-def list_vpcs():
-    """Lists all VPCs along with their subnets."""
-    print("Fetching VPCs...")
-    response = ec2_client.describe_vpcs()
-    vpcs = response['Vpcs']
     print("\nAvailable VPCs:")
-    for idx, vpc in enumerate(vpcs):
-        vpc_id = vpc['VpcId']
-        cidr = vpc['CidrBlock']
-        is_default = vpc['IsDefault']
-        tags = vpc.get('Tags', [])
-        tag_info = ", ".join([f"{tag['Key']}={tag['Value']}" for tag in tags]) if tags else "No Tags"
-
-        print(f"{idx + 1}.")
-        print(f"   VPC ID: {vpc_id}")
-        print(f"   CIDR Block: {cidr}")
-        print(f"   Default VPC: {is_default}")
-        print(f"   Tags: {tag_info}")
-        print("   Subnets:")
-        list_subnets(vpc_id)  # Call the function to list subnets for this VPC
-    return vpcs
-
-def list_subnets(vpc_id):
-    """Lists all subnets in a given VPC."""
-    try:
-        response = ec2_client.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
-        subnets = response['Subnets']
-        for subnet in subnets:
-            subnet_id = subnet['SubnetId']
-            cidr = subnet['CidrBlock']
-            az = subnet['AvailabilityZone']
-            is_public = subnet['MapPublicIpOnLaunch']
-            print(f"      - Subnet ID: {subnet_id}, CIDR Block: {cidr}, Availability Zone: {az}, Public: {is_public}")
-    except Exception as e:
-        print(f"Error listing subnets for VPC {vpc_id}: {e}")
+    print(f"{'#':>3}  {'VPC ID':<23} {'CIDR Block':<18} {'Default':<8} Tags")
+    for idx, vpc in enumerate(inventory):
+        tag_info = ", ".join(f"{key}={value}" for key, value in vpc["tags"].items()) or "No Tags"
+        print(f"{idx + 1:>3}  {vpc['vpc_id']:<23} {vpc['cidr_block']:<18} {str(vpc['is_default']):<8} {tag_info}")
+        for subnet in vpc["subnets"]:
+            print(f"       - {subnet['subnet_id']:<26} {subnet['cidr_block']:<18} "
+                  f"{subnet['availability_zone']:<14} Public: {subnet['public']}")
 
 
-def create_vpc():
-    """Creates a new VPC with associated subnets, internet gateway, and route table."""
+def list_vpcs(output_format="table"):
+    """Lists all VPCs along with their subnets."""
+    if output_format != "json":
+        print("Fetching VPCs...")
+    inventory = fetch_vpc_inventory()
+    print_inventory(inventory, output_format)
+    return inventory
+
+
+def create_vpc(availability_zones, vpc_cidr):
+    """Creates a new VPC with subnets in the given zones, an internet gateway, and a route table.
+
+    Parts already recorded by an interrupted run are reused rather than created again.
+    """
     print("Creating a new VPC...")
     try:
-        response = ec2_client.create_vpc(CidrBlock="10.0.0.0/16")
-        vpc_id = response['Vpc']['VpcId']
-        resources["vpc_id"] = vpc_id
-        print(f"VPC created with ID: {vpc_id}")
-
-        ec2_client.create_tags(Resources=[vpc_id], Tags=[{"Key": "Name", "Value": "MyNewVPC"}])
+        region = resources["region"]
+        vpc_id = resources.get("vpc_id")
+        if vpc_id:
+            print(f"Reusing VPC {vpc_id} from the previous run.")
+        else:
+            response = ec2_client.create_vpc(CidrBlock=vpc_cidr,
+                                             TagSpecifications=tag_specifications("vpc", "MyNewVPC"))
+            vpc_id = response['Vpc']['VpcId']
+            record_resource("vpc_id", vpc_id)
+            discovery_cache.invalidate("vpc_inventory", region)
+            print(f"VPC created with ID: {vpc_id} ({vpc_cidr})")
 
         # Create subnets
-        subnet1_response = ec2_client.create_subnet(VpcId=vpc_id, CidrBlock="10.0.1.0/24", AvailabilityZone="eu-west-2a")
-        subnet2_response = ec2_client.create_subnet(VpcId=vpc_id, CidrBlock="10.0.2.0/24", AvailabilityZone="eu-west-2b")
-        subnet1_id = subnet1_response['Subnet']['SubnetId']
-        subnet2_id = subnet2_response['Subnet']['SubnetId']
-        resources["subnets"] = [subnet1_id, subnet2_id]
-        print(f"Subnets created: {subnet1_id}, {subnet2_id}")
+        subnets = list(resources.get("subnets", []))
+        subnet_specs = [(cidr, availability_zones[index % len(availability_zones)])
+                        for index, cidr in enumerate(preflight.subnet_cidrs(vpc_cidr))]
+        for cidr, availability_zone in subnet_specs[len(subnets):]:
+            subnet_response = ec2_client.create_subnet(VpcId=vpc_id, CidrBlock=cidr, AvailabilityZone=availability_zone,
+                                                       TagSpecifications=tag_specifications("subnet"))
+            subnets.append(subnet_response['Subnet']['SubnetId'])
+            record_resource("subnets", list(subnets))
+        subnet1_id = subnets[0]
+        print(f"Subnets: {', '.join(subnets)}")
 
         ec2_client.modify_subnet_attribute(SubnetId=subnet1_id, MapPublicIpOnLaunch={"Value": True})
 
         # Create an internet gateway and attach it to the VPC
-        igw_response = ec2_client.create_internet_gateway()
-        igw_id = igw_response['InternetGateway']['InternetGatewayId']
-        ec2_client.attach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
-        resources["internet_gateway_id"] = igw_id
+        igw_id = resources.get("internet_gateway_id")
+        if not igw_id:
+            igw_response = ec2_client.create_internet_gateway(
+                TagSpecifications=tag_specifications("internet-gateway"))
+            igw_id = igw_response['InternetGateway']['InternetGatewayId']
+            record_resource("internet_gateway_id", igw_id)
+        call_ignoring(lambda: ec2_client.attach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id),
+                      ["Resource.AlreadyAssociated"])
         print(f"Internet Gateway created and attached: {igw_id}")
 
         # Create a route table and associate it with the public subnet
-        route_table_response = ec2_client.create_route_table(VpcId=vpc_id)
-        route_table_id = route_table_response['RouteTable']['RouteTableId']
-        ec2_client.create_route(RouteTableId=route_table_id, DestinationCidrBlock="0.0.0.0/0", GatewayId=igw_id)
-        ec2_client.associate_route_table(RouteTableId=route_table_id, SubnetId=subnet1_id)
-        resources["route_table_id"] = route_table_id
+        route_table_id = resources.get("route_table_id")
+        if not route_table_id:
+            route_table_response = ec2_client.create_route_table(
+                VpcId=vpc_id, TagSpecifications=tag_specifications("route-table"))
+            route_table_id = route_table_response['RouteTable']['RouteTableId']
+            record_resource("route_table_id", route_table_id)
+        call_ignoring(lambda: ec2_client.create_route(RouteTableId=route_table_id, DestinationCidrBlock="0.0.0.0/0",
+                                                      GatewayId=igw_id), ["RouteAlreadyExists"])
+        call_ignoring(lambda: ec2_client.associate_route_table(RouteTableId=route_table_id, SubnetId=subnet1_id),
+                      ["Resource.AlreadyAssociated"])
         print(f"Route table created and associated with subnet {subnet1_id}")
 
         return vpc_id, subnet1_id
@@ -97,6 +200,13 @@ def create_vpc():
 def create_security_group(vpc_id):
     """Checks if a security group exists and creates it if not."""
     group_name = "OpenVPN-Security-Group"
+    cache_key = f"{vpc_id}:{group_name}"
+    # Preflight looked the group up moments ago and refreshed or dropped this entry.
+    sg_id = discovery_cache.get("security_group", resources["region"], cache_key)
+    if sg_id:
+        print(f"Security group '{group_name}' found in the discovery cache with ID: {sg_id}. Using it.")
+        return sg_id
+
     print(f"Checking if security group '{group_name}' exists...")
     try:
         response = ec2_client.describe_security_groups(
@@ -108,6 +218,7 @@ def create_security_group(vpc_id):
         if response["SecurityGroups"]:
             sg_id = response["SecurityGroups"][0]["GroupId"]
             print(f"Security group '{group_name}' already exists with ID: {sg_id}. Using it.")
+            discovery_cache.put("security_group", resources["region"], cache_key, sg_id)
             return sg_id
     except Exception as e:
         print(f"Error checking security group: {e}")
@@ -117,10 +228,12 @@ def create_security_group(vpc_id):
         response = ec2_client.create_security_group(
             GroupName=group_name,
             Description="Security group for OpenVPN server",
-            VpcId=vpc_id
+            VpcId=vpc_id,
+            TagSpecifications=tag_specifications("security-group")
         )
         sg_id = response["GroupId"]
-        resources["security_group_id"] = sg_id
+        record_resource("security_group_id", sg_id)
+        discovery_cache.put("security_group", resources["region"], cache_key, sg_id)
         print(f"Security group created with ID: {sg_id}")
 
         # Add inbound rules
@@ -142,17 +255,24 @@ def create_security_group(vpc_id):
 
 def create_key_pair(key_name):
     """Checks if the key pair exists, and creates it if not."""
+    if discovery_cache.get("key_pair", resources["region"], key_name):
+        print(f"Key pair '{key_name}' found in the discovery cache. Using it.")
+        record_resource("key_pair_name", key_name)
+        return key_name
+
     print(f"Checking if key pair '{key_name}' exists...")
     try:
         ec2_client.describe_key_pairs(KeyNames=[key_name])
         print(f"Key pair '{key_name}' already exists. Using it.")
-        resources["key_pair_name"] = key_name
+        record_resource("key_pair_name", key_name)
+        discovery_cache.put("key_pair", resources["region"], key_name, True)
         return key_name
     except ec2_client.exceptions.ClientError as e:
         if "InvalidKeyPair.NotFound" in str(e):
             print(f"Key pair '{key_name}' does not exist. Creating it...")
             try:
-                response = ec2_client.create_key_pair(KeyName=key_name)
+                response = ec2_client.create_key_pair(KeyName=key_name,
+                                                      TagSpecifications=tag_specifications("key-pair"))
                 private_key = response['KeyMaterial']
                 pem_file = os.path.join(os.getcwd(), f"{key_name}.pem")
                 with open(pem_file, "w") as file:
@@ -165,7 +285,8 @@ def create_key_pair(key_name):
                 except Exception as chmod_error:
                     print(f"Error setting permissions for '{pem_file}': {chmod_error}")
 
-                resources["key_pair_name"] = key_name
+                record_resource("key_pair_name", key_name)
+                discovery_cache.put("key_pair", resources["region"], key_name, True)
                 print(f"Key pair '{key_name}' created and saved to '{pem_file}'.")
                 return key_name
             except Exception as create_error:
@@ -176,97 +297,167 @@ def create_key_pair(key_name):
             return None
 
 
-def ensure_iam_role_permissions(role_name):
-    """Ensures the IAM role has the necessary permissions."""
-    print(f"Ensuring correct permissions for IAM role: {role_name}...")
-    
-    try:
-        # Define required managed policies
-        required_policies = [
-            "arn:aws:iam::aws:policy/CloudWatchFullAccess",
-            "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
-        ]
-        
-        # Check existing attached policies
-        attached_policies = iam_client.list_attached_role_policies(RoleName=role_name)["AttachedPolicies"]
-        attached_policy_arns = [policy["PolicyArn"] for policy in attached_policies]
-
-        # Attach missing policies
-        for policy_arn in required_policies:
-            if policy_arn not in attached_policy_arns:
-                print(f"Attaching policy: {policy_arn}")
-                iam_client.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
-        
-        # Create and attach a custom inline policy for EC2 permissions
-        custom_policy_name = "CustomEC2Permissions"
-        custom_policy_document = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "ec2:StopInstances",
-                        "ec2:DescribeInstances",
-                        "ec2:TerminateInstances",
-                        "ec2:ReleaseAddress",
-                        "ec2:DescribeAddresses"
-                    ],
-                    "Resource": "*"
-                }
-            ]
-        }
-        
-        print(f"Attaching custom inline policy: {custom_policy_name}")
-        iam_client.put_role_policy(
-            RoleName=role_name,
-            PolicyName=custom_policy_name,
-            PolicyDocument=json.dumps(custom_policy_document)
-        )
-        print(f"Permissions for IAM role '{role_name}' updated successfully.")
-    except Exception as e:
-        print(f"Error ensuring permissions for IAM role '{role_name}': {e}")
-
-
-
-def launch_ec2_instance(key_name, sg_id, subnet_id):
-    """Launches an EC2 instance."""
-    print("Launching OpenVPN EC2 instance...")
+def launch_ec2_instance(key_name, sg_id, subnet_id, image_id, instance_type, count=1, user_data=""):
+    """Launches one or more EC2 instances in a single run_instances call, tuned by the user data script."""
+    print(f"Launching {count} OpenVPN EC2 instance(s) of type {instance_type} from {image_id}...")
     try:
         response = ec2_client.run_instances(
-            ImageId="ami-031c46bb046b90dae",
-            InstanceType="t2.micro",
-            MinCount=1,
-            MaxCount=1,
+            ImageId=image_id,
+            InstanceType=instance_type,
+            MinCount=count,
+            MaxCount=count,
             KeyName=key_name,
             SecurityGroupIds=[sg_id],
             SubnetId=subnet_id,
-            TagSpecifications=[{"ResourceType": "instance", "Tags": [{"Key": "Name", "Value": "OpenVPN-Server"}]}],
+            UserData=user_data,
+            TagSpecifications=[{"ResourceType": "instance", "Tags": deployment_tags("OpenVPN-Server") + [
+                {"Key": usage.TAG_CAP, "Value": str(usage.DATA_CAP_BYTES)},  # Picked up by the data cap Lambda
+            ]}],
         )
-        instance_id = response["Instances"][0]["InstanceId"]
-        resources["instance_id"] = instance_id
-        print(f"Instance launched with ID: {instance_id}")
-        return instance_id
+        instance_ids = [instance["InstanceId"] for instance in response["Instances"]]
+        # Added to what is already recorded, so instances of an interrupted run are never lost track of.
+        record_resource("instance_ids", resources.get("instance_ids", []) + instance_ids)
+        print(f"Instances launched with IDs: {', '.join(instance_ids)}")
+        return instance_ids
     except Exception as e:
         print(f"Error launching EC2 instance: {e}")
         return None
 
-def allocate_elastic_ip(instance_id):
-    """Allocates and associates an Elastic IP after a delay."""
-    print("Waiting 60 seconds for the EC2 instance to initialize...")
-    time.sleep(60)
-    print("Allocating Elastic IP...")
+def launch_missing_instances(key_name, sg_id, subnet_id, image_id, instance_type, count=1, user_data=""):
+    """Launches the instances an interrupted run did not get to. Returns the IDs of all count instances."""
+    recorded = resources.get("instance_ids", [])
+    if len(recorded) >= count:
+        return recorded[:count]
+    if recorded:
+        print(f"Reusing instance(s) {', '.join(recorded)} from the interrupted run.")
+    if launch_ec2_instance(key_name, sg_id, subnet_id, image_id, instance_type, count - len(recorded),
+                           user_data) is None:
+        return None
+    return resources["instance_ids"]
+
+def allocate_elastic_ips(instance_ids):
+    """Allocates Elastic IPs straight away and associates them once the instances are running."""
+    print(f"Allocating {len(instance_ids)} Elastic IP(s)...")
     try:
-        waiter = ec2_client.get_waiter('instance_running')
-        waiter.wait(InstanceIds=[instance_id])
-        eip_response = ec2_client.allocate_address(Domain="vpc")
-        ec2_client.associate_address(InstanceId=instance_id, AllocationId=eip_response["AllocationId"])
-        resources["elastic_ip"] = eip_response['PublicIp']
-        print(f"Elastic IP allocated: {eip_response['PublicIp']}")
+        # Allocation does not depend on the instances, so do it while they are still booting.
+        elastic_ips = dict(resources.get("elastic_ips", {}))
+        for instance_id in instance_ids:
+            if instance_id in elastic_ips:
+                continue  # Allocated by an interrupted run
+            eip_response = ec2_client.allocate_address(Domain="vpc",
+                                                       TagSpecifications=tag_specifications("elastic-ip"))
+            elastic_ips[instance_id] = {"public_ip": eip_response["PublicIp"], "allocation_id": eip_response["AllocationId"]}
+            record_resource("elastic_ips", dict(elastic_ips))
+            print(f"Elastic IP allocated: {eip_response['PublicIp']}")
+
+        print(f"Waiting for EC2 instance(s) {', '.join(instance_ids)} to reach the running state...")
+        wait_for_instance_state(ec2_client, instance_ids, "running")
+        for instance_id in instance_ids:
+            ec2_client.associate_address(InstanceId=instance_id, AllocationId=elastic_ips[instance_id]["allocation_id"])
+            print(f"Elastic IP {elastic_ips[instance_id]['public_ip']} associated with instance {instance_id}.")
+        return [elastic_ips[instance_id]["public_ip"] for instance_id in instance_ids]
     except Exception as e:
         print(f"Error allocating Elastic IP: {e}")
+        return None
+
+def create_load_balancer(vpc_id, subnet_id, availability_zones):
+    """Creates a network load balancer that forwards UDP 1194 and TCP 443 to the servers.
+
+    Returns {"udp": target group ARN, "tcp": target group ARN}. Parts already
+    recorded by an interrupted run are reused rather than created again.
+    """
+    print("Creating a network load balancer...")
+    try:
+        deployment_id = resources["deployment_id"]
+        # One subnet per zone; a new VPC only has a second zone when the region offered one.
+        subnet_ids = resources.get("subnets", [subnet_id])[:len(set(availability_zones))] or [subnet_id]
+        route_table_id = resources.get("route_table_id")
+        for other_subnet_id in subnet_ids[1:] if route_table_id else []:
+            # An internet-facing load balancer needs the internet gateway route in every subnet it uses.
+            call_ignoring(lambda: ec2_client.associate_route_table(RouteTableId=route_table_id,
+                                                                   SubnetId=other_subnet_id),
+                          ["Resource.AlreadyAssociated"])
+
+        target_group_arns = dict(resources.get("target_group_arns", {}))
+        for key, protocol, port in LOAD_BALANCER_LISTENERS:
+            if key in target_group_arns:
+                continue
+            response = elbv2_client.create_target_group(
+                Name=f"openvpn-{deployment_id}-{key}", Protocol=protocol, Port=port, VpcId=vpc_id,
+                TargetType="instance", HealthCheckProtocol="TCP", HealthCheckPort="443", Tags=deployment_tags())
+            target_group_arns[key] = response["TargetGroups"][0]["TargetGroupArn"]
+            record_resource("target_group_arns", dict(target_group_arns))
+            elbv2_client.modify_target_group_attributes(
+                TargetGroupArn=target_group_arns[key],
+                Attributes=[{"Key": "deregistration_delay.timeout_seconds", "Value": str(DEREGISTRATION_DELAY)}])
+
+        load_balancer_arn = resources.get("load_balancer_arn")
+        if not load_balancer_arn:
+            response = elbv2_client.create_load_balancer(Name=f"openvpn-{deployment_id}", Subnets=subnet_ids,
+                                                         Scheme="internet-facing", Type="network",
+                                                         Tags=deployment_tags())
+            load_balancer_arn = response["LoadBalancers"][0]["LoadBalancerArn"]
+            record_resource("load_balancer_arn", load_balancer_arn)
+            record_resource("load_balancer_dns", response["LoadBalancers"][0]["DNSName"])
+        for key, protocol, port in LOAD_BALANCER_LISTENERS:
+            # Creating a listener identical to an existing one succeeds, so a resume needs no check.
+            elbv2_client.create_listener(LoadBalancerArn=load_balancer_arn, Protocol=protocol, Port=port,
+                                         DefaultActions=[{"Type": "forward",
+                                                          "TargetGroupArn": target_group_arns[key]}])
+        print(f"Load balancer {resources['load_balancer_dns']} forwards UDP 1194 and TCP 443.")
+        return target_group_arns
+    except Exception as e:
+        print(f"Error creating the load balancer: {e}")
+        return None
+
+
+def register_targets(instance_ids, target_group_arns, sg_id, subnet_id):
+    """Registers running servers with the load balancer's target groups. Returns True on success.
+
+    Also records where `scale` launches further servers.
+    """
+    record_resource("scale_out", dict(resources.get("scale_out", {}), security_group_id=sg_id, subnet_id=subnet_id))
+    print(f"Waiting for EC2 instance(s) {', '.join(instance_ids)} to run before registering them...")
+    try:
+        wait_for_instance_state(ec2_client, instance_ids, "running")
+        targets = [{"Id": instance_id} for instance_id in instance_ids]
+        for target_group_arn in target_group_arns.values():
+            elbv2_client.register_targets(TargetGroupArn=target_group_arn, Targets=targets)
+        print(f"Instance(s) {', '.join(instance_ids)} registered with the load balancer.")
+        return True
+    except Exception as e:
+        print(f"Error registering instances with the load balancer: {e}")
+        return False
+
+
+def reconcile_role_policies(role_name, attached_policy_arns=None):
+    """Attaches the required managed policies the role is missing, in one pass.
+
+    attached_policy_arns skips the listing when the caller already knows
+    them, e.g. for a role it has just created. Returns True on success.
+    """
+    if attached_policy_arns is None:
+        paginator = iam_client.get_paginator("list_attached_role_policies")
+        attached_policy_arns = {policy["PolicyArn"] for page in paginator.paginate(RoleName=role_name)
+                                for policy in page["AttachedPolicies"]}
+    missing = [arn for arn in LAMBDA_ROLE_POLICIES if arn not in attached_policy_arns]
+    if not missing:
+        return True
+    print(f"Attaching {len(missing)} policy(ies) to IAM Role {role_name}: {', '.join(missing)}")
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        futures = [executor.submit(iam_client.attach_role_policy, RoleName=role_name, PolicyArn=arn)
+                   for arn in missing]
+        for future in futures:
+            future.result()
+    return True
+
 
 def create_lambda_role():
-    """Creates or reuses an IAM role for the Lambda function."""
+    """Creates or reuses the IAM role for the Lambda function, with the policies it needs.
+
+    A new role takes a few seconds to become assumable; create_lambda_function
+    retries until it is, rather than waiting a fixed time here.
+    """
     print("Creating IAM Role for Lambda...")
     role_name = "LambdaStopInstanceRole"
     assume_role_policy = {
@@ -279,217 +470,458 @@ def create_lambda_role():
             }
         ]
     }
-    try:
-        # Check if the role already exists
-        response = iam_client.get_role(RoleName=role_name)
-        role_arn = response['Role']['Arn']
-        print(f"IAM Role {role_name} already exists. Reusing it.")
-        return role_arn
-    except iam_client.exceptions.NoSuchEntityException:
-        print(f"IAM Role {role_name} does not exist. Creating it...")
+    role_arn = discovery_cache.get("iam_role", discovery_cache.GLOBAL_REGION, role_name)
+    if role_arn:
         try:
-            response = iam_client.create_role(
-                RoleName=role_name,
-                AssumeRolePolicyDocument=json.dumps(assume_role_policy)
-            )
-            role_arn = response["Role"]["Arn"]
-
-            # Attach policies for Lambda execution and EC2 stop
-            iam_client.attach_role_policy(
-                RoleName=role_name,
-                PolicyArn="arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
-            )
-            iam_client.attach_role_policy(
-                RoleName=role_name,
-                PolicyArn="arn:aws:iam::aws:policy/AmazonEC2FullAccess"
-            )
-
-            print(f"IAM Role {role_name} created successfully. Waiting for propagation...")
-            time.sleep(15)  # Wait for the role to propagate
+            # Listing the policies to repair them also proves the cached role still exists.
+            reconcile_role_policies(role_name)
+            print(f"IAM Role {role_name} found in the discovery cache. Reusing it.")
+            record_resource("lambda_role_name", role_name)
             return role_arn
         except Exception as e:
-            print(f"Error creating IAM Role: {e}")
-            return None
-    except Exception as e:
-        print(f"Error checking IAM Role: {e}")
-        return None
-
-    # Attach managed policies
-    try:
-        required_policies = [
-            "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole",
-            "arn:aws:iam::aws:policy/CloudWatchFullAccess"
-        ]
-        attached_policies = iam_client.list_attached_role_policies(RoleName=role_name)["AttachedPolicies"]
-        attached_policy_arns = [policy["PolicyArn"] for policy in attached_policies]
-
-        for policy_arn in required_policies:
-            if policy_arn not in attached_policy_arns:
-                print(f"Attaching policy: {policy_arn}")
-                iam_client.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
-
-        # Attach custom inline policy for EC2 actions
-        custom_policy_name = "CustomEC2Permissions"
-        custom_policy_document = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "ec2:StopInstances",
-                        "ec2:DescribeInstances",
-                        "ec2:TerminateInstances",
-                        "ec2:ReleaseAddress",
-                        "ec2:DescribeAddresses"
-                    ],
-                    "Resource": "*"
-                }
-            ]
-        }
-        print(f"Attaching custom inline policy: {custom_policy_name}")
-        iam_client.put_role_policy(
-            RoleName=role_name,
-            PolicyName=custom_policy_name,
-            PolicyDocument=json.dumps(custom_policy_document)
-        )
-
-        print(f"Permissions for IAM role '{role_name}' updated successfully.")
-    except Exception as e:
-        print(f"Error attaching policies to IAM Role '{role_name}': {e}")
-        return None
-
-    return role_arn
-
-
-def create_lambda_function(instance_id, role_arn):
-    """Creates the Lambda function to stop the EC2 instance."""
-    print("Creating Lambda Function...")
-    function_name = "StopEC2Instance"
-    lambda_file = "lambda_function.zip"
-    with open("lambda_function.py", "w") as file:
-        file.write(f"""
-import boto3
-
-def lambda_handler(event, context):
-    ec2 = boto3.client('ec2')
-    ec2.stop_instances(InstanceIds=['{instance_id}'])
-    print("Stopped instance: {instance_id}")
-        """)
-    with zipfile.ZipFile(lambda_file, 'w') as zip_file:
-        zip_file.write("lambda_function.py")
-    os.remove("lambda_function.py")
-
+            if error_code(e) != "NoSuchEntity":
+                print(f"Error reconciling IAM Role {role_name}: {e}")
+                return None
+            print(f"IAM Role {role_name} from the discovery cache no longer exists.")
+            discovery_cache.invalidate("iam_role", discovery_cache.GLOBAL_REGION, role_name)
     try:
-        with open(lambda_file, "rb") as file:
-            zipped_code = file.read()
-        response = lambda_client.create_function(
-            FunctionName=function_name,
-            Runtime="python3.9",
-            Role=role_arn,
-            Handler="lambda_function.lambda_handler",
-            Code={"ZipFile": zipped_code},
-            Timeout=10
-        )
-        resources["lambda_function_name"] = function_name
-        print(f"Lambda Function {function_name} created successfully.")
-        return response["FunctionArn"]
+        try:
+            role_arn = iam_client.get_role(RoleName=role_name)["Role"]["Arn"]
+            print(f"IAM Role {role_name} already exists. Reusing it.")
+            attached_policy_arns = None
+        except iam_client.exceptions.NoSuchEntityException:
+            print(f"IAM Role {role_name} does not exist. Creating it...")
+            try:
+                response = iam_client.create_role(
+                    RoleName=role_name,
+                    Path=ROLE_PATH,
+                    AssumeRolePolicyDocument=json.dumps(assume_role_policy),
+                    Tags=deployment_tags()
+                )
+                role_arn = response["Role"]["Arn"]
+                attached_policy_arns = set()
+                print(f"IAM Role {role_name} created successfully.")
+            except Exception as e:
+                if error_code(e) != "EntityAlreadyExists":
+                    raise
+                # Another region of a fleet deploy created it between our get_role and create_role.
+                role_arn = iam_client.get_role(RoleName=role_name)["Role"]["Arn"]
+                attached_policy_arns = None
+                print(f"IAM Role {role_name} was just created by another deploy. Reusing it.")
+        # Shared by every deployment; clean_up deletes it with the last one that uses it.
+        record_resource("lambda_role_name", role_name)
+
+        # Roles made by older versions may lack a policy added since, e.g. CloudWatch read access.
+        reconcile_role_policies(role_name, attached_policy_arns)
+        discovery_cache.put("iam_role", discovery_cache.GLOBAL_REGION, role_name, role_arn)
+        return role_arn
     except Exception as e:
-        print(f"Error creating Lambda Function: {e}")
+        print(f"Error creating IAM Role {role_name}: {e}")
         return None
 
-def create_cloudwatch_alarm(instance_id, function_arn):
-    """Creates a CloudWatch alarm to monitor monthly data usage."""
-    print("Creating CloudWatch Alarm for monthly data usage...")
-    try:
-        # Define the monthly threshold split into an hourly approximation
-        hourly_threshold = 107374182400 / (30 * 24)  # ~99.6 GB split into 30 days and 24 hours/day
-        
-        cloudwatch_client.put_metric_alarm(
-            AlarmName="MonthlyDataUsageAlarm",
-            AlarmDescription="Alarm to monitor combined NetworkIn and NetworkOut for ~99.6 GB of usage.",
-            ActionsEnabled=True,
-            AlarmActions=[function_arn],
-            MetricName="NetworkOut",
-            Namespace="AWS/EC2",
-            Statistic="Sum",
-            Period=3600,  # 1 hour
-            EvaluationPeriods=24,  # Monitor for 24 hours (1 day equivalent)
-            Threshold=hourly_threshold,
-            ComparisonOperator="GreaterThanThreshold",
-            Dimensions=[
-                {"Name": "InstanceId", "Value": instance_id}
-            ],
-            TreatMissingData="notBreaching"
-        )
-        resources["cloudwatch_alarm_name"] = "VPNNetworkUsageAlarm"
-        print("CloudWatch Alarm created successfully.")
-    except Exception as e:
-        print(f"Error creating CloudWatch Alarm: {e}")
 
+def retryable_role_error(error):
+    """False for an InvalidParameterValueException other than the one about a role still propagating."""
+    return error_code(error) != "InvalidParameterValueException" or "cannot be assumed" in str(error)
 
 
+def call_with_role_retries(action, description, retry_codes=()):
+    """Calls a Lambda API that takes a role, retrying with jittered backoff until the role is assumable."""
+    return call_with_retries(action, ["InvalidParameterValueException", *retry_codes], description,
+                             attempts=ROLE_PROPAGATION_ATTEMPTS, base_delay=ROLE_PROPAGATION_BASE_DELAY,
+                             max_delay=ROLE_PROPAGATION_MAX_DELAY, should_retry=retryable_role_error)
 
 
-def main():
-    print("Starting script...")
-    try:
-        global ec2_client, iam_client, lambda_client, cloudwatch_client
-        region = input("Enter the AWS region (e.g., eu-west-2): ").strip()
-        resources["region"] = region  # Save the specified region to the resources dictionary
-        ec2_client = boto3.client("ec2", region_name=region)
-        iam_client = boto3.client("iam", region_name=region)
-        lambda_client = boto3.client("lambda", region_name=region)
-        cloudwatch_client = boto3.client("cloudwatch", region_name=region)
+def build_lambda_package():
+    """Builds the Lambda deployment package in memory.
 
-        vpcs = list_vpcs()
-        vpc_choice = input("Do you want to select an existing VPC? (yes/no): ").strip().lower()
+    Entries get a fixed timestamp and mode, so unchanged sources always give
+    the same bytes and therefore the same CodeSha256.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for name in LAMBDA_MODULES:
+            with open(os.path.join(SOURCE_DIR, name), "r") as file:
+                source = file.read()
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zip_file.writestr(info, source)
+    return buffer.getvalue()
 
-        if vpc_choice == "yes":
-            vpc_id = input("Enter the VPC ID to use: ").strip()
-            subnet_id = input("Enter the Subnet ID to use: ").strip()
-        else:
-            vpc_id, subnet_id = create_vpc()
-            if not vpc_id:
-                print("Failed to create VPC. Exiting.")
-                return
 
-        sg_id = create_security_group(vpc_id)
-        if not sg_id:
-            print("Failed to create security group. Exiting.")
-            return
+def code_sha256(package):
+    """Returns a package digest in the form Lambda reports as CodeSha256."""
+    return base64.b64encode(hashlib.sha256(package).digest()).decode()
 
-        key_name = input("Enter the key pair name (will be created if it doesn't exist): ").strip()
-        if not create_key_pair(key_name):
-            print("Failed to create key pair. Exiting.")
-            return
 
-        instance_id = launch_ec2_instance(key_name, sg_id, subnet_id)
-        if not instance_id:
-            print("Failed to launch EC2 instance. Exiting.")
-            return
+def update_lambda_function(function_name, configuration, package, settings):
+    """Brings an existing function up to date, uploading code only when its hash differs."""
+    changed = {key: value for key, value in settings.items() if configuration.get(key) != value}
+    if changed:
+        print(f"Updating Lambda Function {function_name} settings: {', '.join(sorted(changed))}...")
+        # Lambda rejects a change while a previous update is still being applied, or while a new role propagates.
+        call_with_role_retries(
+            lambda: lambda_client.update_function_configuration(FunctionName=function_name, **changed),
+            f"Updating Lambda Function {function_name}", ["ResourceConflictException"])
 
-        allocate_elastic_ip(instance_id)
+    if configuration["CodeSha256"] == code_sha256(package):
+        print(f"Lambda Function {function_name} code is unchanged. Skipping the upload.")
+        return
+    print(f"Uploading new code for Lambda Function {function_name}...")
+    call_with_retries(lambda: lambda_client.update_function_code(FunctionName=function_name, ZipFile=package),
+                      ["ResourceConflictException"], f"Updating Lambda Function {function_name} code")
 
-        role_arn = create_lambda_role()
-        if not role_arn:
-            print("Failed to create IAM Role. Exiting.")
-            return
 
-        function_arn = create_lambda_function(instance_id, role_arn)
-        if not function_arn:
-            print("Failed to create Lambda Function. Exiting.")
-            return
+def create_lambda_function(role_arn):
+    """Creates the Lambda function that enforces the monthly data cap on the region's servers.
 
-        create_cloudwatch_alarm(instance_id, function_arn)
+    The function is shared by every server in the region, so an existing one
+    is updated in place instead.
+    """
+    function_name = "StopEC2Instance"
+    package = build_lambda_package()
+    settings = {
+        "Role": role_arn,
+        "Handler": "data_cap_handler.lambda_handler",
+        "Timeout": 60,
+        "Environment": {"Variables": {"DATA_CAP_BYTES": str(usage.DATA_CAP_BYTES)}},
+    }
+    try:
+        try:
+            configuration = lambda_client.get_function(FunctionName=function_name)["Configuration"]
+        except lambda_client.exceptions.ResourceNotFoundException:
+            configuration = None
+
+        if configuration:
+            print(f"Lambda Function {function_name} already exists. Updating it in place...")
+            update_lambda_function(function_name, configuration, package, settings)
+            function_arn = configuration["FunctionArn"]
+        else:
+            print("Creating Lambda Function...")
+            # A role created moments ago is rejected until it has propagated through IAM.
+            response = call_with_role_retries(lambda: lambda_client.create_function(
+                FunctionName=function_name,
+                Runtime="python3.9",
+                Code={"ZipFile": package},
+                Tags={DEPLOYMENT_TAG: resources["deployment_id"]},
+                **settings
+            ), "Waiting for the IAM role to propagate")
+            function_arn = response["FunctionArn"]
+            print(f"Lambda Function {function_name} created successfully.")
+        record_resource("lambda_function_name", function_name)
+        record_resource("lambda_function_arn", function_arn)
+        return function_arn
+    except Exception as e:
+        print(f"Error creating Lambda Function: {e}")
+        return None
 
-        save_resources_to_file()
 
-        # Print SSH login instructions
-        print_ssh_instructions()
+def schedule_usage_checks(function_arn, rule_name="MonthlyDataUsageCheck"):
+    """Runs the data cap Lambda on a fixed schedule.
 
-        print("Setup completed successfully!")
+    Each run adds the traffic since the previous one to the month's running
+    total and stops any instance that has used up the cap.
+    """
+    print(f"Scheduling data usage checks ({USAGE_CHECK_SCHEDULE}) with rule {rule_name}...")
+    try:
+        rule_arn = events_client.put_rule(Name=rule_name, ScheduleExpression=USAGE_CHECK_SCHEDULE,
+                                          State="ENABLED", Tags=deployment_tags())["RuleArn"]
+        record_resource("usage_check_rule_name", rule_name)
+        call_ignoring(lambda: lambda_client.add_permission(
+            FunctionName=function_arn,
+            StatementId=f"{rule_name}-invoke",
+            Action="lambda:InvokeFunction",
+            Principal="events.amazonaws.com",
+            SourceArn=rule_arn,
+        ), ["ResourceConflictException"])
+        events_client.put_targets(Rule=rule_name, Targets=[{"Id": USAGE_CHECK_TARGET_ID, "Arn": function_arn}])
+        print(f"Data usage checks scheduled; instances stop at {usage.DATA_CAP_BYTES / 1024 ** 3:.0f} GB per month.")
+        return True
+    except Exception as e:
+        print(f"Error scheduling data usage checks: {e}")
+        return False
+
+
+def build_deploy_steps(create_new_vpc, scale_out=False):
+    """Builds the provisioning graph; independent steps run concurrently."""
+    steps = [
+        Step("create_security_group", create_security_group, requires=["vpc_id"], provides=["sg_id"]),
+        Step("create_key_pair", create_key_pair, requires=["key_name"], provides=["key_pair_name"]),
+        Step("launch_ec2_instance", launch_missing_instances,
+             requires=["key_pair_name", "sg_id", "subnet_id", "image_id", "instance_type", "instance_count",
+                       "user_data"],
+             provides=["instance_ids"]),
+        Step("allocate_elastic_ips", allocate_elastic_ips, requires=["instance_ids"], provides=["elastic_ips"]),
+        Step("create_lambda_role", create_lambda_role, provides=["role_arn"]),
+        Step("create_lambda_function", create_lambda_function, requires=["role_arn"], provides=["function_arn"]),
+        Step("schedule_usage_checks", schedule_usage_checks, requires=["function_arn"]),
+    ]
+    if create_new_vpc:
+        steps.insert(0, Step("create_vpc", create_vpc, requires=["availability_zones", "vpc_cidr"],
+                             provides=["vpc_id", "subnet_id"]))
+    if scale_out:
+        # The load balancer is the servers' public endpoint, so they get no Elastic IPs.
+        steps = [step for step in steps if step.name != "allocate_elastic_ips"]
+        steps.append(Step("create_load_balancer", create_load_balancer,
+                          requires=["vpc_id", "subnet_id", "availability_zones"], provides=["target_group_arns"]))
+        steps.append(Step("register_targets", register_targets,
+                          requires=["instance_ids", "target_group_arns", "sg_id", "subnet_id"]))
+    return steps
+
+
+def init_clients(region):
+    """Creates the AWS clients used by the create_* functions for one region."""
+    global ec2_client, iam_client, lambda_client, events_client, elbv2_client
+    resources["region"] = region  # Save the specified region to the resources dictionary
+    ec2_client = lazy_client("ec2", region)
+    elbv2_client = lazy_client("elbv2", region)
+    iam_client = lazy_client("iam", region)
+    lambda_client = lazy_client("lambda", region)
+    events_client = lazy_client("events", region)
+
+
+def deploy(context, create_new_vpc, resources_file="resources.json", resume=False):
+    """Runs the provisioning graph and saves the resources. Returns True on success."""
+    global journal_file
+    journal_file = journal.journal_path(resources_file)
+    if not resume and os.path.exists(journal_file):
+        print(f"Found '{journal_file}' from an interrupted deploy. Resume it or clean it up first.")
+        return False
+    context = dict(context)
+    context.setdefault("instance_count", 1)
+
+    # Reject anything that can't work, in one round of lookups, before anything is created.
+    launch_config, errors, notes = preflight.check(resources["region"], context, resources)
+    for note in notes:
+        print(f"Note: {note}")
+    if errors:
+        for error in errors:
+            print(f"Error: {error}")
+        return False
+    tuning = context.get("tuning") or {}
+    try:
+        context["user_data"] = bootstrap.render(launch_config["instance_type"], launch_config["vcpus"], tuning)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+    context.update(launch_config)
+    record_resource("region", resources["region"])
+    # Kept across resumes so every resource of the deploy carries the same ID.
+    record_resource("deployment_id", resources.get("deployment_id") or uuid.uuid4().hex[:12])
+    record_resource("instance_count", context["instance_count"])  # What a resumed run launches up to
+    record_resource("instance_type", launch_config["instance_type"])
+    record_resource("image_id", launch_config["image_id"])
+    if create_new_vpc:
+        record_resource("vpc_cidr", launch_config["vpc_cidr"])
+    if tuning:
+        record_resource("tuning", tuning)
+    if context.get("scale_out"):
+        limits = {"min_instances": context["instance_count"]}
+        if context.get("max_instances"):
+            limits["max_instances"] = context["max_instances"]
+        record_resource("scale_out", dict(resources.get("scale_out", {}), **limits))
+
+    steps = build_deploy_steps(create_new_vpc, context.get("scale_out"))
+    context, timings = run_steps(steps, context)
+    instrumentation.record_steps("deploy", timings)
+
+    # Save whatever was created, even on failure, so clean_up.py can remove it.
+    if save_resources_to_file(resources_file):
+        journal.remove(journal_file)
+    print_timing_report(timings, f"Deploy timing report ({resources['region']})")
+    return all_succeeded(timings)
+
+
+def load_recorded_resources(resources_file="resources.json"):
+    """Combines a resources file with the records in its journal."""
+    state = {}
+    if os.path.exists(resources_file):
+        with open(resources_file, "r") as file:
+            state.update(json.load(file))
+    state.update(journal.replay(journal.journal_path(resources_file)))
+    return state
+
+
+def _existing_ids(describe, result_key, id_key, filter_name, ids):
+    """Returns which of ids still exist, using one filtered describe call."""
+    if not ids:
+        return set()
+    response = describe(Filters=[{"Name": filter_name, "Values": list(ids)}])
+    return {item[id_key] for item in response[result_key]}
+
+
+def _live_instance_ids(instance_ids):
+    if not instance_ids:
+        return set()
+    response = ec2_client.describe_instances(Filters=[
+        {"Name": "instance-id", "Values": list(instance_ids)},
+        {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]},
+    ])
+    return {instance["InstanceId"] for reservation in response["Reservations"] for instance in reservation["Instances"]}
+
+
+def _function_exists(function_name):
+    try:
+        lambda_client.get_function(FunctionName=function_name)
+        return True
+    except Exception:
+        return False
+
+
+def verify_recorded_resources():
+    """Drops recorded resources that no longer exist, with one describe call per resource type."""
+    elastic_ips = resources.get("elastic_ips", {})
+    checks = {
+        "vpc_id": lambda: _existing_ids(ec2_client.describe_vpcs, "Vpcs", "VpcId", "vpc-id",
+                                        [resources["vpc_id"]] if "vpc_id" in resources else []),
+        "subnets": lambda: _existing_ids(ec2_client.describe_subnets, "Subnets", "SubnetId", "subnet-id",
+                                         resources.get("subnets", [])),
+        "internet_gateway_id": lambda: _existing_ids(
+            ec2_client.describe_internet_gateways, "InternetGateways", "InternetGatewayId", "internet-gateway-id",
+            [resources["internet_gateway_id"]] if "internet_gateway_id" in resources else []),
+        "route_table_id": lambda: _existing_ids(
+            ec2_client.describe_route_tables, "RouteTables", "RouteTableId", "route-table-id",
+            [resources["route_table_id"]] if "route_table_id" in resources else []),
+        "security_group_id": lambda: _existing_ids(
+            ec2_client.describe_security_groups, "SecurityGroups", "GroupId", "group-id",
+            [resources["security_group_id"]] if "security_group_id" in resources else []),
+        "instance_ids": lambda: _live_instance_ids(resources.get("instance_ids", [])),
+        "elastic_ips": lambda: _existing_ids(ec2_client.describe_addresses, "Addresses", "AllocationId",
+                                             "allocation-id", [eip["allocation_id"] for eip in elastic_ips.values()]),
+        "lambda_function_arn": lambda: ({resources["lambda_function_arn"]}
+                                        if "lambda_function_arn" in resources
+                                        and _function_exists(resources["lambda_function_name"]) else set()),
+    }
+    with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+        futures = {key: executor.submit(check) for key, check in checks.items()}
+        existing = {key: future.result() for key, future in futures.items()}
+
+    for key in ("vpc_id", "internet_gateway_id", "route_table_id", "security_group_id", "lambda_function_arn"):
+        if key in resources and resources[key] not in existing[key]:
+            print(f"Recorded {key} {resources[key]} no longer exists; it will be recreated.")
+            del resources[key]
+    if "vpc_id" not in resources:
+        for key in ("subnets", "internet_gateway_id", "route_table_id"):
+            resources.pop(key, None)
+    for key in ("subnets", "instance_ids"):
+        if key in resources:
+            resources[key] = [item for item in resources[key] if item in existing[key]]
+            if not resources[key]:
+                del resources[key]
+    if elastic_ips:
+        resources["elastic_ips"] = {instance_id: eip for instance_id, eip in elastic_ips.items()
+                                    if eip["allocation_id"] in existing["elastic_ips"]}
+
+
+def tuning_options(options):
+    """Returns the bootstrap tuning values given in the deploy options."""
+    return {key: options[key] for key in bootstrap.TUNING_KEYS if options.get(key) is not None}
+
+
+def resume_context(options):
+    """Builds the deploy context from verified resources so finished steps are skipped."""
+    context = {
+        "key_name": options.get("key_name") or resources.get("key_pair_name"),
+        "instance_count": (options.get("instance_count") or resources.get("instance_count")
+                           or len(resources.get("instance_ids", [])) or 1),
+        "instance_type": options.get("instance_type") or resources.get("instance_type"),
+        "image_id": options.get("image_id") or resources.get("image_id"),
+        "tuning": tuning_options(options) or resources.get("tuning"),
+        "scale_out": options.get("scale_out") or "scale_out" in resources,
+        "max_instances": options.get("max_instances") or resources.get("scale_out", {}).get("max_instances"),
+    }
+    if options.get("vpc_id"):
+        context["vpc_id"] = options["vpc_id"]
+        context["subnet_id"] = options["subnet_id"]
+    # create_vpc builds preflight.SUBNET_COUNT subnets whatever the zone count, spreading the zones across them.
+    elif all(key in resources for key in ("vpc_id", "internet_gateway_id", "route_table_id")) \
+            and len(resources.get("subnets", [])) >= preflight.SUBNET_COUNT:
+        context["vpc_id"] = resources["vpc_id"]
+        context["subnet_id"] = resources["subnets"][0]
+    if "security_group_id" in resources:
+        context["sg_id"] = resources["security_group_id"]
+    if "key_pair_name" in resources:
+        context["key_pair_name"] = resources["key_pair_name"]
+    if len(resources.get("instance_ids", [])) >= context["instance_count"]:
+        context["instance_ids"] = resources["instance_ids"]
+    if "lambda_function_arn" in resources:
+        context["function_arn"] = resources["lambda_function_arn"]
+    if "load_balancer_arn" in resources and len(resources.get("target_group_arns", {})) == len(LOAD_BALANCER_LISTENERS):
+        context["target_group_arns"] = resources["target_group_arns"]
+    return context
+
+
+def prompt_for_options(options):
+    """Prompts for any deploy option that was not given on the command line or in a config file."""
+    options = dict(options)
+    if not options.get("region"):
+        options["region"] = input("Enter the AWS region (e.g., eu-west-2): ").strip()
+    init_clients(options["region"])
+
+    if not options.get("vpc_id") and not options.get("create_vpc"):
+        vpcs = list_vpcs()
+        vpc_choice = input("Do you want to select an existing VPC? (yes/no): ").strip().lower()
+        if vpc_choice == "yes":
+            options["vpc_id"] = input("Enter the VPC ID to use: ").strip()
+        else:
+            options["create_vpc"] = True
+    if options.get("vpc_id") and not options.get("subnet_id"):
+        options["subnet_id"] = input("Enter the Subnet ID to use: ").strip()
+    if not options.get("key_name"):
+        options["key_name"] = input("Enter the key pair name (will be created if it doesn't exist): ").strip()
+    return options
+
+
+def create(options, resources_file="resources.json", resume=False):
+    """Deploys without any prompts from fully specified options. Returns True on success.
+
+    With resume=True the resources recorded by an interrupted run are verified
+    and only the missing work is done.
+    """
+    if resume:
+        resources.clear()
+        resources.update(load_recorded_resources(resources_file))
+        region = options.get("region") or resources.get("region")
+        if not region:
+            print(f"Nothing to resume: '{resources_file}' and its journal are missing.")
+            return False
+        init_clients(region)
+        print("Verifying resources recorded by the previous run...")
+        verify_recorded_resources()
+        context = resume_context(options)
+        if not context["key_name"]:
+            print("No key pair name was recorded. Pass one to resume.")
+            return False
+    else:
+        init_clients(options["region"])
+        context = {"key_name": options["key_name"], "instance_count": options.get("instance_count", 1),
+                   "instance_type": options.get("instance_type"), "image_id": options.get("image_id"),
+                   "tuning": tuning_options(options), "scale_out": options.get("scale_out"),
+                   "max_instances": options.get("max_instances")}
+        if options.get("vpc_id"):
+            context["vpc_id"] = options["vpc_id"]
+            context["subnet_id"] = options["subnet_id"]
+
+    if not deploy(context, create_new_vpc=not options.get("vpc_id"), resources_file=resources_file, resume=resume):
+        print("Setup did not complete. Re-run with --resume to continue, or run clean_up.py to remove "
+              "the partially created resources.")
+        return False
+
+    # Print SSH login instructions
+    print_ssh_instructions(resources_file)
+
+    print("Setup completed successfully!")
+    return True
+
+
+def main(options=None):
+    print("Starting script...")
+    try:
+        return create(prompt_for_options(options or {}))
     except Exception as e:
         print(f"An error occurred: {e}")
+        return False
 
 
 def ssh_into_instance(pem_file, elastic_ip):
@@ -501,28 +933,37 @@ def ssh_into_instance(pem_file, elastic_ip):
 
 
 
-def print_ssh_instructions():
+def print_ssh_instructions(filename="resources.json"):
     """Print SSH instructions based on the existing resources."""
     try:
         # Load the resources from the JSON file
-        with open("resources.json", "r") as file:
+        with open(filename, "r") as file:
             resources = json.load(file)
         
-        # Extract the Elastic IP and key pair name from resources
-        elastic_ip = resources.get("elastic_ip")
+        # Extract the Elastic IPs and key pair name from resources
+        elastic_ips = [eip["public_ip"] for eip in resources.get("elastic_ips", {}).values()]
+        if "elastic_ip" in resources:
+            elastic_ips.append(resources["elastic_ip"])  # resources.json written by older versions
         key_name = resources.get("key_pair_name")
-        pem_file = os.path.abspath(f"{key_name}.pem") if key_name else None  # Get absolute path for clarity
+        key_directory = os.path.dirname(os.path.abspath(filename))
+        pem_file = os.path.join(key_directory, f"{key_name}.pem") if key_name else None  # Get absolute path for clarity
 
         # Print the SSH command if both Elastic IP and key name exist
-        if elastic_ip and pem_file:
+        if resources.get("load_balancer_dns"):
+            print(f"\nClients connect through the load balancer at {resources['load_balancer_dns']} "
+                  f"(UDP 1194, TCP 443).")
+            if not elastic_ips:
+                return
+        if elastic_ips and pem_file:
             print("\nSSH Instructions:")
             print("To connect to your OpenVPN instance, run the following command:\n")
-            print(f"ssh -i \"{pem_file}\" openvpnas@{elastic_ip}")
+            for elastic_ip in elastic_ips:
+                print(f"ssh -i \"{pem_file}\" openvpnas@{elastic_ip}")
             print("\nEnsure your .pem file has the correct permissions (chmod 400) before running the command.")
         else:
-            print("Elastic IP or Key Pair information is missing. Please check the resources.json file.")
+            print(f"Elastic IP or Key Pair information is missing. Please check the {filename} file.")
     except FileNotFoundError:
-        print("resources.json file not found. Ensure the VPN create script has been run successfully.")
+        print(f"{filename} file not found. Ensure the VPN create script has been run successfully.")
     except Exception as e:
         print(f"An error occurred while printing SSH instructions: {e}")
 
@@ -530,3 +971,4 @@ def print_ssh_instructions():
 
 if __name__ == "__main__":
     main()
+    instrumentation.write_reports("deploy")
@@ -0,0 +1,227 @@
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from retries import error_code
+
+# Adaptive backoff used while polling describe_instances. A fresh instance
+# usually leaves "pending" within 15-40 seconds, so start with short polls and
+# back off gradually instead of sleeping for a fixed minute.
+INITIAL_POLL_DELAY = 1
+MAX_POLL_DELAY = 5
+BACKOFF_FACTOR = 1.5
+DEFAULT_TIMEOUT = 600
+MAX_FILTER_VALUES = 200  # EC2 accepts at most this many values per filter
+
+
+def describe_instance_states(ec2_client, instance_ids):
+    """Returns a {instance_id: state_name} mapping, with one describe_instances call per 200 IDs.
+
+    IDs are passed as a filter rather than as InstanceIds, so an instance that
+    is not visible yet, or no longer, is left out instead of failing the call.
+    """
+    states = {}
+    instance_ids = list(instance_ids)
+    for index in range(0, len(instance_ids), MAX_FILTER_VALUES):
+        chunk = instance_ids[index:index + MAX_FILTER_VALUES]
+        response = ec2_client.describe_instances(Filters=[{"Name": "instance-id", "Values": chunk}])
+        for reservation in response.get("Reservations", []):
+            for instance in reservation.get("Instances", []):
+                states[instance["InstanceId"]] = instance["State"]["Name"]
+    return states
+
+
+class InstanceStatePoller:
+    """The shared describe_instances poll of one region.
+
+    Every thread waiting on instances in the region registers their IDs here.
+    Whichever waiter is due first describes all registered instances in one
+    call, and the others read their states from that result, so fifty
+    concurrent waits cost the same API traffic as one.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.watchers = {}  # instance_id -> number of waiters
+        self.states = {}
+        self.polled = set()
+        self.generation = 0
+        self.polling = False
+
+    def watch(self, instance_ids):
+        """Registers instance IDs.
+
+        Returns the generation to pass to the first poll, and whether other
+        waiters were already polling.
+        """
+        with self.condition:
+            shared = bool(self.watchers)
+            for instance_id in instance_ids:
+                self.watchers[instance_id] = self.watchers.get(instance_id, 0) + 1
+            return self.generation, shared
+
+    def unwatch(self, instance_ids):
+        with self.condition:
+            for instance_id in instance_ids:
+                if self.watchers.get(instance_id, 0) > 1:
+                    self.watchers[instance_id] -= 1
+                else:
+                    self.watchers.pop(instance_id, None)
+
+    def poll(self, ec2_client, instance_ids, seen_generation, patience=0):
+        """Returns (generation, states) from a poll that finished after seen_generation and covered instance_ids.
+
+        Waits up to patience seconds for another waiter's poll before
+        describing the instances itself.
+        """
+        deadline = time.monotonic() + patience
+        with self.condition:
+            while True:
+                if self.polling:
+                    self.condition.wait()
+                    continue
+                if self.generation > seen_generation and self.polled.issuperset(instance_ids):
+                    return self.generation, dict(self.states)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            self.polling = True
+            watched = set(self.watchers) | set(instance_ids)
+        try:
+            states = describe_instance_states(ec2_client, watched)
+        except Exception:
+            with self.condition:
+                self.polling = False
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self.states, self.polled = states, watched
+            self.generation += 1
+            self.polling = False
+            self.condition.notify_all()
+            return self.generation, dict(states)
+
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+
+def instance_poller(ec2_client):
+    """Returns the shared poller for the client's region."""
+    region = ec2_client.meta.region_name
+    with _pollers_lock:
+        poller = _pollers.get(region)
+        if poller is None:
+            poller = _pollers[region] = InstanceStatePoller()
+        return poller
+
+
+def wait_for_instance_state(ec2_client, instance_ids, target_state="running", timeout=DEFAULT_TIMEOUT):
+    """Polls with adaptive backoff until every instance reaches target_state.
+
+    Concurrent waits in the same region share their describe_instances polls.
+    """
+    if isinstance(instance_ids, str):
+        instance_ids = [instance_ids]
+    poller = instance_poller(ec2_client)
+    pending = set(instance_ids)
+    delay = INITIAL_POLL_DELAY
+    deadline = time.monotonic() + timeout
+    generation, shared = poller.watch(pending)
+    # Joining waits that are already polling picks up their next poll instead of adding one.
+    patience = delay if shared else 0
+
+    try:
+        while pending:
+            generation, states = poller.poll(ec2_client, pending, generation, patience)
+            for instance_id in sorted(pending):
+                state = states.get(instance_id)
+                # Long-terminated instances disappear from describe calls altogether;
+                # freshly launched ones can briefly be missing too.
+                if state == target_state or (state is None and target_state == "terminated"):
+                    pending.discard(instance_id)
+                    poller.unwatch([instance_id])
+                elif state in ("terminated", "shutting-down") and target_state != "terminated":
+                    raise RuntimeError(f"Instance {instance_id} entered state '{state}' "
+                                       f"while waiting for '{target_state}'.")
+
+            if not pending:
+                break
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Timed out waiting for {sorted(pending)} to reach '{target_state}'.")
+            patience = delay
+            delay = min(delay * BACKOFF_FACTOR, MAX_POLL_DELAY)
+    finally:
+        poller.unwatch(pending)
+
+    return list(instance_ids)
+
+
+def wait_for_load_balancer_deleted(elbv2_client, load_balancer_arn, timeout=DEFAULT_TIMEOUT):
+    """Polls with adaptive backoff until a deleted load balancer no longer exists.
+
+    Its network interfaces, which block deleting the subnets, go with it.
+    """
+    deadline = time.monotonic() + timeout
+    delay = INITIAL_POLL_DELAY
+    while True:
+        try:
+            elbv2_client.describe_load_balancers(LoadBalancerArns=[load_balancer_arn])
+        except Exception as e:
+            if error_code(e) == "LoadBalancerNotFound":
+                return
+            raise
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Timed out waiting for load balancer {load_balancer_arn} to be deleted.")
+        time.sleep(delay)
+        delay = min(delay * BACKOFF_FACTOR, MAX_POLL_DELAY)
+
+
+def wait_for_targets_drained(elbv2_client, target_group_arns, instance_ids, timeout=DEFAULT_TIMEOUT):
+    """Polls with adaptive backoff until deregistered instances have finished draining in every target group."""
+    deadline = time.monotonic() + timeout
+    delay = INITIAL_POLL_DELAY
+    targets = [{"Id": instance_id} for instance_id in instance_ids]
+    pending = list(target_group_arns)
+    while True:
+        pending = [arn for arn in pending if any(
+            description["TargetHealth"]["State"] == "draining"
+            for description in elbv2_client.describe_target_health(
+                TargetGroupArn=arn, Targets=targets)["TargetHealthDescriptions"])]
+        if not pending:
+            return
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Timed out waiting for {sorted(instance_ids)} to drain.")
+        time.sleep(delay)
+        delay = min(delay * BACKOFF_FACTOR, MAX_POLL_DELAY)
+
+
+def wait_for_tcp_port(host, port, timeout=DEFAULT_TIMEOUT, connect_timeout=2):
+    """Retries a TCP connect with adaptive backoff until host:port accepts connections.
+
+    Returns the seconds it took.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = INITIAL_POLL_DELAY
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=connect_timeout):
+                return time.monotonic() - start
+        except OSError:
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Timed out waiting for {host}:{port} to accept connections.")
+        time.sleep(delay)
+        delay = min(delay * BACKOFF_FACTOR, MAX_POLL_DELAY)
+
+
+def wait_for_tcp_ports(endpoints, timeout=DEFAULT_TIMEOUT):
+    """Waits for every (host, port) in endpoints concurrently. Returns {(host, port): seconds}."""
+    endpoints = list(endpoints)
+    if not endpoints:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        futures = {endpoint: executor.submit(wait_for_tcp_port, *endpoint, timeout) for endpoint in endpoints}
+        return {endpoint: future.result() for endpoint, future in futures.items()}